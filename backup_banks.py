@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# backs up every guild in BANK_DIR into one gzipped archive of JSON lines, and restores from it.
+# each guild is a run of lines: its other fields, then a line per user, open bet and settled bet,
+# then an end line with the counts and the sha256 of the guild's lines before it:
+#   {"type": "guild", "guild": ..., "fields": {...}}
+#   {"type": "user", "guild": ..., "user": {...}}
+#   {"type": "bet", "guild": ..., "bet": {...}}
+#   {"type": "history", "guild": ..., "bet": {...}}
+#   {"type": "end", "guild": ..., "users": N, "bets": N, "history": N, "sha256": ...}
+# between an "archive" line and an "archive end" line with the number of guilds, so a truncated
+# archive is noticed. history indexes aren't backed up; they are rebuilt on restore.
+#
+# guilds are exported in parallel, each by a worker that writes its own gzip member, and the
+# members are concatenated into the archive as they finish. a worker reads the snapshot and
+# journal holding the guild's lock shared, so it sees the bank between two commands, and notes
+# where the history ends; settled bets are only ever appended, so the history up to there is
+# streamed after the lock is released. at most --jobs banks are in memory at once, and users
+# are streamed out of binary snapshots without building them.
+#
+# restoring replaces each guild's snapshot, journal and history, holding its lock exclusively
+# while they are swapped in. the archive is checked as it's read, and a guild is only restored
+# once its end line matches. "verify" only checks the archive. only file banks are backed up;
+# restore into files and use sqlbank.py to import them into SQLite.
+#
+#   python backup_banks.py export ARCHIVE [--jobs N] [GUILD...]
+#   python backup_banks.py import ARCHIVE [--jobs N] [--format json|binary] [GUILD...]
+#   python backup_banks.py verify ARCHIVE
+import argparse
+import contextlib
+import datetime
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import binbank
+import lambda_function
+
+ARCHIVE_VERSION = 1
+GZIP_LEVEL = 6 # most of 9's ratio at a fraction of the time
+HISTORY_CHUNK = 1000 # settled bets written to a history segment at once when restoring
+WRITE_BUFFER = 1024 * 1024 # bytes of lines gathered before they are compressed
+
+def line(record: dict):
+    return (json.dumps(record) + '\n').encode('utf-8')
+
+def read_guild(guild: str):
+    # the bank as JSON, users still in a binary snapshot, the end of the history and settled
+    # bets a crashed command left off it, as of one moment between commands
+    lock = lambda_function.open_guild_lock(guild, fcntl.LOCK_SH)
+    try:
+        obj, source, _ = lambda_function.read_snapshot(lambda_function.server_file(guild))
+        records = lambda_function.read_journal(lambda_function.journal_file(guild))
+        lambda_function.apply_journal_records(obj, records)
+        dir = lambda_function.history_dir(guild)
+        end = lambda_function.history_end(dir)
+        unrecorded = lambda_function.unrecorded_bets(dir, records)
+    finally:
+        os.close(lock)
+    if source is None and obj == lambda_function.empty_bank_json():
+        obj = lambda_function.new_bank_json()
+    return obj, source, end, unrecorded
+
+def guild_users(obj: dict, source):
+    # users changed since a binary snapshot was written are in obj, and replace theirs in it
+    if source is not None:
+        for record in source.user_records():
+            if record[0] not in obj['users']:
+                yield binbank.user_dict(*record)
+    yield from obj['users'].values()
+
+def guild_history(guild: str, obj: dict, end: tuple[int, int], unrecorded: list[dict]):
+    dir = lambda_function.history_dir(guild)
+    if end == (0, 0):
+        # from before history segments, still in the snapshot
+        yield from obj['history']
+    for position, _, bet in lambda_function.scan_history(dir, (0, 0)):
+        if position >= end:
+            break
+        if bet is None:
+            print(f"Skipping unreadable history entry in {dir}")
+            continue
+        yield bet
+    yield from unrecorded
+
+def export_guild(task: tuple):
+    guild, parts = task
+    report = {"guild": guild, "users": 0, "bets": 0, "history": 0}
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            obj, source, end, unrecorded = read_guild(guild)
+            part = f"{parts}/{guild}.gz"
+            checksum = hashlib.sha256()
+            # buffered, as every line written to a GzipFile on its own costs as much as compressing it
+            with gzip.open(part, "wb", compresslevel=GZIP_LEVEL) as compressed, \
+                    io.BufferedWriter(compressed, WRITE_BUFFER) as file:
+                def write(record: dict):
+                    data = line(record)
+                    checksum.update(data)
+                    file.write(data)
+                fields = {key: value for key, value in obj.items() if key not in ("users", "currentBets", "history")}
+                write({"type": "guild", "guild": guild, "fields": fields})
+                for user in guild_users(obj, source):
+                    write({"type": "user", "guild": guild, "user": user})
+                    report["users"] += 1
+                for bet in obj['currentBets']:
+                    write({"type": "bet", "guild": guild, "bet": bet})
+                    report["bets"] += 1
+                for bet in guild_history(guild, obj, end, unrecorded):
+                    write({"type": "history", "guild": guild, "bet": bet})
+                    report["history"] += 1
+                file.write(line({"type": "end", "guild": guild, "users": report["users"], "bets": report["bets"],
+                                 "history": report["history"], "sha256": checksum.hexdigest()}))
+            report["part"] = part
+            report["bytes"] = os.path.getsize(part)
+    except Exception as e:
+        report["error"] = repr(e)
+    report["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    report["log"] = log.getvalue().splitlines()
+    return report
+
+def export_archive(path: str, guilds: list[str], jobs: int):
+    # written beside the archive and renamed over it once complete
+    tmp = f"{path}.tmp"
+    parts = tempfile.mkdtemp(prefix="parts-", dir=os.path.dirname(os.path.abspath(path)))
+    reports = []
+    try:
+        with open(tmp, "wb") as archive:
+            archive.write(gzip.compress(line({"type": "archive", "version": ARCHIVE_VERSION,
+                                              "bankVersion": lambda_function.VERSION,
+                                              "created": datetime.datetime.now().isoformat()})))
+            with multiprocessing.Pool(jobs) as pool:
+                for report in pool.imap_unordered(export_guild, [(guild, parts) for guild in guilds]):
+                    if "part" in report:
+                        # gzip members one after another read back as one stream
+                        with open(report["part"], "rb") as part:
+                            shutil.copyfileobj(part, archive)
+                        os.remove(report["part"])
+                    print_report(report)
+                    reports.append(report)
+            exported = sum(1 for report in reports if "error" not in report)
+            archive.write(gzip.compress(line({"type": "archive end", "guilds": exported})))
+            archive.flush()
+            os.fsync(archive.fileno())
+        os.replace(tmp, path)
+    finally:
+        shutil.rmtree(parts, ignore_errors=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return reports
+
+def restore_guild(task: tuple):
+    # writes the guild's files from its lines in part, replacing whatever it had
+    guild, part, format = task
+    report = {"guild": guild, "users": 0, "bets": 0, "history": 0}
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            if format is not None:
+                lambda_function.BANK_FORMAT = format
+            # the history is built beside the guild's, and the lock only held to swap everything in
+            dir = lambda_function.history_dir(guild)
+            restored = f"{dir}.restore"
+            shutil.rmtree(restored, ignore_errors=True)
+            obj = lambda_function.empty_bank_json()
+            settled = []
+            with open(part, "r", encoding='utf-8') as file:
+                for data in file:
+                    record = json.loads(data)
+                    if record['type'] == "guild":
+                        obj.update(record['fields'])
+                    elif record['type'] == "user":
+                        obj['users'][record['user']['id']] = record['user']
+                    elif record['type'] == "bet":
+                        obj['currentBets'].append(record['bet'])
+                    elif record['type'] == "history":
+                        settled.append(record['bet'])
+                        report["history"] += 1
+                        if len(settled) == HISTORY_CHUNK:
+                            lambda_function.append_history_segment(restored, settled)
+                            settled = []
+            if len(settled) > 0:
+                lambda_function.append_history_segment(restored, settled)
+            lambda_function.index_history(restored)
+            report["users"], report["bets"] = len(obj['users']), len(obj['currentBets'])
+            bank = lambda_function.Bank.from_dict(obj)
+            bank.history_dir = dir
+            lock = lambda_function.open_guild_lock(guild, fcntl.LOCK_EX)
+            try:
+                shutil.rmtree(dir, ignore_errors=True)
+                if os.path.isdir(restored):
+                    os.rename(restored, dir)
+                lambda_function.write_snapshot(lambda_function.server_file(guild), bank)
+                if os.path.exists(lambda_function.journal_file(guild)):
+                    os.remove(lambda_function.journal_file(guild))
+                shutil.rmtree(lambda_function.responses_dir(guild), ignore_errors=True)
+                # containers with the guild cached read it again
+                lambda_function.write_generation(lock, lambda_function.read_generation(lock) + 1)
+            finally:
+                os.close(lock)
+    except Exception as e:
+        report["error"] = repr(e)
+    finally:
+        os.remove(part)
+    report["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    report["log"] = log.getvalue().splitlines()
+    return report
+
+def read_archive(path: str, parts: str | None, wanted: set[str]):
+    # checks the archive line by line, writing each guild wanted to a part file in parts (if
+    # given). yields (guild, part or None, error or None) as each guild's end line is read
+    with gzip.open(path, "rb") as archive:
+        first = json.loads(archive.readline() or b"null")
+        if not isinstance(first, dict) or first.get('type') != "archive":
+            raise Exception(f"{path} is not a bank archive")
+        if first['version'] != ARCHIVE_VERSION:
+            raise Exception(f"{path} is version {first['version']}, only {ARCHIVE_VERSION} can be read")
+        guild = None
+        counts: dict[str, int] = {}
+        checksum = hashlib.sha256()
+        part = None
+        guilds = 0
+        for data in archive:
+            record = json.loads(data)
+            if record['type'] == "archive end":
+                if guild is not None:
+                    raise Exception(f"archive ends in the middle of guild {guild}")
+                if record['guilds'] != guilds:
+                    raise Exception(f"archive has {guilds} guilds, its end says {record['guilds']}")
+                return
+            if guild is None:
+                if record['type'] != "guild":
+                    raise Exception(f"expected a guild, found {record['type']}")
+                guild = record['guild']
+                counts = {"user": 0, "bet": 0, "history": 0}
+                checksum = hashlib.sha256()
+                if parts is not None and (len(wanted) == 0 or guild in wanted):
+                    part = open(f"{parts}/{guild}", "wb")
+            elif record['guild'] != guild:
+                raise Exception(f"found {record['guild']} in the middle of guild {guild}")
+            if record['type'] == "end":
+                if part is not None:
+                    part.close()
+                problem = None
+                if checksum.hexdigest() != record['sha256']:
+                    problem = "checksum does not match"
+                elif (counts["user"], counts["bet"], counts["history"]) != (record['users'], record['bets'], record['history']):
+                    problem = f"has {counts['user']} users, {counts['bet']} bets and {counts['history']} settled bets, " \
+                              f"its end says {record['users']}, {record['bets']} and {record['history']}"
+                guilds += 1
+                yield guild, None if part is None else part.name, problem
+                guild, part = None, None
+                continue
+            checksum.update(data)
+            if record['type'] in counts:
+                counts[record['type']] += 1
+            if part is not None:
+                part.write(data)
+    raise Exception("archive is truncated")
+
+def import_archive(path: str, guilds: list[str], jobs: int, format: str | None):
+    parts = tempfile.mkdtemp(prefix="parts-", dir=os.path.dirname(os.path.abspath(path)))
+    reports = []
+    try:
+        with multiprocessing.Pool(jobs) as pool:
+            pending = []
+            try:
+                for guild, part, problem in read_archive(path, parts, set(guilds)):
+                    if part is None:
+                        continue
+                    if problem is not None:
+                        os.remove(part)
+                        reports.append({"guild": guild, "error": problem})
+                        print_report(reports[-1])
+                        continue
+                    # restored while the rest of the archive is read
+                    pending.append(pool.apply_async(restore_guild, ((guild, part, format),)))
+            except Exception as e:
+                reports.append({"guild": "(archive)", "error": repr(e)})
+                print_report(reports[-1])
+            for result in pending:
+                reports.append(result.get())
+                print_report(reports[-1])
+    finally:
+        shutil.rmtree(parts, ignore_errors=True)
+    return reports
+
+def verify_archive(path: str):
+    reports = []
+    try:
+        for guild, _, problem in read_archive(path, None, set()):
+            if problem is not None:
+                reports.append({"guild": guild, "error": problem})
+                print_report(reports[-1])
+            else:
+                reports.append({"guild": guild})
+    except Exception as e:
+        reports.append({"guild": "(archive)", "error": repr(e)})
+        print_report(reports[-1])
+    return reports
+
+def print_report(report: dict):
+    line = f"{report['guild']:20}"
+    if "users" in report:
+        line += f" {report['users']:>8} users {report['bets']:>6} bets {report['history']:>8} settled"
+    if "ms" in report:
+        line += f" {report['ms']:9.1f} ms"
+    if "error" in report:
+        line += f"  FAILED {report['error']}"
+    print(line)
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(description="back up every guild in BANK_DIR to one archive, or restore from it")
+    parser.add_argument("command", choices=["export", "import", "verify"])
+    parser.add_argument("archive")
+    parser.add_argument("guilds", nargs="*", help="guilds to export or restore, every guild if none")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="guilds exported or restored at once")
+    parser.add_argument("--format", choices=["json", "binary"], help="snapshot format to restore into")
+    options = parser.parse_args(args)
+
+    start = time.perf_counter()
+    if options.command == "export":
+        reports = export_archive(options.archive, options.guilds or lambda_function.file_guilds(), options.jobs)
+    elif options.command == "import":
+        reports = import_archive(options.archive, options.guilds, options.jobs, options.format)
+    else:
+        reports = verify_archive(options.archive)
+    failed = [report['guild'] for report in reports if "error" in report]
+    print(f"{len(reports)} guilds in {time.perf_counter() - start:.1f}s")
+    if len(failed) > 0:
+        print(f"FAILED: {len(failed)}: " + ", ".join(failed))
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
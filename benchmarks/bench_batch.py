@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# throughput of lambda_function.handle_batch against handling the same interactions one at a
+# time through lambda_handler. the load is a burst like the one after midnight: in every guild
+# a run of /bb bank claims by different users, with a bet and its accept every few claims, and
+# the guilds' interactions interleaved as they would arrive. with a warm cache the banks stay
+# parsed between invocations; with a cold one every invocation reads them from disk again.
+# both ways must leave every guild with the same users and open bets
+#
+#   python bench_batch.py [--guilds 20] [--users 10000] [--claims 50] [--batch-sizes 10,100]
+#                         [--cache warm|cold|both] [--format json|binary]
+import argparse
+import contextlib
+import io
+import shutil
+import sys
+import time
+from common import interaction, setup, signed_event, user_id
+
+def guild_commands(guild: str, claims: int):
+    bodies = []
+    for i in range(claims):
+        bodies.append(interaction(guild, user_id(i), "bank"))
+        if i % 5 == 4:
+            # only works if the claims before it were applied first
+            bodies.append(interaction(guild, user_id(i), "bet", against=user_id(i - 1), arbitrator=user_id(i - 2),
+                                      amount=100, condition="it rains"))
+            bodies.append(interaction(guild, user_id(i - 1), "accept", against=user_id(i)))
+    return bodies
+
+def interleave(per_guild: list[list[dict]]):
+    bodies = []
+    for i in range(max(len(commands) for commands in per_guild)):
+        bodies.extend(commands[i] for commands in per_guild if i < len(commands))
+    return bodies
+
+def make_guilds(lambda_function, guilds: list[str], users: int):
+    shutil.rmtree(lambda_function.BANK_DIR, ignore_errors=True)
+    lambda_function.bank_cache.clear()
+    lambda_function.seen_signatures.clear()
+    lambda_function.recent_responses.clear()
+    lambda_function.made_dirs.clear()
+    for guild in guilds:
+        obj = lambda_function.new_bank_json()
+        # the claimers are new to the bank, so every claim pays out
+        obj['users'] = {user_id(-i): {"id": user_id(-i), "balance": 1000, "lastPaycheck": "2023-01-01T00:00:00"}
+                        for i in range(1, users + 1)}
+        bank, _ = lambda_function.load_bank(guild, obj)
+        lambda_function.make_dir(lambda_function.guild_dir(guild))
+        lambda_function.write_snapshot(lambda_function.server_file(guild), bank)
+
+def guild_state(lambda_function, guilds: list[str], claims: int):
+    # balances of the claimers and the open bets, which depend on commands running in order
+    state = {}
+    for guild in guilds:
+        with lambda_function.file_server(guild) as bank:
+            state[guild] = ([bank.get_user(user_id(i)).balance for i in range(claims)],
+                            sorted((bet.p1, bet.p2, bet.pending) for bet in bank.current_bets))
+    return state
+
+def run_one_at_a_time(lambda_function, events: list[dict], cold: bool):
+    for event in events:
+        if cold:
+            lambda_function.bank_cache.clear()
+        lambda_function.lambda_handler(event, None)
+
+def run_batches(lambda_function, events: list[dict], size: int, cold: bool):
+    for start in range(0, len(events), size):
+        if cold:
+            lambda_function.bank_cache.clear()
+        lambda_function.handle_batch(events[start:start + size])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--users", type=int, default=10000, help="users already in each guild's bank")
+    parser.add_argument("--claims", type=int, default=50, help="users claiming their paycheck in each guild")
+    parser.add_argument("--batch-sizes", default="10,100", help="comma separated events per batch")
+    parser.add_argument("--cache", choices=["warm", "cold", "both"], default="both")
+    parser.add_argument("--format", choices=["json", "binary"], default="json", help="snapshot format")
+    args = parser.parse_args()
+
+    signing_key, _ = setup()
+    import lambda_function
+    lambda_function.BANK_FORMAT = args.format
+    guilds = [f"guild{i}" for i in range(args.guilds)]
+    bodies = interleave([guild_commands(guild, args.claims) for guild in guilds])
+    events = [signed_event(signing_key, body) for body in bodies]
+    modes = [("one at a time", lambda cold: run_one_at_a_time(lambda_function, events, cold))]
+    for size in (int(size) for size in args.batch_sizes.split(",")):
+        modes.append((f"batches of {size}", lambda cold, size=size: run_batches(lambda_function, events, size, cold)))
+    caches = ["warm", "cold"] if args.cache == "both" else [args.cache]
+
+    print(f"{len(events)} interactions over {args.guilds} guilds of {args.users} users, {args.format}")
+    print(f"{'':24} {'seconds':>9} {'per second':>11} {'speedup':>8} {'same':>5}")
+    ok = True
+    for cache in caches:
+        expected = None
+        baseline = None
+        for name, run in modes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                make_guilds(lambda_function, guilds, args.users)
+                start = time.perf_counter()
+                run(cache == "cold")
+                seconds = time.perf_counter() - start
+                state = guild_state(lambda_function, guilds, args.claims)
+            if expected is None:
+                expected, baseline = state, seconds
+            same = state == expected
+            ok = ok and same
+            print(f"{name + ', ' + cache:24} {seconds:9.2f} {len(events) / seconds:11.0f} {baseline / seconds:7.1f}x "
+                  f"{'yes' if same else 'NO':>5}")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# compares User and Bet against the dataclass_wizard dataclasses they replaced: how long a
+# synthetic guild's users and bets take to load from their JSON form, how much memory they
+# hold once loaded, and that both write back exactly the JSON they were loaded from.
+# the old classes are copied below; dataclass-wizard itself is only needed to run this
+#
+#   python bench_models.py [--users 100000] [--bets 100000]
+import argparse
+import datetime
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from dataclass_wizard import JSONWizard
+from common import setup
+
+# the models as they were
+class LegacyTracked:
+    def __setattr__(self, name: str, value):
+        if name in self.__dataclass_fields__ and self.__dict__.get(name, LegacyTracked) != value:
+            self.__dict__['_dirty'] = True
+        super().__setattr__(name, value)
+
+    def __post_init__(self):
+        self._dirty = False
+
+@dataclass
+class LegacyUser(LegacyTracked, JSONWizard):
+    id: str
+    balance: int
+    last_paycheck: datetime.datetime
+    wins: int = 0
+    losses: int = 0
+    cancelled: int = 0
+    net: int = 0
+
+@dataclass
+class LegacyBet(LegacyTracked, JSONWizard):
+    p1: str
+    p2: str
+    arbitrator: str
+    amount: int
+    condition: str
+    start_time: datetime.datetime
+    end_time: datetime.datetime
+    p1_won: bool
+    pending: bool
+    rejected: bool
+    p1_cancel: bool
+    p2_cancel: bool
+
+def user_id(i: int):
+    # shaped like a Discord snowflake
+    return str(100000000000000000 + i)
+
+def make_json(users: int, bets: int):
+    random.seed(1)
+    now = datetime.datetime(2023, 8, 1, 12, 0, 0, 123456)
+    user_objs = {}
+    for i in range(users):
+        # some users have never been paid, so last paycheck is the datetime.min sentinel
+        last_paycheck = datetime.datetime.min if i % 10 == 0 else now - datetime.timedelta(seconds=random.randrange(10 ** 7))
+        user_objs[user_id(i)] = {"id": user_id(i), "balance": random.randrange(10 ** 6),
+                                 "lastPaycheck": last_paycheck.isoformat(),
+                                 "wins": i % 7, "losses": i % 5, "cancelled": i % 3, "net": (i % 11 - 5) * 100}
+    bet_objs = []
+    for i in range(bets):
+        pending = i % 4 == 0
+        bet_objs.append({"p1": user_id(random.randrange(users)), "p2": user_id(random.randrange(users)),
+                         "arbitrator": user_id(random.randrange(users)), "amount": random.randrange(1, 1000),
+                         "condition": f"it rains on day {i}",
+                         "startTime": (now - datetime.timedelta(minutes=i)).isoformat(),
+                         # open bets end at the datetime.max sentinel
+                         "endTime": datetime.datetime.max.isoformat() if pending else now.isoformat(),
+                         "p1Won": i % 2 == 0, "pending": pending, "rejected": i % 9 == 0,
+                         "p1Cancel": i % 6 == 0, "p2Cancel": i % 12 == 0})
+    return user_objs, bet_objs
+
+def load(user_class, bet_class, user_objs: dict, bet_objs: list):
+    users = {id: user_class.from_dict(obj) for id, obj in user_objs.items()}
+    bets = [bet_class.from_dict(obj) for obj in bet_objs]
+    return users, bets
+
+def measure(name: str, user_class, bet_class, user_objs: dict, bet_objs: list):
+    start = time.perf_counter()
+    load(user_class, bet_class, user_objs, bet_objs)
+    seconds = time.perf_counter() - start
+    # loaded again under tracemalloc, which slows allocation down too much to time it
+    tracemalloc.start()
+    users, bets = load(user_class, bet_class, user_objs, bet_objs)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    lossless = all(users[id].to_dict() == obj for id, obj in user_objs.items()) and \
+               all(bet.to_dict() == obj for bet, obj in zip(bets, bet_objs))
+    print(f"{name:12} {seconds * 1000:9.1f} {memory / (1 << 20):10.1f} {memory / (len(users) + len(bets)):10.0f} "
+          f"{'yes' if lossless else 'NO':>9}")
+    return lossless
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--bets", type=int, default=100000)
+    args = parser.parse_args()
+
+    setup()
+    import lambda_function
+    user_objs, bet_objs = make_json(args.users, args.bets)
+    print(f"{args.users} users, {args.bets} bets")
+    print(f"{'':12} {'load ms':>9} {'memory MB':>10} {'B/object':>10} {'lossless':>9}")
+    ok = measure("dataclasses", LegacyUser, LegacyBet, user_objs, bet_objs)
+    ok = measure("slots", lambda_function.User, lambda_function.Bet, user_objs, bet_objs) and ok
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
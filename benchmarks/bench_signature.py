@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# micro-benchmark for request signature checks:
+# building a VerifyKey on every request (the old behaviour) against the container-wide key,
+# and how cheaply a replayed request is turned away
+import timeit
+from nacl.signing import VerifyKey
+from common import setup, signed_event
+
+signing_key, _ = setup()
+import lambda_function
+
+N = 2000
+
+event = signed_event(signing_key, {"type": 1})
+header = event['params']['header']
+message = header['x-signature-timestamp'].encode() + event['rawBody'].encode()
+signature = bytes.fromhex(header['x-signature-ed25519'])
+
+def uncached():
+    VerifyKey(bytes.fromhex(lambda_function.PUBLIC_KEY)).verify(message, signature)
+
+def cached():
+    lambda_function.get_verify_key().verify(message, signature)
+
+def replayed():
+    try:
+        lambda_function.verify_signature(event)
+    except Exception:
+        pass
+
+lambda_function.verify_signature(event) # first delivery is accepted and remembered
+for name, fn in [("new key per request", uncached), ("cached key", cached), ("replay rejected", replayed)]:
+    seconds = timeit.timeit(fn, number=N)
+    print(f"{name:20} {seconds / N * 1e6:8.1f} us/request")
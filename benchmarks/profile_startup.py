@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# import cost of a cold start.
+# runs `import lambda_function` in fresh interpreters under -X importtime and prints what each
+# module it pulls in costs, then what the lazily imported dependencies cost on their first use.
+# with --budget-ms it exits non-zero when importing lambda_function takes longer than that, so
+# a new eager import shows up before it reaches the cold-start latency tail
+#
+#   python profile_startup.py [--runs N] [--budget-ms MS]
+import argparse
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from common import ROOT, write_config
+
+# imported inside the functions that need them, not by lambda_function itself
+LAZY = ["humanize", "nacl.signing", "boto3", "urllib3"]
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def importable(name: str):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+def profile_once(config_dir: str, lazy: list[str]):
+    # returns [(depth, module, self us, cumulative us)] in the order -X importtime reports them,
+    # which is children before their parent
+    code = "; ".join(f"import {name}" for name in ["lambda_function"] + lazy)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([config_dir, ROOT]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            env=env, cwd=config_dir, capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            own, cumulative, indent, module = match.groups()
+            entries.append((len(indent) // 2, module, int(own), int(cumulative)))
+    return entries
+
+def report(entries: list[tuple[int, str, int, int]], lazy: list[str]):
+    # lambda_function's direct imports are the depth 1 entries just before it
+    at = max(i for i, entry in enumerate(entries) if entry[:2] == (0, "lambda_function"))
+    direct = []
+    for depth, module, own, cumulative in reversed(entries[:at]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((module, cumulative))
+    total = entries[at][3]
+    first_use = [(module, cumulative) for depth, module, _, cumulative in entries[at + 1:]
+                 if depth == 0 and module.split('.')[0] in {name.split('.')[0] for name in lazy}]
+    return total, sorted(direct, key=lambda item: -item[1]), first_use
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="interpreters to start; the fastest is reported")
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail if importing lambda_function takes longer")
+    args = parser.parse_args()
+
+    lazy = [name for name in LAZY if importable(name)]
+    config_dir = tempfile.mkdtemp(prefix="betbot-startup-")
+    write_config(config_dir)
+    best = None
+    for _ in range(args.runs):
+        result = report(profile_once(config_dir, lazy), lazy)
+        if best is None or result[0] < best[0]:
+            best = result
+    total, direct, first_use = best
+
+    print(f"import lambda_function: {total / 1000:8.1f} ms (fastest of {args.runs})")
+    for module, cumulative in direct:
+        print(f"  {module:30} {cumulative / 1000:8.1f} ms")
+    print("first use of lazy imports:")
+    for module, cumulative in first_use:
+        print(f"  {module:30} {cumulative / 1000:8.1f} ms")
+    for name in LAZY:
+        if name not in lazy:
+            print(f"  {name:30}   not installed")
+
+    if args.budget_ms is not None and total / 1000 > args.budget_ms:
+        print(f"over budget: {total / 1000:.1f} ms > {args.budget_ms:.1f} ms")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
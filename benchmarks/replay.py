@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# replays signed interactions through lambda_handler against synthetic guilds and reports
+# latency percentiles and I/O bytes per subcommand, so storage and parsing changes can be
+# compared against a saved baseline.
+#
+# every guild size in --users is crossed with every history size in --history. in each
+# guild, rounds of bank, bet, accept, decide, bet, reject, bet, accept, cancel, cancel are
+# played between fresh users, then one of them pages through the history of the user who won
+# every bet in the synthetic history. with a warm cache the bank stays parsed between commands, as
+# in a reused container; with a cold one every command loads it from disk. I/O bytes come
+# from the metric lines lambda_function logs (see metrics.py).
+# the full default grid takes a while: a cold command on a 100k user JSON bank is over a second.
+# --check recomputes every guild's stats and leaderboard from scratch after its replay and
+# fails if they differ from the incrementally maintained ones
+#
+#   python replay.py [--users 10,1000,100000] [--history 10,10000,1000000] [--rounds 20]
+#                    [--cache warm|cold|both] [--format json|binary] [--storage files|sqlite]
+#                    [--save FILE] [--compare FILE] [--tolerance 0.25] [--check]
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from common import interaction, setup, signed_event, user_id
+
+SUBCOMMANDS = ["bank", "bet", "accept", "reject", "decide", "cancel", "history"]
+BALANCE = 10 ** 12 # enough that no generated bet is ever refused for money
+
+def round_of_commands(guild: str, a: str, b: str, arbitrator: str):
+    # (subcommand, body) for one round between a and b; every subcommand appears at least once
+    return [
+        ("bank", interaction(guild, a, "bank")),
+        ("bet", interaction(guild, a, "bet", against=b, arbitrator=arbitrator, amount=100, condition="it rains")),
+        ("accept", interaction(guild, b, "accept", against=a)),
+        ("decide", interaction(guild, arbitrator, "decide", victor=a, loser=b)),
+        ("bet", interaction(guild, a, "bet", against=b, arbitrator=arbitrator, amount=50, condition="it snows")),
+        ("reject", interaction(guild, b, "reject", against=a)),
+        ("bet", interaction(guild, a, "bet", against=b, arbitrator=arbitrator, amount=25, condition="it hails")),
+        ("accept", interaction(guild, b, "accept", against=a)),
+        ("cancel", interaction(guild, a, "cancel", against=b)),
+        ("cancel", interaction(guild, b, "cancel", against=a)),
+        ("history", interaction(guild, b, "history", user=user_id(0))),
+    ]
+
+def history_template(lambda_function, dir: str, entries: int):
+    # segments holding entries settled bets, written once per history size and linked into guilds
+    bet = {
+        "p1": user_id(0),
+        "p2": user_id(1),
+        "arbitrator": user_id(2),
+        "amount": 100,
+        "condition": "it rains",
+        "startTime": "2023-08-01T12:00:00",
+        "endTime": "2023-08-02T12:00:00",
+        "p1Won": True,
+        "pending": False,
+        "rejected": False,
+        "p1Cancel": False,
+        "p2Cancel": False,
+    }
+    line = json.dumps(bet) + '\n'
+    per_segment = max(1, lambda_function.HISTORY_SEGMENT_BYTES // len(line))
+    os.makedirs(dir, exist_ok=True)
+    segment = 0
+    while entries > 0:
+        count = min(entries, per_segment)
+        with open(f"{dir}/{lambda_function.segment_name(segment)}", "w", encoding='utf-8') as file:
+            file.write(line * count)
+        entries -= count
+        segment += 1
+    lambda_function.index_history(dir)
+
+def template_stats(entries: int):
+    # (wins, losses, cancelled, net) of the two users in the history template
+    return {
+        user_id(0): (entries, 0, 0, 100 * entries),
+        user_id(1): (0, entries, 0, -100 * entries),
+    }
+
+def guild_fields(lambda_function, users: int, history: int):
+    # everyone has the same balance, so the leaderboard is whoever is kept and the rest sit at the floor
+    kept = min(users, lambda_function.LEADERS_KEPT)
+    return {
+        "leaders": {user_id(i): BALANCE for i in range(kept)},
+        "leadersFloor": BALANCE if users > kept else None,
+        "statsVersion": lambda_function.STATS_VERSION,
+        "settledCount": history,
+    }
+
+def make_guild(lambda_function, binbank, guild: str, users: int, history: int, template: str):
+    now = binbank.to_micros(lambda_function.datetime.datetime.now())
+    stats = template_stats(history)
+    records = [(user_id(i), BALANCE, now, *stats.get(user_id(i), (0, 0, 0, 0))) for i in range(users)]
+    fields = guild_fields(lambda_function, users, history)
+    if lambda_function.STORAGE == "sqlite":
+        make_sqlite_guild(lambda_function, guild, records, template, fields)
+        return
+    path = lambda_function.server_file(guild)
+    if lambda_function.BANK_FORMAT == "binary":
+        data = (binbank.BINARY_VERSION + '\n').encode() + binbank.encode(records, [], [], fields)
+    else:
+        obj = {"users": {record[0]: binbank.user_dict(*record) for record in records},
+               "currentBets": [], "history": [], **fields}
+        data = (lambda_function.VERSION + '\n' + json.dumps(obj)).encode('utf-8')
+    lambda_function.make_dir(os.path.dirname(path))
+    lambda_function.write_file_atomic(path, data)
+    # every segment but the newest is only read, so linking is enough; the newest gets appended to
+    dir = lambda_function.history_dir(guild)
+    os.makedirs(dir, exist_ok=True)
+    segments = lambda_function.history_segments(template)
+    for segment in segments[:-1]:
+        os.link(f"{template}/{segment}", f"{dir}/{segment}")
+    if len(segments) > 0:
+        shutil.copy(f"{template}/{segments[-1]}", f"{dir}/{segments[-1]}")
+        # the index is appended to as well
+        shutil.copytree(f"{template}/index", f"{dir}/index")
+        shutil.copy(f"{template}/indexed", f"{dir}/indexed")
+
+def template_bets(lambda_function, template: str):
+    for segment in lambda_function.history_segments(template):
+        with open(f"{template}/{segment}", encoding='utf-8') as file:
+            for line in file:
+                yield json.loads(line)
+
+def make_sqlite_guild(lambda_function, guild: str, records: list[tuple], template: str, fields: dict):
+    import sqlbank
+    connection = sqlbank.connect(lambda_function.SQLITE_PATH)
+    store = sqlbank.GuildStore(connection, guild)
+    store.begin(immediate=True)
+    store.replace(records, [], template_bets(lambda_function, template), fields)
+    store.commit()
+    connection.close()
+
+def percentile(sorted_values: list[float], fraction: float):
+    # nearest rank
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(samples: list[tuple[float, dict]]):
+    seconds = sorted(sample[0] for sample in samples)
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(seconds, 0.50) * 1000,
+        "p95_ms": percentile(seconds, 0.95) * 1000,
+        "p99_ms": percentile(seconds, 0.99) * 1000,
+        "read_bytes": sum(sample[1].get("readBytes", 0) for sample in samples) / len(samples),
+        # binary snapshots are mapped, and only the pages a command touches are read
+        "mapped_bytes": sum(sample[1].get("mappedBytes", 0) for sample in samples) / len(samples),
+        "written_bytes": sum(sample[1].get("writtenBytes", 0) for sample in samples) / len(samples),
+    }
+
+def replay_cell(lambda_function, binbank, metrics, signing_key, users: int, history: int, template: str,
+                rounds: int, cold: bool, check: bool):
+    replay_cell.count += 1
+    guild = f"guild{replay_cell.count}"
+    make_guild(lambda_function, binbank, guild, users, history, template)
+    lines = []
+    metrics.sink = lines.append
+    samples = {name: [] for name in SUBCOMMANDS}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for r in range(rounds):
+            # three users per round, spread over the guild; small guilds reuse them
+            a, b, arbitrator = (user_id((3 * r + i) % max(users, 3)) for i in range(3))
+            # signed just before they are sent, so the timestamps are always in the window
+            events = [(name, signed_event(signing_key, body)) for name, body in round_of_commands(guild, a, b, arbitrator)]
+            for name, event in events:
+                if cold:
+                    lambda_function.bank_cache.clear()
+                start = time.perf_counter()
+                resp = lambda_function.lambda_handler(event, None)
+                seconds = time.perf_counter() - start
+                content = resp['data']['content']
+                if content.startswith("Error running command") or content.startswith("Failed to parse"):
+                    raise Exception(f"{name} failed: {content}")
+                samples[name].append((seconds, json.loads(lines[-1])))
+        if check:
+            with lambda_function.server(guild) as bank:
+                problems = bank.check_stats()
+            if len(problems) > 0:
+                raise Exception(f"stats of {guild} are inconsistent:\n" + "\n".join(problems))
+    lambda_function.bank_cache.clear()
+    return {name: summarize(values) for name, values in samples.items()}
+replay_cell.count = 0
+
+def cell_name(users: int, history: int, cache: str):
+    return f"users={users} history={history} cache={cache}"
+
+def print_results(results: dict, baseline: dict | None, tolerance: float):
+    regressions = 0
+    for cell, subcommands in results.items():
+        print(cell)
+        print(f"  {'':8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'read B':>11} {'mapped B':>11} {'written B':>10}")
+        for name, stats in subcommands.items():
+            line = f"  {name:8} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} " \
+                   f"{stats['read_bytes']:11.0f} {stats['mapped_bytes']:11.0f} {stats['written_bytes']:10.0f}"
+            before = (baseline or {}).get(cell, {}).get(name)
+            if before is not None:
+                ratio = stats['p95_ms'] / before['p95_ms'] if before['p95_ms'] > 0 else 1.0
+                line += f"   p95 {ratio:5.2f}x baseline"
+                if ratio > 1 + tolerance:
+                    line += " SLOWER"
+                    regressions += 1
+            print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="10,1000,100000", help="comma separated guild sizes")
+    parser.add_argument("--history", default="10,10000,1000000", help="comma separated settled bet counts")
+    parser.add_argument("--rounds", type=int, default=20, help="rounds of commands per guild")
+    parser.add_argument("--cache", choices=["warm", "cold", "both"], default="both")
+    parser.add_argument("--format", choices=["json", "binary"], default="json", help="snapshot format")
+    parser.add_argument("--storage", choices=["files", "sqlite"], default="files", help="storage backend")
+    parser.add_argument("--save", help="write the results to this file as a baseline")
+    parser.add_argument("--compare", help="compare against a baseline saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="p95 slowdown over baseline reported as a regression")
+    parser.add_argument("--check", action="store_true", help="verify stats and the leaderboard after every guild")
+    args = parser.parse_args()
+
+    signing_key, bank_dir = setup()
+    import lambda_function
+    import binbank
+    import metrics
+    metrics.SAMPLE_RATE = 1.0 # every command logs the byte counts read back here
+    lambda_function.BANK_FORMAT = args.format
+    lambda_function.STORAGE = args.storage
+
+    caches = ["warm", "cold"] if args.cache == "both" else [args.cache]
+    results = {}
+    try:
+        for history in [int(size) for size in args.history.split(",")]:
+            template = tempfile.mkdtemp(prefix="betbot-history-")
+            history_template(lambda_function, template, history)
+            for users in [int(size) for size in args.users.split(",")]:
+                for cache in caches:
+                    name = cell_name(users, history, cache)
+                    print(f"running {name}", file=sys.stderr)
+                    results[name] = replay_cell(lambda_function, binbank, metrics, signing_key,
+                                                users, history, template, args.rounds, cache == "cold", args.check)
+            shutil.rmtree(template)
+    finally:
+        shutil.rmtree(bank_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"saved baseline to {args.save}")
+    return 1 if regressions > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
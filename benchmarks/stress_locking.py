@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# multi-process stress test for the per-guild bank lock.
+# every worker process adds 1 to a balance many times through with_bank: first all in one guild
+# (contended), then each in a guild of its own (uncontended). no increment may be lost,
+# and the throughput of both runs is reported
+#   python stress_locking.py [workers] [increments per worker]
+import contextlib
+import io
+import multiprocessing
+import sys
+import time
+from common import setup
+
+def increment(bank):
+    bank.get_user("counter").balance += 1
+
+def worker(args: tuple[str, str, int]):
+    bank_dir, guild, increments = args
+    setup(bank_dir)
+    import lambda_function
+    conflicts = lambda_function.counters['bank_conflicts']
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(increments):
+            lambda_function.with_bank(guild, increment)
+    return lambda_function.counters['bank_conflicts'] - conflicts
+
+def run(pool, bank_dir: str, guilds: list[str], increments: int):
+    start = time.perf_counter()
+    conflicts = sum(pool.map(worker, [(bank_dir, guild, increments) for guild in guilds]))
+    return time.perf_counter() - start, conflicts
+
+def main(workers: int, increments: int):
+    _, bank_dir = setup()
+    import lambda_function
+    failed = False
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        for name, guilds in [("one guild", ["shared"] * workers),
+                             ("own guilds", [f"guild{i}" for i in range(workers)])]:
+            seconds, conflicts = run(pool, bank_dir, guilds, increments)
+            with contextlib.redirect_stdout(io.StringIO()):
+                lambda_function.bank_cache.clear()
+                balances = {}
+                for guild in set(guilds):
+                    with lambda_function.server(guild) as bank:
+                        balances[guild] = bank.get_user("counter").balance
+            expected = {guild: guilds.count(guild) * increments for guild in guilds}
+            ok = balances == expected
+            failed = failed or not ok
+            total = workers * increments
+            print(f"{name:10} {total} increments in {seconds:.2f}s, {total / seconds:7.0f}/s, "
+                  f"{conflicts} optimistic conflicts, {'no updates lost' if ok else f'LOST UPDATES {balances} != {expected}'}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(*(args + [8, 200][len(args):])))
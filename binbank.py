@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# compact binary bank format
+#
+# a JSON bank has to be parsed in full before a single user can be read. this format keeps
+# fixed-width records behind an offset table, so one user (by binary search) or the open bets
+# can be read straight out of an mmap without decoding the rest of the file.
+#
+# layout after the version line, integers little-endian, offsets from the start of the file:
+#   header    string, user, bet and history counts, then the offsets of each section below
+#   strings   (count + 1) u32 offsets into the string data, then the utf-8 data.
+#             every user id in the bank is stored once, sorted, and referred to by index
+#   users     fixed-width (id index, balance, last paycheck, wins, losses, cancelled, net)
+#             records, sorted by id
+#   bets      fixed-width bet records, each followed by its condition text
+#   history   same as bets
+#   extra     the rest of the bank's fields (e.g. the leaderboard) as JSON, to the end of the file
+# timestamps are microseconds since 1970-01-01, naive like the datetimes in Bank.
+# "b1" files have no extra section and their user records stop after the last paycheck;
+# they are still read, with zeroes for the rest
+#
+# to convert snapshots between formats, use migrate_banks.py --format, which holds each guild's
+# lock and folds in its journal
+import datetime
+import json
+import struct
+
+BINARY_VERSION = "b2"
+BINARY_VERSIONS = ("b1", "b2") # every version read_snapshot can open
+
+HEADER = struct.Struct("<IIIIQQQQQQ")
+HEADER_B1 = struct.Struct("<IIIIQQQQQ")
+OFFSET = struct.Struct("<I")
+USER = struct.Struct("<IqqIIIq")
+USER_B1 = struct.Struct("<Iqq")
+BET = struct.Struct("<IIIqqqBI")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Bet flags
+P1_WON = 1
+PENDING = 2
+REJECTED = 4
+P1_CANCEL = 8
+P2_CANCEL = 16
+
+def to_micros(dt: datetime.datetime):
+    if dt.tzinfo is not None:
+        raise ValueError(f"binary banks only store naive timestamps, got {dt}")
+    return (dt - EPOCH) // MICROSECOND
+
+def from_micros(micros: int):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+def iso_to_micros(s: str):
+    return to_micros(datetime.datetime.fromisoformat(s))
+
+def micros_to_iso(micros: int):
+    return from_micros(micros).isoformat()
+
+def user_dict(id: str, balance: int, last_paycheck: int, wins: int = 0, losses: int = 0, cancelled: int = 0, net: int = 0):
+    return {"id": id, "balance": balance, "lastPaycheck": micros_to_iso(last_paycheck),
+            "wins": wins, "losses": losses, "cancelled": cancelled, "net": net}
+
+def bet_flags(p1_won: bool, pending: bool, rejected: bool, p1_cancel: bool, p2_cancel: bool):
+    return (P1_WON if p1_won else 0) | (PENDING if pending else 0) | (REJECTED if rejected else 0) | \
+           (P1_CANCEL if p1_cancel else 0) | (P2_CANCEL if p2_cancel else 0)
+
+def json_flags(bet: dict):
+    return bet_flags(bet['p1Won'], bet['pending'], bet['rejected'], bet['p1Cancel'], bet['p2Cancel'])
+
+def bet_dict(p1: str, p2: str, arbitrator: str, amount: int, condition: str, start_time: int, end_time: int, flags: int):
+    # a bet in its JSON form, from micros and flags
+    return {
+        "p1": p1,
+        "p2": p2,
+        "arbitrator": arbitrator,
+        "amount": amount,
+        "condition": condition,
+        "startTime": micros_to_iso(start_time),
+        "endTime": micros_to_iso(end_time),
+        "p1Won": flags & P1_WON != 0,
+        "pending": flags & PENDING != 0,
+        "rejected": flags & REJECTED != 0,
+        "p1Cancel": flags & P1_CANCEL != 0,
+        "p2Cancel": flags & P2_CANCEL != 0,
+    }
+
+def encode(users: list[tuple], current_bets: list[dict], history: list[dict], extra: dict):
+    # users are (id, balance, last paycheck in micros, wins, losses, cancelled, net);
+    # bets are in their JSON form
+    ids = {user[0] for user in users}
+    for bet in current_bets + history:
+        ids.update((bet['p1'], bet['p2'], bet['arbitrator']))
+    strings = sorted((id.encode('utf-8') for id in ids))
+    index = {s.decode('utf-8'): i for i, s in enumerate(strings)}
+
+    string_offsets = bytearray()
+    position = 0
+    for s in strings:
+        string_offsets += OFFSET.pack(position)
+        position += len(s)
+    string_offsets += OFFSET.pack(position)
+    string_data = b"".join(strings)
+
+    user_data = bytearray()
+    for id, *fields in sorted(users, key=lambda user: index[user[0]]):
+        user_data += USER.pack(index[id], *fields)
+
+    def encode_bets(bets: list[dict]):
+        data = bytearray()
+        for bet in bets:
+            condition = bet['condition'].encode('utf-8')
+            data += BET.pack(index[bet['p1']], index[bet['p2']], index[bet['arbitrator']], bet['amount'],
+                             iso_to_micros(bet['startTime']), iso_to_micros(bet['endTime']),
+                             json_flags(bet), len(condition))
+            data += condition
+        return data
+    bet_data = encode_bets(current_bets)
+    history_data = encode_bets(history)
+    extra_data = json.dumps(extra).encode('utf-8')
+
+    # offsets are from the start of the file, which begins with the version line
+    start = len(BINARY_VERSION) + 1 + HEADER.size
+    offsets = [start]
+    for section in (string_offsets, string_data, user_data, bet_data, history_data):
+        offsets.append(offsets[-1] + len(section))
+    header = HEADER.pack(len(strings), len(users), len(current_bets), len(history), *offsets)
+    return b"".join((header, string_offsets, string_data, user_data, bet_data, history_data, extra_data))
+
+class BinaryBank:
+    # reads a binary bank in place. buffer is usually an mmap of the whole file, start is
+    # the offset just past the version line and version is what that line says
+    def __init__(self, buffer, start: int, version: str = BINARY_VERSION):
+        self.buffer = buffer
+        if version == "b1":
+            (self.string_count, self.user_count, self.bet_count, self.history_count,
+             self.string_offsets_at, self.strings_at, self.users_at, self.bets_at,
+             self.history_at) = HEADER_B1.unpack_from(buffer, start)
+            self.extra_at = None
+            self.user_struct = USER_B1
+        else:
+            (self.string_count, self.user_count, self.bet_count, self.history_count,
+             self.string_offsets_at, self.strings_at, self.users_at, self.bets_at,
+             self.history_at, self.extra_at) = HEADER.unpack_from(buffer, start)
+            self.user_struct = USER
+
+    def user_record(self, id: str, fields: tuple):
+        # (id, balance, last paycheck, wins, losses, cancelled, net) whatever the version
+        if self.user_struct is USER_B1:
+            return (id, *fields, 0, 0, 0, 0)
+        return (id, *fields)
+
+    def string_bytes(self, i: int):
+        begin, end = struct.unpack_from("<II", self.buffer, self.string_offsets_at + i * OFFSET.size)
+        return self.buffer[self.strings_at + begin:self.strings_at + end]
+
+    def string(self, i: int):
+        return bytes(self.string_bytes(i)).decode('utf-8')
+
+    def find_string(self, s: str):
+        target = s.encode('utf-8')
+        low, high = 0, self.string_count
+        while low < high:
+            mid = (low + high) // 2
+            if self.string_bytes(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.string_count and self.string_bytes(low) == target:
+            return low
+        return None
+
+    def find_user(self, id: str):
+        # (id, balance, last paycheck in micros, wins, losses, cancelled, net),
+        # or None if the bank has no such user
+        i = self.find_string(id)
+        if i is None:
+            return None
+        user = self.user_struct
+        low, high = 0, self.user_count
+        while low < high:
+            mid = (low + high) // 2
+            if user.unpack_from(self.buffer, self.users_at + mid * user.size)[0] < i:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.user_count:
+            index, *fields = user.unpack_from(self.buffer, self.users_at + low * user.size)
+            if index == i:
+                return self.user_record(id, fields)
+        return None
+
+    def user_records(self):
+        end = self.users_at + self.user_count * self.user_struct.size
+        for index, *fields in self.user_struct.iter_unpack(self.buffer[self.users_at:end]):
+            yield self.user_record(self.string(index), fields)
+
+    def read_bets(self, at: int, count: int):
+        bets = []
+        for _ in range(count):
+            p1, p2, arbitrator, amount, start_time, end_time, flags, length = BET.unpack_from(self.buffer, at)
+            at += BET.size
+            condition = bytes(self.buffer[at:at + length]).decode('utf-8')
+            at += length
+            bets.append(bet_dict(self.string(p1), self.string(p2), self.string(arbitrator), amount, condition,
+                                 start_time, end_time, flags))
+        return bets
+
+    def current_bets(self):
+        return self.read_bets(self.bets_at, self.bet_count)
+
+    def history(self):
+        return self.read_bets(self.history_at, self.history_count)
+
+    def extra(self):
+        if self.extra_at is None:
+            return {}
+        return json.loads(bytes(self.buffer[self.extra_at:]).decode('utf-8'))
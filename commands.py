@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# the /bb command, declared once.
+# publish_commands.py sends command_json() to Discord, and lambda_function dispatches through
+# parse(), which checks an interaction's options against the same declarations before any
+# bank is opened. to add a subcommand, add it to SUBCOMMANDS and write its Bank method:
+# the method gets the calling User, then each option's value in the order declared here
+from dataclasses import dataclass, field
+
+# option types, see https://discord.com/developers/docs/interactions/application-commands
+SUB_COMMAND = 1
+STRING = 3
+INTEGER = 4
+USER = 6
+
+# what each option type's value arrives as. user options carry the user's id
+VALUE_TYPES = {
+    STRING: str,
+    INTEGER: int,
+    USER: str,
+}
+TYPE_NAMES = {
+    STRING: "text",
+    INTEGER: "a whole number",
+    USER: "a user",
+}
+
+@dataclass
+class Option:
+    name: str
+    type: int
+    description: str
+    required: bool = True
+
+@dataclass
+class Subcommand:
+    name: str
+    description: str
+    handler: str # name of the Bank method that runs it
+    options: list[Option] = field(default_factory=list)
+    # leaves the bank as it was, so a redelivered interaction can simply run it again
+    read_only: bool = False
+
+COMMAND_NAME = "bb"
+COMMAND_DESCRIPTION = "Place bets, decide the winner"
+
+SUBCOMMANDS = [
+    Subcommand("bank", "Check your bank, and receive money once daily", "cmd_bank"),
+    Subcommand("bet", "Place a bet against another user", "cmd_make_bet", [
+        Option("against", USER, "The user you are betting against"),
+        Option("arbitrator", USER, "The user who decides the winner"),
+        Option("amount", INTEGER, "The amount you are betting"),
+        Option("condition", STRING, "Better wins if:"),
+    ]),
+    Subcommand("accept", "Accept a bet against a user", "cmd_accept_bet", [
+        Option("against", USER, "The user who placed a bet on you"),
+    ]),
+    Subcommand("reject", "Reject a bet against a user", "cmd_reject_bet", [
+        Option("against", USER, "The user who placed a bet on you"),
+    ]),
+    Subcommand("decide", "Decide a bet between users, if you are the arbitrator", "cmd_decide_bet", [
+        Option("victor", USER, "The user who should win the bet"),
+        Option("loser", USER, "The user who should lose the bet"),
+    ]),
+    Subcommand("pending", "List the bets you are the arbitrator for", "cmd_pending", read_only=True),
+    Subcommand("leaderboard", "Show the richest users", "cmd_leaderboard", read_only=True),
+    Subcommand("stats", "Show a user's balance and betting record", "cmd_stats", [
+        Option("user", USER, "The user to show, yourself if left out", required=False),
+    ], read_only=True),
+    Subcommand("history", "List a user's settled bets, newest first", "cmd_history", [
+        Option("user", USER, "The user to show, yourself if left out", required=False),
+        Option("page", INTEGER, "The page to show, 1 for the newest bets", required=False),
+    ], read_only=True),
+    Subcommand("cancel", "Cancel a bet with another user. Requires consent from other user", "cmd_cancel_bet", [
+        Option("against", USER, "The user you want to cancel your bet with"),
+    ]),
+]
+
+class CommandError(Exception):
+    pass
+
+def compile_dispatch(subcommands: list[Subcommand]):
+    # subcommand name -> (subcommand, option name -> position in the handler's arguments)
+    return {
+        subcommand.name: (subcommand, {option.name: i for i, option in enumerate(subcommand.options)})
+        for subcommand in subcommands
+    }
+
+DISPATCH = compile_dispatch(SUBCOMMANDS)
+
+def parse(data: dict):
+    # the subcommand an interaction's data asks for and its option values in declared order,
+    # or CommandError saying what is wrong with them
+    command = data.get('name')
+    options = data.get('options') or []
+    if command != COMMAND_NAME or len(options) == 0:
+        raise CommandError(f"Unknown command or no arguments given: {command}")
+    name = options[0].get('name')
+    entry = DISPATCH.get(name)
+    if entry is None:
+        raise CommandError(f"Got unknown option: {name}")
+    subcommand, positions = entry
+
+    values = [None] * len(subcommand.options)
+    for option in options[0].get('options') or []:
+        position = positions.get(option.get('name'))
+        if position is None:
+            raise CommandError(f"Got unknown option for {name}: {option.get('name')}")
+        declared = subcommand.options[position]
+        value = option.get('value')
+        # bool is an int to isinstance, but never a valid option value
+        if not isinstance(value, VALUE_TYPES[declared.type]) or isinstance(value, bool):
+            raise CommandError(f"Option {declared.name} for {name} should be {TYPE_NAMES[declared.type]}, got: {value}")
+        values[position] = value
+    for declared, value in zip(subcommand.options, values):
+        if declared.required and value is None:
+            raise CommandError(f"Missing option {declared.name} for {name}")
+    return subcommand, values
+
+def option_json(option: Option):
+    return {
+        "name": option.name,
+        "description": option.description,
+        "type": option.type,
+        "required": option.required,
+    }
+
+def subcommand_json(subcommand: Subcommand):
+    obj = {
+        "name": subcommand.name,
+        "description": subcommand.description,
+        "type": SUB_COMMAND,
+        "required": False,
+    }
+    if len(subcommand.options) > 0:
+        obj["options"] = [option_json(option) for option in subcommand.options]
+    return obj
+
+def command_json():
+    # a CHAT_INPUT (slash) command, which is type 1
+    return {
+        "name": COMMAND_NAME,
+        "type": 1,
+        "description": COMMAND_DESCRIPTION,
+        "options": [subcommand_json(subcommand) for subcommand in SUBCOMMANDS],
+    }
@@ -1,18 +1,30 @@
 from __future__ import annotations
 import datetime
-import pytz
-from typing import cast
+from zoneinfo import ZoneInfo
+from typing import TYPE_CHECKING
 from contextlib import contextmanager
-from io import SEEK_SET, TextIOWrapper
-from typing import Dict
+from io import SEEK_SET
+from typing import BinaryIO, Dict
 from public_key import PUBLIC_KEY, BANK_DIR, VERSION, VERSION_MAX_LENGTH, TIMEZONE
-from dataclasses import dataclass
-from dataclass_wizard import JSONWizard
+import public_key
+from dataclasses import dataclass, field
+from collections import OrderedDict
 import json
-import humanize
-
-from nacl.signing import VerifyKey
 import os
+import time
+import mmap
+import fcntl
+import struct
+import heapq
+import hashlib
+import binbank
+import commands
+import metrics
+# humanize, nacl and sqlbank are imported where they are first used: every import here is paid on each
+# cold start, whether or not the command needs it. see profile_startup.py
+if TYPE_CHECKING:
+    from nacl.signing import VerifyKey
+    import sqlbank
 
 PING_PONG = {"type": 1}
 RESPONSE_TYPES =  { 
@@ -24,16 +36,101 @@ RESPONSE_TYPES =  {
                   }
 PAYCHECK = 1000
 PAYCHECK_FREQUENCY = datetime.timedelta(days=1)
+# days after which a bet nobody accepted, or an accepted bet nobody decided, is cancelled and
+# refunded, counted from when it was placed or accepted. None keeps them open forever
+PENDING_BET_EXPIRY_DAYS: float | None = getattr(public_key, "PENDING_BET_EXPIRY_DAYS", None)
+UNDECIDED_BET_EXPIRY_DAYS: float | None = getattr(public_key, "UNDECIDED_BET_EXPIRY_DAYS", None)
+# append one mutation record per command instead of rewriting the whole bank
+JOURNAL = getattr(public_key, "JOURNAL", True)
+JOURNAL_COMPACT_ENTRIES = 64 # fold the journal back into a fresh snapshot after this many records
+# format snapshots are written in, "json" or "binary"; both are always readable.
+# None keeps each guild in the format its snapshot already has, JSON for new guilds
+BANK_FORMAT: str | None = getattr(public_key, "BANK_FORMAT", None)
+BANK_CACHE_ENTRIES = 32 # banks kept parsed between invocations of a warm container
+BANK_CACHE_BYTES = 64 * 1024 * 1024 # approximate memory budget for the cache, measured by on-disk size
+HISTORY_SEGMENT_BYTES = 1024 * 1024 # start a new history segment once the newest one reaches this size
+SIGNATURE_TOLERANCE = 5 * 60 # seconds a request's signed timestamp may be away from our clock
+# seconds an interaction's token can be used for follow-ups, so a deferred command can still be answered
+INTERACTION_TOKEN_SECONDS = 15 * 60
+SEEN_SIGNATURES_MAX = 10000 # recently verified signatures remembered to reject replays
+RESPONSES_CACHED = 1000 # responses to recent interactions kept in memory, to answer redeliveries
+RESPONSE_TTL = 15 * 60 # seconds a response is kept on disk for redeliveries; interaction tokens last this long
+OPTIMISTIC_RETRIES = 3 # optimistic attempts at a command before holding the guild lock throughout
+GENERATION_WIDTH = 20 # digits of the write counter kept in each guild's lock file
+# seconds of expected work above which a command is acknowledged first and answered by a
+# follow-up message (Discord allows 3s). None answers everything directly
+DEFER_BUDGET: float | None = getattr(public_key, "DEFER_BUDGET", None)
+LOAD_BYTES_PER_SECOND = 16 * 1024 * 1024 # rough cost of reading an uncached bank, for DEFER_BUDGET
+COLD_SECONDS_TRACKED = 1024 # guilds whose uncached command times are remembered
+DISCORD_API = getattr(public_key, "DISCORD_API", "https://discord.com/api/v10")
+# SQS queue deferred commands are sent to, for batch_handler to run them a guild at a time.
+# None runs each one in its own invocation instead
+BATCH_QUEUE_URL: str | None = getattr(public_key, "BATCH_QUEUE_URL", None)
+LEADERBOARD_SIZE = 10 # users shown by /bb leaderboard
+LEADERS_KEPT = 50 # richest users tracked, so falling leaders can be replaced without a full scan
+STATS_VERSION = 2 # banks on an older one have their stats, settled count and leaderboard rebuilt from history when loaded
+HISTORY_PAGE_SIZE = 10 # settled bets per page of /bb history
+MESSAGE_LIMIT = 2000 # characters Discord allows in a message
+# "files" for a snapshot per guild in BANK_DIR, "sqlite" for one database written from a
+# single host (see sqlbank.py), "resident" for files kept in memory by local_server.py
+STORAGE = getattr(public_key, "STORAGE", "files")
+SQLITE_PATH = getattr(public_key, "SQLITE_PATH", f"{BANK_DIR}/banks.sqlite3")
+SHARD_LEVELS = 2 # directories between BANK_DIR and a guild's files
+SHARD_WIDTH = 2 # hex digits of the guild's hash naming each of them, so 256 per level
+# whether guilds are also looked for directly in BANK_DIR, where they were kept before shards.
+# set it to False once move_banks.py has moved every guild, to save the lookups
+FLAT_LAYOUT_FALLBACK = getattr(public_key, "FLAT_LAYOUT_FALLBACK", True)
+FOLLOWUP_TIMEOUT = 5 # seconds
 #PUBLIC_KEY = '' # found on Discord Application -> General Information page
 
-def verify_signature(event):
+# built on first use and kept for the life of the container
+verify_key: VerifyKey | None = None
+# signature -> time after which its timestamp is too old to pass anyway, oldest first
+seen_signatures: OrderedDict[str, float] = OrderedDict()
+# interaction id -> (time it expires, response given to it), least recently used first
+recent_responses: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+class ReplayedSignature(Exception):
+    pass
+
+def get_verify_key():
+    global verify_key
+    if verify_key is None:
+        from nacl.signing import VerifyKey
+        verify_key = VerifyKey(bytes.fromhex(PUBLIC_KEY))
+    return verify_key
+
+def verify_signature(event, check_replay: bool = True, tolerance: float = SIGNATURE_TOLERANCE):
     raw_body = event.get("rawBody")
     auth_sig = event['params']['header'].get('x-signature-ed25519')
     auth_ts  = event['params']['header'].get('x-signature-timestamp')
-    
+
+    # cheap checks first, so stale or replayed requests cost nothing
+    now = time.time()
+    if abs(now - float(auth_ts)) > tolerance:
+        raise Exception(f"timestamp {auth_ts} is outside the {tolerance}s window")
+    while len(seen_signatures) > 0 and next(iter(seen_signatures.values())) < now:
+        seen_signatures.popitem(last=False)
+    if check_replay and auth_sig in seen_signatures:
+        raise ReplayedSignature("signature has already been used")
+
     message = auth_ts.encode() + raw_body.encode()
-    verify_key = VerifyKey(bytes.fromhex(PUBLIC_KEY))
-    verify_key.verify(message, bytes.fromhex(auth_sig)) # raises an error if unequal
+    get_verify_key().verify(message, bytes.fromhex(auth_sig)) # raises an error if unequal
+
+    # only remember signatures that verified, so forged ones can't crowd out real ones
+    seen_signatures[auth_sig] = float(auth_ts) + SIGNATURE_TOLERANCE
+    if len(seen_signatures) > SEEN_SIGNATURES_MAX:
+        seen_signatures.popitem(last=False)
+
+def verify_interaction(event, check_replay: bool = True, tolerance: float = SIGNATURE_TOLERANCE):
+    # verify_signature, returning whether the request is a replay of one this container already
+    # verified. a replay is checked to be genuine too, and may only get a stored response back
+    try:
+        verify_signature(event, check_replay, tolerance)
+        return False
+    except ReplayedSignature:
+        verify_signature(event, check_replay=False, tolerance=tolerance)
+        return True
 
 def ping_pong(body):
     if body.get("type") == 1:
@@ -42,12 +139,34 @@ def ping_pong(body):
 
 
 def lambda_handler(event, _):
-    print(f"event {event}") # debug print
+    metrics.start()
+    try:
+        return handle_event(event)
+    finally:
+        metrics.emit()
+
+def handle_event(event):
+    if metrics.LOG_EVENTS:
+        print(f"event {event}")
+    if 'deferred' in event:
+        metrics.tag("deferred", "true")
+        return finish_deferred(event['deferred'])
+
     # verify the signature
     try:
-        verify_signature(event)
+        with metrics.phase("verify"):
+            replayed = verify_interaction(event)
     except Exception as e:
         raise Exception(f"[UNAUTHORIZED] Invalid request signature: {e}")
+    body = event.get('body-json')
+
+    # a redelivered interaction gets the response it got the first time, without touching the bank
+    stored = stored_response(body)
+    if stored is not None:
+        metrics.dimension("Command", "duplicate")
+        return stored
+    if replayed:
+        raise Exception("[UNAUTHORIZED] Invalid request signature: signature has already been used")
 
     resp = {
         "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
@@ -60,276 +179,1084 @@ def lambda_handler(event, _):
     };
 
     # check if message is a ping
-    body = event.get('body-json')
     if ping_pong(body):
+        metrics.dimension("Command", "ping")
         resp = PING_PONG
+    elif DEFER_BUDGET is not None and expected_seconds(body.get('guild_id')) > DEFER_BUDGET:
+        # too slow to answer inside Discord's deadline: acknowledge now, and edit in the
+        # result from another invocation once the command has run
+        metrics.dimension("Command", "acknowledge")
+        resp = {"type": RESPONSE_TYPES['ACK_WITH_SOURCE']}
+        # stored before the command can run, so a redelivery doesn't run it a second time; the
+        # result takes its place once it's in. without the guild's lock, which a slow command
+        # could hold past Discord's deadline
+        store_response(body, resp, locked=False)
+        deferred_invoker(event)
     else:
-        command = "No command"
-        options = "No options"
+        resp = handle_command(body)
+
+    if metrics.LOG_EVENTS:
+        print(f"response {resp}")
+    return resp;
+
+def handle_command(body: dict):
+    command = "No command"
+    options = "No options"
+    start = time.perf_counter()
+    # a retried deferred invocation, or a redelivery, gets what the command answered already
+    stored = stored_response(body)
+    if stored is not None and not is_acknowledgement(stored):
+        metrics.dimension("Command", "duplicate")
+        return stored
+    try:
+        # open server
+        server_id = body.get('guild_id')
+        cold = server_id not in bank_cache
+        command = body.get('data').get('name')
+        options = body.get('data').get('options')
+        metrics.tag("guild", server_id)
+        try:
+            subcommand, values = commands.parse(body.get('data'))
+        except commands.CommandError as e:
+            # malformed commands never get as far as loading the bank
+            metrics.dimension("Command", "invalid")
+            return message_response(f"Failed to parse command. {e}")
+        metrics.dimension("Command", subcommand.name)
+        resp = with_bank(server_id, lambda bank: run_command(bank, body, subcommand, values))
+        if not subcommand.read_only:
+            store_response(body, resp)
+        if cold:
+            record_cold_seconds(server_id, time.perf_counter() - start)
+    except Exception as e:
+        resp = command_error_response(command, options, e)
+    return resp
+
+def command_error_response(command, options, e: Exception):
+    return message_response(f"Error running command.\nCommand: {command}\nOptions: {options}\nError: {e}")
+
+# guild id -> smoothed seconds a command took when the bank wasn't cached, oldest first
+cold_seconds: OrderedDict[str, float] = OrderedDict()
+
+def record_cold_seconds(server_id: str, seconds: float):
+    previous = cold_seconds.pop(server_id, seconds)
+    cold_seconds[server_id] = 0.5 * previous + 0.5 * seconds
+    if len(cold_seconds) > COLD_SECONDS_TRACKED:
+        cold_seconds.popitem(last=False)
+
+def expected_seconds(server_id: str):
+    # a cached bank is cheap. otherwise go by how long this guild took last time,
+    # or failing that by how much there is to read
+    if server_id in bank_cache:
+        return 0.0
+    if server_id in cold_seconds:
+        return cold_seconds[server_id]
+    stamp = bank_stamp(server_id, 0)
+    return sum(stat[2] for stat in stamp[1:] if stat is not None) / LOAD_BYTES_PER_SECOND
+
+def stored_response(body: dict):
+    # what was answered to this interaction, if it was handled in the last RESPONSE_TTL seconds:
+    # from memory, or from the guild's file if another container handled it
+    id = body.get('id')
+    if id is None:
+        return None
+    # taken out and put back at the end as single operations, so local_server.py's threads
+    # can share the cache
+    entry = recent_responses.pop(id, None)
+    if entry is not None:
+        recent_responses[id] = entry
+    elif body.get('guild_id') is not None:
+        entry = read_stored_response(body.get('guild_id'), id)
+        if entry is not None:
+            remember_response(id, entry)
+    if entry is None or entry[0] < time.time():
+        return None
+    return entry[1]
+
+def remember_response(id: str, entry: tuple[float, dict]):
+    previous = recent_responses.pop(id, None)
+    if previous is not None and is_acknowledgement(entry[1]) and not is_acknowledgement(previous[1]):
+        # the command already answered
+        entry = previous
+    recent_responses[id] = entry
+    if len(recent_responses) > RESPONSES_CACHED:
+        recent_responses.popitem(last=False)
+
+def response_window(now: float):
+    # responses go in a file per RESPONSE_TTL seconds, so one that hasn't expired is in the
+    # current window or the one before, and older windows can be removed whole
+    return int(now // RESPONSE_TTL)
+
+def read_stored_response(server_id: str, id: str):
+    # only lines for this interaction are parsed. a command's result is the answer over its
+    # acknowledgement, whichever was written last
+    prefix = json.dumps({"id": id})[:-1] + ", "
+    window = response_window(time.time())
+    found = None
+    for number in (window - 1, window):
+        try:
+            file = open(f"{responses_dir(server_id)}/{number}", "r", encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with file:
+            for line in file:
+                if not line.startswith(prefix):
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    # an append still in progress
+                    continue
+                if found is None or is_acknowledgement(found[1]):
+                    found = (obj['expires'], obj['response'])
+    return found
+
+def is_acknowledgement(resp: dict):
+    return resp.get('type') == RESPONSE_TYPES['ACK_WITH_SOURCE']
+
+def store_response(body: dict, resp: dict, locked: bool = True):
+    store_responses(body.get('guild_id'), [(body, resp)], locked)
+
+def store_responses(server_id: str, answered: list[tuple[dict, dict]], locked: bool = True):
+    # kept for redeliveries of the interactions. this comes after the bank is written, so a crash
+    # in between can still let a redelivery run a command again. all the lines go in one append,
+    # under the guild's lock unless locked is False, so they don't interleave with other containers'
+    now = time.time()
+    lines = []
+    for body, resp in answered:
+        if body.get('id') is None:
+            continue
+        entry = (now + RESPONSE_TTL, resp)
+        remember_response(body.get('id'), entry)
+        lines.append(json.dumps({"id": body.get('id'), "expires": entry[0], "response": resp}) + '\n')
+    if server_id is None or len(lines) == 0:
+        return
+    lock = open_guild_lock(server_id, fcntl.LOCK_EX) if locked else None
+    try:
+        dir = responses_dir(server_id)
+        window = response_window(now)
+        while True:
+            make_dir(dir)
+            try:
+                file = os.open(f"{dir}/{window}", os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+                created = True
+            except FileExistsError:
+                file = os.open(f"{dir}/{window}", os.O_WRONLY | os.O_APPEND)
+                created = False
+            except FileNotFoundError:
+                # the directory was removed since it was made
+                made_dirs.discard(dir)
+                continue
+            break
         try:
-            # open server
-            server_id = body.get('guild_id')
-            with server(server_id) as bank:
-                # get user
-                user_id = body.get('member').get('user').get('id')
-                user = bank.get_user(user_id)
-
-                # parse command
-                command = body.get('data').get('name')
-                options = body.get('data').get('options')
-                if len(options) > 0 and command == "bb":
-                    option = options[0].get('name')
-                    if option == "bank":
-                        paycheck_message = ""
-                        time_diff = user.last_paycheck - get_prev_midnight()
-                        if time_diff < datetime.timedelta(0):
-                            user.balance += PAYCHECK
-                            user.last_paycheck = datetime.datetime.now()
-                            paycheck_message = f"Added daily paycheck: +${PAYCHECK}"
-                        else:
-                            paycheck_message = f"{humanize.precisedelta(get_next_midnight() - datetime.datetime.now(), format='%0.f')} until next paycheck"
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": f"Balance: ${user.balance}\n{paycheck_message}",
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    elif option == "bet":
-                        against = None
-                        arbitrator = None
-                        amount = None
-                        condition = None
-                        options = options[0].get('options')
-                        for option in options:
-                            option_name = option.get('name')
-                            match option_name:
-                                case 'against':
-                                    against = option.get('value')
-                                case 'arbitrator':
-                                    arbitrator = option.get('value')
-                                case 'amount':
-                                    amount = option.get('value')
-                                case 'condition':
-                                    condition = option.get('value')
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": bank.cmd_make_bet(user, against, arbitrator, amount, condition),
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    elif option == "accept":
-                        against = None
-                        options = options[0].get('options')
-                        for option in options:
-                            option_name = option.get('name')
-                            match option_name:
-                                case 'against':
-                                    against = option.get('value')
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": bank.cmd_accept_bet(user, against),
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    elif option == "reject":
-                        against = None
-                        options = options[0].get('options')
-                        for option in options:
-                            option_name = option.get('name')
-                            match option_name:
-                                case 'against':
-                                    against = option.get('value')
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": bank.cmd_reject_bet(user, against),
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    elif option == "decide":
-                        victor = None
-                        loser = None
-                        options = options[0].get('options')
-                        for option in options:
-                            option_name = option.get('name')
-                            match option_name:
-                                case 'victor':
-                                    victor = option.get('value')
-                                case 'loser':
-                                    loser = option.get('value')
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": bank.cmd_decide_bet(user, victor, loser),
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    elif option == "cancel":
-                        against = None
-                        options = options[0].get('options')
-                        for option in options:
-                            option_name = option.get('name')
-                            match option_name:
-                                case 'against':
-                                    against = option.get('value')
-
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": bank.cmd_cancel_bet(user, against),
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                    else:
-                        resp = {
-                            "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                            "data": {
-                                "tts": False,
-                                "content": f"Failed to parse command. Got unknown option: {option}",
-                                "embeds": [],
-                                "allowed_mentions": []
-                            }
-                        };
-                else:
-                    # wrong command or no arguments
-                    resp = {
-                        "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                        "data": {
-                            "tts": False,
-                            "content": f"Failed to parse command. Unknown command or no arguments given: {command}",
-                            "embeds": [],
-                            "allowed_mentions": []
-                        }
-                    };
+            os.write(file, "".join(lines).encode('utf-8'))
+        finally:
+            os.close(file)
+        if created:
+            # whoever starts a window removes the ones nothing reads any more
+            for name in os.listdir(dir):
+                if name.isdigit() and int(name) < window - 1:
+                    try:
+                        os.remove(f"{dir}/{name}")
+                    except FileNotFoundError:
+                        pass
+            # the single file responses were kept in before windows
+            if os.path.isfile(f"{server_file(server_id)}.responses"):
+                os.remove(f"{server_file(server_id)}.responses")
+    finally:
+        if lock is not None:
+            os.close(lock)
+
+# built on first use and kept for the life of the container
+lambda_client = None
+http_pool = None
+
+def invoke_self(event):
+    # the deferred half runs as an asynchronous invocation of this same function.
+    # the function's role needs lambda:InvokeFunction on itself
+    global lambda_client
+    if lambda_client is None:
+        import boto3
+        lambda_client = boto3.client('lambda')
+    lambda_client.invoke(FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+                         InvocationType='Event',
+                         Payload=json.dumps({"deferred": event}).encode())
+
+# built on first use and kept for the life of the container
+sqs_client = None
+
+def send_to_queue(event):
+    # the queue's messages are read by batch_handler. the function's role needs sqs:SendMessage on it
+    global sqs_client
+    if sqs_client is None:
+        import boto3
+        sqs_client = boto3.client('sqs')
+    sqs_client.send_message(QueueUrl=BATCH_QUEUE_URL, MessageBody=json.dumps({"deferred": event}))
+
+# how a deferred event gets run later; swap this out to run them some other way
+deferred_invoker = invoke_self if BATCH_QUEUE_URL is None else send_to_queue
+
+def finish_deferred(event):
+    # the request was acknowledged by an earlier invocation that already saw this signature,
+    # so only the signature itself is checked, and its age against how long the token lasts:
+    # a retried or delayed invocation is still answered. once acknowledged, the user always
+    # gets a follow-up, if only with the error
+    body = event.get('body-json')
+    try:
+        with metrics.phase("verify"):
+            verify_signature(event, check_replay=False, tolerance=INTERACTION_TOKEN_SECONDS)
+    except Exception as e:
+        error = f"[UNAUTHORIZED] Invalid request signature: {e}"
+        try:
+            send_followup(body, message_response(f"Couldn't run this command. {error}"))
+        except Exception as followup_error:
+            print(f"Follow-up failed: {followup_error}")
+        raise Exception(error)
+    resp = handle_command(body)
+    send_followup(body, resp)
+    return resp
+
+def send_followup(body: dict, resp: dict):
+    # replaces the "thinking..." message Discord shows for an ACK_WITH_SOURCE
+    global http_pool
+    if http_pool is None:
+        import urllib3
+        http_pool = urllib3.PoolManager()
+    url = f"{DISCORD_API}/webhooks/{body.get('application_id')}/{body.get('token')}/messages/@original"
+    r = http_pool.request("PATCH", url,
+                          body=json.dumps(resp['data']).encode(),
+                          headers={"Content-Type": "application/json"},
+                          timeout=FOLLOWUP_TIMEOUT)
+    if metrics.LOG_EVENTS:
+        print(f"followup {r.status}")
+    if r.status >= 300:
+        raise Exception(f"Follow-up message failed with {r.status}: {r.data}")
+
+def batch_handler(event, _):
+    # entry point for an SQS event source. each message is an event as lambda_handler takes it,
+    # usually a deferred one from send_to_queue; deferred commands are answered with follow-ups
+    metrics.start()
+    try:
+        events = [json.loads(record['body']) for record in event['Records']]
+        responses = handle_batch(events)
+        for item, resp in zip(events, responses):
+            if 'deferred' in item:
+                # acknowledged already, so answered whatever happened to it
+                if 'data' not in resp:
+                    resp = message_response(f"Couldn't run this command. {resp.get('error')}")
+                try:
+                    send_followup(item['deferred'].get('body-json'), resp)
+                except Exception as e:
+                    # the command has run either way, so the message is not retried
+                    print(f"Follow-up failed: {e}")
+        return {"responses": responses}
+    finally:
+        metrics.emit()
+
+def handle_batch(events: list[dict]):
+    # a response for each event, in order. every event is verified, then commands are grouped by
+    # guild so each bank is opened and written once for all of its commands, in arrival order
+    metrics.dimension("Command", "batch")
+    metrics.put("batchEvents", len(events))
+    responses: list[dict] = [{}] * len(events)
+    guilds: Dict[str, list[tuple[int, dict]]] = {}
+    # interaction id -> the first event in the batch with it, and the events repeating it
+    first: dict[str, int] = {}
+    repeats: list[tuple[int, int]] = []
+    for i, event in enumerate(events):
+        # deferred events were checked for replays when they were acknowledged, and may have
+        # waited in the queue for as long as their token lasts
+        deferred = 'deferred' in event
+        if deferred:
+            event = event['deferred']
+        try:
+            with metrics.phase("verify"):
+                replayed = verify_interaction(event, check_replay=not deferred,
+                                              tolerance=INTERACTION_TOKEN_SECONDS if deferred else SIGNATURE_TOLERANCE)
         except Exception as e:
-            resp = {
-                "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
-                "data": {
-                    "tts": False,
-                    "content": f"Error running command.\nCommand: {command}\nOptions: {options}\nError: {e}",
-                    "embeds": [],
-                    "allowed_mentions": []
-                }
-            };
-
-    print(f"response {resp}") #debug print
-    return resp;
+            responses[i] = {"error": f"[UNAUTHORIZED] Invalid request signature: {e}"}
+            continue
+        body = event.get('body-json')
+        # as in handle_event and handle_command, for deferred events only a finished command counts
+        stored = stored_response(body)
+        if stored is not None and (not deferred or not is_acknowledgement(stored)):
+            responses[i] = stored
+        elif body.get('id') in first:
+            repeats.append((i, first[body.get('id')]))
+        elif replayed:
+            responses[i] = {"error": "[UNAUTHORIZED] Invalid request signature: signature has already been used"}
+        elif ping_pong(body):
+            responses[i] = PING_PONG
+        else:
+            if body.get('id') is not None:
+                first[body.get('id')] = i
+            guilds.setdefault(body.get('guild_id'), []).append((i, body))
+    for server_id, batch in guilds.items():
+        for (i, _), resp in zip(batch, handle_guild_batch(server_id, [body for _, body in batch])):
+            responses[i] = resp
+    for i, original in repeats:
+        responses[i] = responses[original]
+    return responses
+
+class BatchCommandError(Exception):
+    # a command in a batch raised; position is its place among the commands being run
+    def __init__(self, position: int, error: Exception):
+        super().__init__(str(error))
+        self.position = position
+        self.error = error
+
+def handle_guild_batch(server_id: str, bodies: list[dict]):
+    # handle_command for each body, with the bank opened and written back once for all of them.
+    # a command that raises is answered with the error and the rest are run again without it,
+    # on a fresh bank, since nothing the raising command left behind can be trusted
+    responses: list[dict] = [{}] * len(bodies)
+    parsed = []
+    for i, body in enumerate(bodies):
+        try:
+            subcommand, values = commands.parse(body.get('data') or {})
+        except commands.CommandError as e:
+            responses[i] = message_response(f"Failed to parse command. {e}")
+            continue
+        parsed.append((i, body, subcommand, values))
+    metrics.tag("guild", server_id)
+    metrics.put("batchCommands", len(parsed))
+    while len(parsed) > 0:
+        try:
+            results = with_bank(server_id, lambda bank: run_commands(bank, parsed))
+        except BatchCommandError as e:
+            i, body, _, _ = parsed.pop(e.position)
+            responses[i] = command_error_response(body['data'].get('name'), body['data'].get('options'), e.error)
+            continue
+        except Exception as e:
+            # the bank itself couldn't be read or written
+            for i, body, _, _ in parsed:
+                responses[i] = command_error_response(body['data'].get('name'), body['data'].get('options'), e)
+            break
+        for (i, _, _, _), resp in zip(parsed, results):
+            responses[i] = resp
+        store_responses(server_id, [(body, resp) for (_, body, subcommand, _), resp in zip(parsed, results)
+                                    if not subcommand.read_only])
+        break
+    return responses
+
+def run_commands(bank: Bank, parsed: list[tuple]):
+    responses = []
+    for position, (_, body, subcommand, values) in enumerate(parsed):
+        try:
+            responses.append(run_command(bank, body, subcommand, values))
+        except Exception as e:
+            raise BatchCommandError(position, e)
+    return responses
+
+def message_response(content: str):
+    return {
+        "type": RESPONSE_TYPES['MESSAGE_WITH_SOURCE'],
+        "data": {
+            "tts": False,
+            "content": content,
+            "embeds": [],
+            "allowed_mentions": []
+        }
+    }
+
+def run_command(bank: Bank, body: dict, subcommand: commands.Subcommand, values: list):
+    # get user
+    user_id = body.get('member').get('user').get('id')
+    user = bank.get_user(user_id)
+    with metrics.phase("command"):
+        content = HANDLERS[subcommand.name](bank, user, *values)
+    return message_response(content)
 
 def init_server(server: str):
     os.makedirs(f"{BANK_DIR}/{server}", exist_ok=True)
 
+def shard_dir(server: str):
+    digest = hashlib.blake2b(server.encode('utf-8'), digest_size=8).hexdigest()
+    parts = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return "/".join([BANK_DIR, *parts])
+
+# guild id -> the directory its files are in. a guild's shard is looked up once per container;
+# BANK_DIR is checked again on every use, since move_banks.py can move the guild out of it
+guild_dirs: Dict[str, str] = {}
+# directories known to exist, so they aren't created again on every command
+made_dirs: set[str] = set()
+
+def guild_dir(server: str):
+    # guilds live in their shard, unless they are still in BANK_DIR itself from before shards.
+    # once a guild's lock exists in its shard, that's where it is, see move_banks.py
+    dir = guild_dirs.get(server)
+    if dir == BANK_DIR and os.path.exists(f"{shard_dir(server)}/{server}.lock"):
+        dir = None
+    if dir is None:
+        dir = shard_dir(server)
+        if FLAT_LAYOUT_FALLBACK and not os.path.exists(f"{dir}/{server}.lock") and \
+                any(os.path.exists(f"{BANK_DIR}/{server}{suffix}") for suffix in ("", ".journal", ".lock")):
+            dir = BANK_DIR
+        guild_dirs[server] = dir
+    return dir
+
+def make_dir(dir: str):
+    if dir not in made_dirs:
+        os.makedirs(dir, exist_ok=True)
+        made_dirs.add(dir)
+
+def open_guild_lock(server_id: str, operation: int):
+    # the guild's lock file, opened and flocked with operation. a guild found in BANK_DIR can be
+    # moved into its shard meanwhile; if it was by the time the lock is held, it is looked up again
+    while True:
+        path = lock_file(server_id)
+        make_dir(os.path.dirname(path))
+        try:
+            lock = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # the directory was removed since it was made
+            made_dirs.discard(os.path.dirname(path))
+            continue
+        try:
+            fcntl.flock(lock, operation)
+        except BaseException:
+            os.close(lock)
+            raise
+        if lock_file(server_id) == path:
+            return lock
+        os.close(lock)
+
 def server_file(server: str):
-    return f"{BANK_DIR}/{server}";
+    return f"{guild_dir(server)}/{server}"
+
+def journal_file(server: str):
+    return f"{server_file(server)}.journal"
+
+def history_dir(server: str):
+    return f"{server_file(server)}.history"
+
+def lock_file(server: str):
+    return f"{server_file(server)}.lock"
+
+def responses_dir(server: str):
+    return f"{server_file(server)}.replies"
+
+def file_guilds():
+    # every guild in BANK_DIR, in its shard or not. a guild has a snapshot (the file named
+    # after it), a journal, or both
+    guilds = set()
+    for dir in [BANK_DIR] + shard_dirs():
+        for name in os.listdir(dir):
+            if ('.' not in name and os.path.isfile(f"{dir}/{name}")) or name.endswith(".journal"):
+                guilds.add(name.split('.')[0])
+    return sorted(guilds)
+
+def shard_dirs():
+    # the deepest level of shard directories that exist
+    dirs = [BANK_DIR]
+    for _ in range(SHARD_LEVELS):
+        dirs = [f"{dir}/{name}" for dir in dirs if os.path.isdir(dir) for name in sorted(os.listdir(dir))
+                if len(name) == SHARD_WIDTH and os.path.isdir(f"{dir}/{name}")]
+    return dirs
 
 def format_user(id: str):
     return f"<@{id}>"
 
-@dataclass
-class User(JSONWizard):
-    id: str
-    balance: int
-    last_paycheck: datetime.datetime
+def bet_key(a: str, b: str):
+    # a bet between a and b is the same bet as one between b and a
+    return (a, b) if a <= b else (b, a)
+
+def fill_message(text: str, entries, count: int):
+    # adds count entries to text until the next one would take it past MESSAGE_LIMIT,
+    # keeping room to say how many were left out
+    for i, entry in enumerate(entries):
+        # after the last entry there is nothing left to mention
+        room = 0 if i == count - 1 else len(f"\n\n...and {count - i - 1} more")
+        if len(text) + 2 + len(entry) + room > MESSAGE_LIMIT:
+            return text + f"\n\n...and {count - i} more"
+        text += f"\n\n{entry}"
+    return text
+
+def user_record(user: User):
+    # a user as binbank and sqlbank store it:
+    # (id, balance, last paycheck in micros, wins, losses, cancelled, net)
+    return (user.id, user.balance, user.last_paycheck_micros, user.wins, user.losses, user.cancelled, user.net)
+
+def record_user(record: tuple):
+    return User.from_record(record)
+
+def compute_stats(bets):
+    # user id -> [wins, losses, cancelled, net] over settled bets, the slow way, and how many
+    # bets there were
+    stats: Dict[str, list[int]] = {}
+    count = 0
+    for bet in bets:
+        count += 1
+        p1 = stats.setdefault(bet.p1, [0, 0, 0, 0])
+        p2 = stats.setdefault(bet.p2, [0, 0, 0, 0])
+        if bet.was_cancelled():
+            p1[2] += 1
+            p2[2] += 1
+            continue
+        winner, loser = (p1, p2) if bet.p1_won else (p2, p1)
+        winner[0] += 1
+        winner[3] += bet.amount
+        loser[1] += 1
+        loser[3] -= bet.amount
+    return stats, count
+
+def expiry_micros(days: float | None):
+    return None if days is None else round(days * 86400 * 1000000)
+
+def bet_deadline(bet: Bet):
+    # when an open bet expires, in micros, or None if bets like it never do
+    expiry = expiry_micros(PENDING_BET_EXPIRY_DAYS if bet.pending else UNDECIDED_BET_EXPIRY_DAYS)
+    return None if expiry is None else bet.start_micros + expiry
+
+def expiry_cutoff(days: float | None, now: int):
+    # bets that started before this have expired; with no expiry, none have
+    expiry = expiry_micros(days)
+    return binbank.to_micros(datetime.datetime.min) if expiry is None else now - expiry
+
+def snowflake(id: str):
+    # Discord ids are kept as ints, which take a fraction of the memory of strings.
+    # anything that wouldn't turn back into the same string is kept as it is
+    if id.isascii() and id.isdigit() and (id[0] != '0' or id == '0'):
+        return int(id)
+    return id
+
+def flag_property(flag: int):
+    # a bool kept as one bit of the object's _flags
+    def get(self):
+        return self._flags & flag != 0
+    def set(self, value: bool):
+        object.__setattr__(self, '_flags', self._flags | flag if value else self._flags & ~flag)
+    return property(get, set)
+
+def snowflake_property(slot: str):
+    def get(self):
+        return str(getattr(self, slot))
+    def set(self, value: str):
+        object.__setattr__(self, slot, snowflake(value))
+    return property(get, set)
+
+def time_property(slot: str):
+    # a datetime kept as microseconds since 1970 (see binbank), datetime.min and max included
+    def get(self):
+        return binbank.from_micros(getattr(self, slot))
+    def set(self, value: datetime.datetime):
+        object.__setattr__(self, slot, binbank.to_micros(value))
+    return property(get, set)
+
+class Tracked:
+    # remembers whether a persistent field (one of FIELDS) has been given a new value
+    # since the object was created or last written out
+    __slots__ = ('_dirty',)
+    FIELDS: frozenset[str] = frozenset()
+
+    def __setattr__(self, name: str, value):
+        if name in self.FIELDS and getattr(self, name, Tracked) != value:
+            object.__setattr__(self, '_dirty', True)
+        object.__setattr__(self, name, value)
+
+    def is_dirty(self):
+        return self._dirty
+
+    def mark_clean(self):
+        object.__setattr__(self, '_dirty', False)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+class User(Tracked):
+    # slots instead of a __dict__, the id as an int and the paycheck time in micros, since a
+    # big guild holds many of these. the JSON form is unchanged
+    __slots__ = ('_id', 'balance', 'last_paycheck_micros', 'wins', 'losses', 'cancelled', 'net')
+    FIELDS = frozenset(('id', 'balance', 'last_paycheck', 'last_paycheck_micros', 'wins', 'losses', 'cancelled', 'net'))
+
+    id = snowflake_property('_id')
+    last_paycheck = time_property('last_paycheck_micros')
+
+    def __init__(self, id: str, balance: int, last_paycheck: datetime.datetime,
+                 wins: int = 0, losses: int = 0, cancelled: int = 0, net: int = 0):
+        self.init(snowflake(id), balance, binbank.to_micros(last_paycheck), wins, losses, cancelled, net)
+
+    def init(self, id: int | str, balance: int, last_paycheck_micros: int, wins: int, losses: int, cancelled: int, net: int):
+        set = object.__setattr__
+        set(self, '_id', id)
+        set(self, 'balance', balance)
+        set(self, 'last_paycheck_micros', last_paycheck_micros)
+        # kept up to date as bets settle, see Bank.record_result and Bank.cancel_bet
+        set(self, 'wins', wins)
+        set(self, 'losses', losses)
+        set(self, 'cancelled', cancelled)
+        set(self, 'net', net) # winnings minus losses
+        set(self, '_dirty', False)
+
+    @classmethod
+    def from_record(cls, record: tuple):
+        # see user_record
+        user = cls.__new__(cls)
+        id, *rest = record
+        user.init(snowflake(id), *rest)
+        return user
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        user = cls.__new__(cls)
+        user.init(snowflake(obj['id']), obj['balance'], binbank.iso_to_micros(obj['lastPaycheck']),
+                  obj.get('wins', 0), obj.get('losses', 0), obj.get('cancelled', 0), obj.get('net', 0))
+        return user
+
+    def to_dict(self):
+        return binbank.user_dict(self.id, self.balance, self.last_paycheck_micros,
+                                 self.wins, self.losses, self.cancelled, self.net)
 
     def fmt(self):
         return format_user(self.id)
-    
-    # @staticmethod
-    # def from_json(json):
-    #     return User(json.get('id'), json.get('balance'), last_paycheck=json.get('last_paycheck'))
 
-@dataclass
-class Bet(JSONWizard):
-    p1: str
-    p2: str
-    arbitrator: str
-    amount: int
-    condition: str
-    start_time: datetime.datetime
+class Bet(Tracked):
+    # compact like User; the five bools are bits of _flags, as in binbank
+    __slots__ = ('_p1', '_p2', '_arbitrator', 'amount', 'condition', 'start_micros', 'end_micros', '_flags')
+    FIELDS = frozenset(('p1', 'p2', 'arbitrator', 'amount', 'condition', 'start_time', 'end_time', 'start_micros',
+                        'end_micros', 'p1_won', 'pending', 'rejected', 'p1_cancel', 'p2_cancel'))
+
+    p1 = snowflake_property('_p1')
+    p2 = snowflake_property('_p2')
+    arbitrator = snowflake_property('_arbitrator')
+    start_time = time_property('start_micros')
     # used once bet is in history
-    end_time: datetime.datetime
-    p1_won: bool # else p2 won
-    pending: bool
-    rejected: bool
-    p1_cancel: bool
-    p2_cancel: bool
-    # @staticmethod
-
-    # def from_json(json):
-    #     return Bet(p1=json.get('p1'),
-    #                p2=json.get('p2'),
-    #                arbitrator=json.get('arbitrator'),
-    #                amount=json.get('amount'),
-    #                condition=json.get('condition'),
-    #                start_time=json.get('start_time'),
-    #                end_time=json.get('end_time'),
-    #                p1_won=json.get('p1_won'))
+    end_time = time_property('end_micros')
+    p1_won = flag_property(binbank.P1_WON) # else p2 won
+    pending = flag_property(binbank.PENDING)
+    rejected = flag_property(binbank.REJECTED)
+    p1_cancel = flag_property(binbank.P1_CANCEL)
+    p2_cancel = flag_property(binbank.P2_CANCEL)
+
+    def __init__(self, p1: str, p2: str, arbitrator: str, amount: int, condition: str,
+                 start_time: datetime.datetime, end_time: datetime.datetime,
+                 p1_won: bool, pending: bool, rejected: bool, p1_cancel: bool, p2_cancel: bool):
+        self.init(p1, p2, arbitrator, amount, condition, binbank.to_micros(start_time), binbank.to_micros(end_time),
+                  binbank.bet_flags(p1_won, pending, rejected, p1_cancel, p2_cancel))
+
+    def init(self, p1: str, p2: str, arbitrator: str, amount: int, condition: str, start_micros: int, end_micros: int, flags: int):
+        set = object.__setattr__
+        set(self, '_p1', snowflake(p1))
+        set(self, '_p2', snowflake(p2))
+        set(self, '_arbitrator', snowflake(arbitrator))
+        set(self, 'amount', amount)
+        set(self, 'condition', condition)
+        set(self, 'start_micros', start_micros)
+        set(self, 'end_micros', end_micros)
+        set(self, '_flags', flags)
+        set(self, '_dirty', False)
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        bet = cls.__new__(cls)
+        bet.init(obj['p1'], obj['p2'], obj['arbitrator'], obj['amount'], obj['condition'],
+                 binbank.iso_to_micros(obj['startTime']), binbank.iso_to_micros(obj['endTime']),
+                 binbank.bet_flags(obj['p1Won'], obj['pending'], obj['rejected'], obj['p1Cancel'], obj['p2Cancel']))
+        return bet
+
+    def to_dict(self):
+        return binbank.bet_dict(self.p1, self.p2, self.arbitrator, self.amount, self.condition,
+                                self.start_micros, self.end_micros, self._flags)
+
+    def was_cancelled(self):
+        # a settled bet was either cancelled, before it was accepted or by both sides, or decided
+        return self.pending or (self.p1_cancel and self.p2_cancel)
 
     def describe_now(self):
         return f"{format_user(self.p1)} bets ${self.amount} against {format_user(self.p2)}\n" + \
                f"Condition: {self.condition}"
     def describe_history(self):
+        if self.was_cancelled():
+            return f"Bet: {format_user(self.p1)} and {format_user(self.p2)} cancelled a bet of ${self.amount}\n" \
+                   f"Condition: {self.condition}"
         winner = format_user(self.p1) if self.p1_won else format_user(self.p2)
         loser = format_user(self.p2) if self.p1_won else format_user(self.p1)
         return f"Bet: {winner} won {self.amount} from {loser}\n" \
                f"Condition: {self.condition}"
 
 @dataclass
-class Bank(JSONWizard):
+class Bank:
     users: Dict[str, User]
     current_bets: list[Bet]
     history: list[Bet]
+    # the LEADERS_KEPT richest users by id, with their balances. every user not in it has at
+    # most leaders_floor; None means every user with a balance is in it
+    leaders: Dict[str, int] = field(default_factory=dict)
+    leaders_floor: int | None = None
+    stats_version: int = 0
+    # how many bets have ever been settled, so the history's length is known without reading it
+    settled_count: int = 0
 
-    def get_bet(self: Bank, p1: str, p2: str):
+    @classmethod
+    def from_dict(cls, obj: dict):
+        # the bank's JSON form, which is what the dataclass_wizard version of these classes wrote
+        return cls(users={id: User.from_dict(user) for id, user in obj['users'].items()},
+                   current_bets=[Bet.from_dict(bet) for bet in obj['currentBets']],
+                   history=[Bet.from_dict(bet) for bet in obj['history']],
+                   leaders=obj.get('leaders', {}),
+                   leaders_floor=obj.get('leadersFloor'),
+                   stats_version=obj.get('statsVersion', 0),
+                   settled_count=obj.get('settledCount', 0))
+
+    def to_dict(self):
+        return {
+            "users": {id: user.to_dict() for id, user in self.users.items()},
+            "currentBets": [bet.to_dict() for bet in self.current_bets],
+            "history": [bet.to_dict() for bet in self.history],
+            **self.extra_fields(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def __post_init__(self):
+        self.index_bets()
+        # users handed out by get_user, the only ones a command can have changed
+        self._touched_users: Dict[str, User] = {}
+        # whether bets were opened or closed
+        self._bets_changed = False
+        # whether the leaderboard, stats_version or settled_count changed
+        self._fields_changed = False
+        # set by server(); settled bets that have been written out live there
+        self.history_dir: str | None = None
+        # set by server(); settled bets not on the history yet, appended by the next write: from an
+        # invocation that crashed before appending them, or still in a bank file from before history segments
+        self.unrecorded: list[dict] = []
+        # set by server() when the snapshot is binary, or for SQLite; users not in self.users are read from it
+        self.user_source: binbank.BinaryBank | sqlbank.GuildStore | None = None
+        # set by server(); the format of the snapshot on disk, which it is written back in unless BANK_FORMAT says otherwise
+        self.snapshot_format = "json"
+        # set by server() for SQLite; open bets not in current_bets are read from it as they are asked for
+        self.bet_source: sqlbank.GuildStore | None = None
+        # bets opened or closed since the bank was loaded, so only those rows are written.
+        # a bet closed and then opened again between the same users is in both
+        self._added_bets: set[tuple[str, str]] = set()
+        self._removed_bets: set[tuple[str, str]] = set()
+        # users whose open bets (or bets to arbitrate) have all been read from bet_source
+        self._fetched_bets_of: set[str] = set()
+        self._fetched_arbitrated_by: set[str] = set()
+
+    def index_bets(self):
+        # open bets by unordered pair (as a position in current_bets), by participant and by arbitrator.
+        # these are never serialized, so they are rebuilt whenever a bank is loaded
+        self._bet_positions: Dict[tuple[str, str], int] = {}
+        self._user_bets: Dict[str, set[tuple[str, str]]] = {}
+        self._arbitrator_bets: Dict[str, set[tuple[str, str]]] = {}
+        for i, bet in enumerate(self.current_bets):
+            self._bet_positions[bet_key(bet.p1, bet.p2)] = i
+            self._index_bet(bet)
+        # (when it expires in micros, pair) for open bets that can expire, soonest first. entries
+        # aren't removed when a bet closes or is accepted; expire_bets skips the ones out of date
+        self._expiry_heap: list[tuple[int, tuple[str, str]]] = []
         for bet in self.current_bets:
-            if (bet.p1 == p1 and bet.p2 == p2) or (bet.p1 == p2 and bet.p2 == p1):
-                return bet
-        return None
+            deadline = bet_deadline(bet)
+            if deadline is not None:
+                self._expiry_heap.append((deadline, bet_key(bet.p1, bet.p2)))
+        heapq.heapify(self._expiry_heap)
+
+    def _index_bet(self, bet: Bet):
+        key = bet_key(bet.p1, bet.p2)
+        self._user_bets.setdefault(bet.p1, set()).add(key)
+        self._user_bets.setdefault(bet.p2, set()).add(key)
+        self._arbitrator_bets.setdefault(bet.arbitrator, set()).add(key)
+
+    def _unindex_bet(self, bet: Bet):
+        key = bet_key(bet.p1, bet.p2)
+        for user_id, index in ((bet.p1, self._user_bets), (bet.p2, self._user_bets), (bet.arbitrator, self._arbitrator_bets)):
+            keys = index.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del index[user_id]
+
+    def add_bet(self, bet: Bet):
+        self._bets_changed = True
+        self._added_bets.add(bet_key(bet.p1, bet.p2))
+        self._load_bet(bet)
+
+    def _load_bet(self, bet: Bet):
+        self._bet_positions[bet_key(bet.p1, bet.p2)] = len(self.current_bets)
+        self.current_bets.append(bet)
+        self._index_bet(bet)
+        self.schedule_expiry(bet)
+
+    def schedule_expiry(self, bet: Bet):
+        # for a bet that was just opened or accepted
+        deadline = bet_deadline(bet)
+        if deadline is not None:
+            heapq.heappush(self._expiry_heap, (deadline, bet_key(bet.p1, bet.p2)))
+
+    def expire_bets(self):
+        # cancels and refunds every open bet past its expiry, and returns them. only the expired
+        # bets are looked at, so this is cheap enough to do whenever a bank is opened
+        if PENDING_BET_EXPIRY_DAYS is None and UNDECIDED_BET_EXPIRY_DAYS is None:
+            return []
+        now = binbank.to_micros(datetime.datetime.now())
+        if self.bet_source is not None:
+            # the store's bets aren't read up front, so the ones old enough to expire are read now
+            self._fetch_bets(self.bet_source.bets_started_before(expiry_cutoff(PENDING_BET_EXPIRY_DAYS, now),
+                                                                 expiry_cutoff(UNDECIDED_BET_EXPIRY_DAYS, now)))
+        expired = []
+        while len(self._expiry_heap) > 0 and self._expiry_heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._expiry_heap)
+            i = self._bet_positions.get(key)
+            if i is None or bet_deadline(self.current_bets[i]) != deadline:
+                # closed since, or accepted and pushed again with a new deadline
+                continue
+            bet = self.current_bets[i]
+            # as if both sides agreed to cancel it
+            bet.p1_cancel = True
+            bet.p2_cancel = True
+            self.cancel_bet(bet.p1, bet.p2)
+            expired.append(bet)
+        return expired
+
+    def _fetch_bets(self, bets: list[dict]):
+        # open bets from bet_source, minus any this command has already read or closed
+        for obj in bets:
+            key = bet_key(obj['p1'], obj['p2'])
+            if key not in self._bet_positions and key not in self._removed_bets:
+                self._load_bet(Bet.from_dict(obj))
+
+    def remove_bet(self, bet: Bet):
+        # move the last open bet into the hole instead of shifting the whole list
+        self._bets_changed = True
+        self._added_bets.discard(bet_key(bet.p1, bet.p2))
+        self._removed_bets.add(bet_key(bet.p1, bet.p2))
+        i = self._bet_positions.pop(bet_key(bet.p1, bet.p2))
+        last = self.current_bets.pop()
+        if i < len(self.current_bets):
+            self.current_bets[i] = last
+            self._bet_positions[bet_key(last.p1, last.p2)] = i
+        self._unindex_bet(bet)
+
+    def get_bet(self: Bank, p1: str, p2: str):
+        i = self._bet_positions.get(bet_key(p1, p2))
+        if i is None and self.bet_source is not None and bet_key(p1, p2) not in self._removed_bets:
+            obj = self.bet_source.find_bet(p1, p2)
+            if obj is not None:
+                self._fetch_bets([obj])
+                i = self._bet_positions.get(bet_key(p1, p2))
+        if i is None:
+            return None
+        return self.current_bets[i]
+
+    def bets_of(self, user_id: str):
+        if self.bet_source is not None and user_id not in self._fetched_bets_of:
+            self._fetch_bets(self.bet_source.bets_of(user_id))
+            self._fetched_bets_of.add(user_id)
+        return [self.current_bets[self._bet_positions[key]] for key in self._user_bets.get(user_id, ())]
+
+    def bets_arbitrated_by(self, user_id: str):
+        if self.bet_source is not None and user_id not in self._fetched_arbitrated_by:
+            self._fetch_bets(self.bet_source.bets_arbitrated_by(user_id))
+            self._fetched_arbitrated_by.add(user_id)
+        return [self.current_bets[self._bet_positions[key]] for key in self._arbitrator_bets.get(user_id, ())]
+
+    def iter_history(self):
+        # oldest first. only bets settled by the running command (or for a resident bank, since
+        # its last snapshot) are held in self.history; everything else is read on demand
+        if self.history_dir is not None:
+            yield from read_history(self.history_dir)
+        if self.bet_source is not None:
+            for obj in self.bet_source.history():
+                yield Bet.from_dict(obj)
+        for obj in self.unrecorded:
+            yield Bet.from_dict(obj)
+        yield from self.history
+
+    def user_history(self, user_id: str, skip: int, count: int):
+        # how many settled bets user_id took part in, and up to count of them, newest first,
+        # after skipping the newest skip. only the bets returned are read
+        held = [bet for bet in reversed(self.history) if user_id in (bet.p1, bet.p2)] + \
+               [Bet.from_dict(obj) for obj in reversed(self.unrecorded) if user_id in (obj['p1'], obj['p2'])]
+        page = held[skip:skip + count]
+        skip = max(0, skip - len(held))
+        count -= len(page)
+        if self.bet_source is not None:
+            total, bets = self.bet_source.user_history(user_id, skip, count)
+        elif self.history_dir is not None:
+            total, bets = read_user_history(self.history_dir, user_id, skip, count)
+        else:
+            total, bets = 0, []
+        return len(held) + total, page + [Bet.from_dict(obj) for obj in bets]
 
     def get_user(self, user_id: str):
         if user_id not in self.users.keys():
-            user = User(id=user_id,
-                        balance=0,
-                        last_paycheck=datetime.datetime.min)
+            user = self.stored_user(user_id)
+            if user is None:
+                # a new user isn't dirty, so looking someone up doesn't cause a write by itself
+                user = User(id=user_id,
+                            balance=0,
+                            last_paycheck=datetime.datetime.min)
             self.users[user_id] = user
-            return user
         else:
-            return self.users[user_id]
+            user = self.users[user_id]
+        self._touched_users[user_id] = user
+        return user
+
+    def stored_user(self, user_id: str):
+        # a user from a binary snapshot or the database that hasn't been read into self.users yet
+        if self.user_source is None:
+            return None
+        record = self.user_source.find_user(user_id)
+        if record is None:
+            return None
+        return record_user(record)
+
+    def dirty_users(self):
+        return {id: user for id, user in self._touched_users.items() if user.is_dirty()}
+
+    def bets_dirty(self):
+        return self._bets_changed or any(bet.is_dirty() for bet in self.current_bets)
+
+    def changed_bets(self):
+        # the pairs whose bets were closed, and the open bets that are new or were changed
+        changed = [bet for bet in self.current_bets if bet_key(bet.p1, bet.p2) in self._added_bets or bet.is_dirty()]
+        return list(self._removed_bets), changed
+
+    def fields_dirty(self):
+        return self._fields_changed
+
+    def extra_fields(self):
+        # what a bank holds besides users and bets, in JSON form, for formats that store it separately
+        return {"leaders": self.leaders, "leadersFloor": self.leaders_floor, "statsVersion": self.stats_version,
+                "settledCount": self.settled_count}
+
+    def is_dirty(self):
+        return self.bets_dirty() or len(self.history) > 0 or len(self.dirty_users()) > 0 or self._fields_changed
+
+    def mark_clean(self):
+        for user in self._touched_users.values():
+            user.mark_clean()
+        for bet in self.current_bets:
+            bet.mark_clean()
+        self._touched_users = {}
+        self._bets_changed = False
+        self._added_bets = set()
+        self._removed_bets = set()
+        self._fields_changed = False
+
+    def user_count(self):
+        if self.user_source is None:
+            return len(self.users)
+        # users read out of the binary snapshot are in both; new users are only in self.users
+        return self.user_source.user_count + sum(1 for id in self.users if self.user_source.find_user(id) is None)
+
+    def materialize(self):
+        # read every user out of the binary snapshot, e.g. to write the bank as JSON
+        if self.user_source is not None:
+            for record in self.user_source.user_records():
+                if record[0] not in self.users:
+                    self.users[record[0]] = record_user(record)
+            self.user_source = None
+
+    def settle_bet(self, bet: Bet):
+        # closes a decided or cancelled bet, which goes on the history
+        self.history.append(bet)
+        self.settled_count += 1
+        self._fields_changed = True
+        self.remove_bet(bet)
+
+    def record_result(self, bet: Bet, victor: str):
+        winner, loser = self.get_user(victor), self.get_user(bet.p2 if victor == bet.p1 else bet.p1)
+        winner.wins += 1
+        winner.net += bet.amount
+        loser.losses += 1
+        loser.net -= bet.amount
+
+    def update_leaders(self):
+        # brings the leaderboard up to date with the balances this command changed.
+        # a user with money stays on it while their balance is at least leaders_floor; if too
+        # many leaders drop below it, it is rebuilt from every user
+        for id, user in self.dirty_users().items():
+            if user.balance > 0 and (self.leaders_floor is None or user.balance >= self.leaders_floor):
+                if self.leaders.get(id) != user.balance:
+                    self.leaders[id] = user.balance
+                    self._fields_changed = True
+            elif id in self.leaders:
+                del self.leaders[id]
+                self._fields_changed = True
+        if len(self.leaders) > LEADERS_KEPT:
+            ranked = sorted(self.leaders.items(), key=lambda item: -item[1])
+            self.leaders = dict(ranked[:LEADERS_KEPT])
+            # everyone dropped has at most the richest of them, and every leader at least that
+            self.leaders_floor = max(ranked[LEADERS_KEPT][1], self.leaders_floor or ranked[LEADERS_KEPT][1])
+        if len(self.leaders) < LEADERBOARD_SIZE and self.leaders_floor is not None:
+            self.rebuild_leaders()
+
+    def rebuild_leaders(self):
+        # reads every user's balance. users with no money aren't on the leaderboard
+        ranked = sorted(((record[0], record[1]) for record in bank_user_records(self) if record[1] > 0), key=lambda item: -item[1])
+        self.leaders = dict(ranked[:LEADERS_KEPT])
+        self.leaders_floor = ranked[LEADERS_KEPT][1] if len(ranked) > LEADERS_KEPT else None
+        self._fields_changed = True
+
+    def backfill_stats(self):
+        # recomputes every user's stats from the whole history, and the leaderboard from every
+        # user. slow on a big guild, but only done once, for banks from before STATS_VERSION
+        print(f"Backfilling stats from history (stats version {self.stats_version})")
+        stats, self.settled_count = compute_stats(self.iter_history())
+        for id in {record[0] for record in bank_user_records(self)} | stats.keys():
+            user = self.get_user(id)
+            user.wins, user.losses, user.cancelled, user.net = stats.get(id, (0, 0, 0, 0))
+        self.rebuild_leaders()
+        self.stats_version = STATS_VERSION
+
+    def check_stats(self):
+        # recomputes stats and the leaderboard from scratch, without changing anything, and
+        # describes every way they differ from what is stored
+        problems = []
+        stats, settled = compute_stats(self.iter_history())
+        if settled != self.settled_count:
+            problems.append(f"stored settled bet count {self.settled_count}, recomputed {settled}")
+        records = {record[0]: record for record in bank_user_records(self)}
+        for id in records.keys() | stats.keys():
+            stored = tuple(records[id][3:]) if id in records else (0, 0, 0, 0)
+            expected = tuple(stats.get(id, (0, 0, 0, 0)))
+            if stored != expected:
+                problems.append(f"{format_user(id)}: stored (wins, losses, cancelled, net) {stored}, recomputed {expected}")
+        balances = {id: record[1] for id, record in records.items()}
+        for id, balance in self.leaders.items():
+            if balances.get(id) != balance:
+                problems.append(f"{format_user(id)}: leaderboard has balance {balance}, bank has {balances.get(id)}")
+            if balance <= 0:
+                problems.append(f"{format_user(id)}: on the leaderboard with no money")
+            elif self.leaders_floor is not None and balance < self.leaders_floor:
+                problems.append(f"{format_user(id)}: on the leaderboard with {balance}, under the floor {self.leaders_floor}")
+        for id, balance in balances.items():
+            if id not in self.leaders and balance > 0 and (self.leaders_floor is None or balance > self.leaders_floor):
+                problems.append(f"{format_user(id)}: missing from the leaderboard with {balance}")
+        shown = sorted(self.leaders.values(), reverse=True)[:LEADERBOARD_SIZE]
+        expected_top = sorted((balance for balance in balances.values() if balance > 0), reverse=True)[:LEADERBOARD_SIZE]
+        if shown != expected_top:
+            problems.append(f"top balances are {shown}, recomputed {expected_top}")
+        return problems
 
     def cancel_bet(self, a: str, b: str):
-        for i in range(len(self.current_bets)):
-            bet = self.current_bets[i]
-            # if this bet pertains to a and b
-            if bet.p1 == a and bet.p2 == b or bet.p2 == a and bet.p1 == b:
-                bet.end_time = datetime.datetime.now()
-                self.get_user(bet.p1).balance += bet.amount
-                refund_text = f"${bet.amount} has been refunded to {format_user(bet.p1)}"
-                if not bet.pending:
-                    self.get_user(bet.p2).balance += bet.amount
-                    refund_text += f"\n${bet.amount} has been refunded to {format_user(bet.p2)}"
-                self.history.append(bet)
-                del self.current_bets[i]
-                return refund_text
-        raise Exception(f"Error: canceled nonexistent bet between {format_user(a)} and {format_user(b)}")
+        bet = self.get_bet(a, b)
+        if bet is None:
+            raise Exception(f"Error: canceled nonexistent bet between {format_user(a)} and {format_user(b)}")
+        bet.end_time = datetime.datetime.now()
+        self.get_user(bet.p1).balance += bet.amount
+        refund_text = f"${bet.amount} has been refunded to {format_user(bet.p1)}"
+        if not bet.pending:
+            self.get_user(bet.p2).balance += bet.amount
+            refund_text += f"\n${bet.amount} has been refunded to {format_user(bet.p2)}"
+        self.get_user(bet.p1).cancelled += 1
+        self.get_user(bet.p2).cancelled += 1
+        self.settle_bet(bet)
+        return refund_text
+
+    def cmd_bank(self: Bank, user: User):
+        time_diff = user.last_paycheck - get_prev_midnight()
+        if time_diff < datetime.timedelta(0):
+            user.balance += PAYCHECK
+            user.last_paycheck = datetime.datetime.now()
+            paycheck_message = f"Added daily paycheck: +${PAYCHECK}"
+        else:
+            import humanize
+            paycheck_message = f"{humanize.precisedelta(get_next_midnight() - datetime.datetime.now(), format='%0.f')} until next paycheck"
+        return f"Balance: ${user.balance}\n{paycheck_message}"
 
     def cmd_make_bet(self: Bank, user: User, against: str | None, arbitrator: str | None, amount: int | None, condition: str | None):
         if against == None:
@@ -366,174 +1293,884 @@ class Bank(JSONWizard):
             return f"{fail_msg}\n{bet.describe_now()}\n{user.fmt()} does not have enough money: {user.balance}"
         if other.balance < amount:
             return f"{fail_msg}\n{bet.describe_now()}\n{other.fmt()} does not have enough money: {other.balance}"
-        self.current_bets.append(bet)
+        self.add_bet(bet)
         user.balance -= amount
         return f"{bet.describe_now()}\n${amount} has been subtracted from {user.fmt()}'s account\nWill {other.fmt()} accept?"
 
     def cmd_reject_bet(self: Bank, user: User, against: str | None):
         if against == None:
             return "Error: 'against' is invalid"
-        for i in range(len(self.current_bets)):
-            bet = self.current_bets[i]
-            # if this bet pertains to user and against
-            if bet.p1 == user.id and bet.p2 == against or bet.p2 == user.id and bet.p1 == against:
-                if not bet.pending:
-                    # interpret this as a cancelation request
-                    return self.cmd_cancel_bet(user, against)
-                elif bet.p2 == user.id:
-                    bet.p2_cancel = True
-                    refund_text = self.cancel_bet(user.id, against)
-                    return f"{user.fmt()} rejected the request with {format_user(against)}\n{refund_text}"
-                else:
-                    # if pending and is p1
-                    # interpret this as a cancelation request
-                    return self.cmd_cancel_bet(user, against)
-        return f"There is no bet between you and {format_user(against)}"
+        bet = self.get_bet(user.id, against)
+        if bet is None:
+            return f"There is no bet between you and {format_user(against)}"
+        if not bet.pending:
+            # interpret this as a cancelation request
+            return self.cmd_cancel_bet(user, against)
+        elif bet.p2 == user.id:
+            bet.p2_cancel = True
+            refund_text = self.cancel_bet(user.id, against)
+            return f"{user.fmt()} rejected the request with {format_user(against)}\n{refund_text}"
+        else:
+            # if pending and is p1
+            # interpret this as a cancelation request
+            return self.cmd_cancel_bet(user, against)
 
     def cmd_cancel_bet(self: Bank, user: User, against: str | None):
         if against == None:
             return "Error: 'against' is invalid"
-        for i in range(len(self.current_bets)):
-            bet = self.current_bets[i]
-            # if this bet pertains to user and against
-            if bet.p1 == user.id and bet.p2 == against or bet.p2 == user.id and bet.p1 == against:
-                if bet.p1 == user.id:
-                    bet.p1_cancel = True
-                if bet.p2 == user.id:
-                    bet.p2_cancel = True
-                refund_text = ""
-                if bet.pending or bet.p1_cancel and bet.p2_cancel:
-                    refund_text = self.cancel_bet(user.id, against)
-                if bet.pending:
-                    return f"{user.fmt()} cancelled a bet request with {format_user(against)}\n{refund_text}"
-                elif bet.p1_cancel and bet.p2_cancel:
-                    # if bet is already made but other agreed to cancel
-                    return f"{user.fmt()} agreed to cancel a bet with {format_user(against)}\n{refund_text}"
-                else:
-                    #if not pending and one of the two hasn't canceled
-                    return f"{user.fmt()} is requesting to cancel a bet with {format_user(against)}"
-        return f"There is no bet between you and {format_user(against)}"
+        bet = self.get_bet(user.id, against)
+        if bet is None:
+            return f"There is no bet between you and {format_user(against)}"
+        if bet.p1 == user.id:
+            bet.p1_cancel = True
+        if bet.p2 == user.id:
+            bet.p2_cancel = True
+        refund_text = ""
+        if bet.pending or bet.p1_cancel and bet.p2_cancel:
+            refund_text = self.cancel_bet(user.id, against)
+        if bet.pending:
+            return f"{user.fmt()} cancelled a bet request with {format_user(against)}\n{refund_text}"
+        elif bet.p1_cancel and bet.p2_cancel:
+            # if bet is already made but other agreed to cancel
+            return f"{user.fmt()} agreed to cancel a bet with {format_user(against)}\n{refund_text}"
+        else:
+            #if not pending and one of the two hasn't canceled
+            return f"{user.fmt()} is requesting to cancel a bet with {format_user(against)}"
 
     def cmd_accept_bet(self: Bank, user: User, against: str | None):
         if against == None:
             return "Error: 'against' is invalid"
-        for i in range(len(self.current_bets)):
-            bet = self.current_bets[i]
-            # if user this bet pertains to user and against
-            if bet.p1 == user.id and bet.p2 == against or bet.p2 == user.id and bet.p1 == against:
-                if not bet.pending:
-                    return f"Bet with {format_user(against)} is already accepted"
-                elif bet.p2 == user.id:
-                    # is p2 and bet is pending
-                    bet.pending = False
-                    bet.start_time = datetime.datetime.now()
-                    user.balance -= bet.amount
-                    return f"Bet with {format_user(against)} accepted!\n" +\
-                            f"${bet.amount} has been subtracted from {user.fmt()}'s account\n" +\
-                            f"Bet info:\n{bet.describe_now()}"
-                else:
-                    # is p1 and bet is pending
-                    return f"Waiting for {format_user(against)} to accept"
-        return f"There is no bet between you and {format_user(against)}"
+        bet = self.get_bet(user.id, against)
+        if bet is None:
+            return f"There is no bet between you and {format_user(against)}"
+        if not bet.pending:
+            return f"Bet with {format_user(against)} is already accepted"
+        elif bet.p2 == user.id:
+            # is p2 and bet is pending
+            bet.pending = False
+            bet.start_time = datetime.datetime.now()
+            self.schedule_expiry(bet)
+            user.balance -= bet.amount
+            return f"Bet with {format_user(against)} accepted!\n" +\
+                    f"${bet.amount} has been subtracted from {user.fmt()}'s account\n" +\
+                    f"Bet info:\n{bet.describe_now()}"
+        else:
+            # is p1 and bet is pending
+            return f"Waiting for {format_user(against)} to accept"
 
     def cmd_decide_bet(self: Bank, user: User, victor: str | None, loser: str | None):
         if victor == None:
             return "Error: 'victor' is invalid"
         if loser == None:
             return "Error: 'loser' is invalid"
-        for i in range(len(self.current_bets)):
-            bet = self.current_bets[i]
-            # if this bet pertains to user and against
-            if bet.p1 == victor and bet.p2 == loser or bet.p2 == victor and bet.p1 == loser:
-                if user.id != bet.arbitrator:
-                    return f"You are not the arbitrator for this bet"
-                elif bet.pending:
-                    return f"You must wait until this bet is accepted before arbitrating"
-                else:
-                    victor_user = self.get_user(victor)
-                    bet.end_time = datetime.datetime.now()
-                    if bet.p1 == victor:
-                        bet.p1_won = True
-                    else:
-                        bet.p1_won = False
-                    victor_user.balance += bet.amount * 2
-                    awarded_text = f"${bet.amount * 2} has been awarded to {format_user(victor)}"
-                    self.history.append(bet)
-                    del self.current_bets[i]
-                    return f"{format_user(bet.arbitrator)} has decided that {format_user(victor)} " +\
-                            f"has won their bet with {format_user(loser)}!\nCondition: {bet.condition}\n{awarded_text}"
-        return f"There is no bet between {format_user(victor)} and {format_user(loser)}"
+        bet = self.get_bet(victor, loser)
+        if bet is None:
+            return f"There is no bet between {format_user(victor)} and {format_user(loser)}"
+        if user.id != bet.arbitrator:
+            return f"You are not the arbitrator for this bet"
+        elif bet.pending:
+            return f"You must wait until this bet is accepted before arbitrating"
+        else:
+            victor_user = self.get_user(victor)
+            bet.end_time = datetime.datetime.now()
+            if bet.p1 == victor:
+                bet.p1_won = True
+            else:
+                bet.p1_won = False
+            victor_user.balance += bet.amount * 2
+            self.record_result(bet, victor)
+            awarded_text = f"${bet.amount * 2} has been awarded to {format_user(victor)}"
+            self.settle_bet(bet)
+            return f"{format_user(bet.arbitrator)} has decided that {format_user(victor)} " +\
+                    f"has won their bet with {format_user(loser)}!\nCondition: {bet.condition}\n{awarded_text}"
+
+    def cmd_leaderboard(self: Bank, user: User):
+        ranked = sorted(self.leaders.items(), key=lambda item: (-item[1], item[0]))[:LEADERBOARD_SIZE]
+        if len(ranked) == 0:
+            return "Nobody has any money yet"
+        text = "Leaderboard:"
+        for i, (id, balance) in enumerate(ranked):
+            text += f"\n{i + 1}. {format_user(id)} ${balance}"
+        return text
+
+    def cmd_stats(self: Bank, user: User, target: str | None):
+        if target is not None:
+            user = self.get_user(target)
+        sign = "+" if user.net >= 0 else "-"
+        return f"Stats for {user.fmt()}\n" +\
+               f"Balance: ${user.balance}\n" +\
+               f"Bets won: {user.wins}, lost: {user.losses}, cancelled: {user.cancelled}\n" +\
+               f"Net winnings: {sign}${abs(user.net)}"
+
+    def cmd_history(self: Bank, user: User, target: str | None, page: int | None):
+        id = user.id if target is None else target
+        page = 1 if page is None else page
+        if page < 1:
+            return "Page must be at least 1"
+        total, bets = self.user_history(id, (page - 1) * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+        if total == 0:
+            return f"{format_user(id)} has no settled bets"
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        if page > pages:
+            return f"{format_user(id)} only has {pages} page{'s' if pages > 1 else ''} of settled bets"
+        entries = (f"{bet.end_time:%Y-%m-%d} {bet.describe_history()}" for bet in bets)
+        return fill_message(f"Settled bets of {format_user(id)}, page {page} of {pages}:", entries, len(bets))
+
+    def cmd_pending(self: Bank, user: User):
+        bets = sorted(self.bets_arbitrated_by(user.id), key=lambda bet: bet.start_time)
+        if len(bets) == 0:
+            return f"There are no bets for {user.fmt()} to decide"
+        waiting = [bet.describe_now() for bet in bets if not bet.pending]
+        not_accepted = [bet.describe_now() for bet in bets if bet.pending]
+        text = f"Bets waiting for {user.fmt()} to decide: {len(waiting)}"
+        for description in waiting:
+            text += f"\n\n{description}"
+        if len(not_accepted) > 0:
+            text += f"\n\nNot yet accepted: {len(not_accepted)}"
+            for description in not_accepted:
+                text += f"\n\n{description}"
+        return text
+
+# subcommand name -> Bank method, looked up once so a missing handler fails at import
+HANDLERS = {subcommand.name: getattr(Bank, subcommand.handler) for subcommand in commands.SUBCOMMANDS}
+
+@dataclass
+class CachedBank:
+    stamp: tuple
+    bank: Bank
+    records: int # journal records on disk behind the snapshot
+
+    def size(self):
+        return sum(stat[2] for stat in self.stamp[1:] if stat is not None)
+
+# running totals for this container
+counters = {
+    "bank_conflicts": 0,
+    "writes_skipped": 0, # commands that left the bank clean, so nothing was written or fsynced
+}
+
+# guild id -> parsed bank, least recently used first
+bank_cache: OrderedDict[str, CachedBank] = OrderedDict()
+
+def file_stat(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # os.replace swaps the inode, so a rewrite is caught even if size and mtime match
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def bank_stamp(server_id: str, generation: int):
+    # the generation catches every write through server(); the file stats also catch
+    # anything that rewrote the files some other way
+    return (generation, file_stat(server_file(server_id)), file_stat(journal_file(server_id)))
+
+def take_cached_bank(server_id: str, stamp: tuple):
+    # the entry leaves the cache while a command holds it, so a failed command
+    # can never leave a half-mutated bank behind for the next invocation
+    entry = bank_cache.pop(server_id, None)
+    if entry is not None and entry.stamp == stamp:
+        if metrics.LOG_EVENTS:
+            print("Using cached bank")
+        return entry
+    return None
+
+def put_cached_bank(server_id: str, entry: CachedBank):
+    bank_cache[server_id] = entry
+    total = sum(cached.size() for cached in bank_cache.values())
+    while len(bank_cache) > BANK_CACHE_ENTRIES or (len(bank_cache) > 0 and total > BANK_CACHE_BYTES):
+        _, evicted = bank_cache.popitem(last=False)
+        total -= evicted.size()
+
+class BankConflict(Exception):
+    # another invocation wrote the bank between an optimistic read and its write
+    pass
+
+def read_generation(lock: int):
+    data = os.pread(lock, GENERATION_WIDTH, 0)
+    return int(data) if len(data) > 0 else 0
+
+def write_generation(lock: int, generation: int):
+    os.pwrite(lock, f"{generation:0{GENERATION_WIDTH}d}".encode(), 0)
+
+def server(server_id: str, optimistic: bool = False):
+    # a with block over the guild's bank from whichever storage STORAGE picks. the bank is
+    # written back when the block ends, unless it raised. with optimistic, BankConflict is
+    # raised instead if another invocation wrote the bank in the meantime
+    return STORAGE_BACKENDS[STORAGE](server_id, optimistic)
 
 @contextmanager
-def server(server_id: str):
-    os.makedirs(BANK_DIR, exist_ok=True)
-    with open(server_file(server_id), "a+", encoding='utf-8') as file:
-        if file.tell() > 0:
-            file.seek(0, SEEK_SET)
-            version = read_version(file)
-            print(f"Found bank with version {version}")
-            if version != "empty":
-                json = fix_bank_json(version, file.read())
-                bank = cast(Bank, Bank.from_json(json))
+def file_server(server_id: str, optimistic: bool = False, compact: bool = False):
+    # the bank file is a snapshot; with JOURNAL on, every command since then is a line in the journal.
+    # <guild>.lock is flocked around reads and writes of the bank, so guilds never wait on each
+    # other, and holds a generation counter that goes up with every write.
+    # normally the lock is held exclusively for the whole command. with optimistic, it is only
+    # held shared while reading, and if the bank was written by the time the command is done,
+    # BankConflict is raised and nothing is written.
+    # with compact, a fresh snapshot is written even if nothing changed, folding in the journal
+    lock = open_guild_lock(server_id, fcntl.LOCK_SH if optimistic else fcntl.LOCK_EX)
+    try:
+        with metrics.phase("load"):
+            generation = read_generation(lock)
+            stamp = bank_stamp(server_id, generation)
+            entry = take_cached_bank(server_id, stamp)
+            metrics.put("cacheHit", 0 if entry is None else 1)
+            rewrite = compact
+            if entry is None:
+                bank, records, upgraded = read_file_bank(server_id)
+                # an upgraded bank is written back straight away so the upgrade only happens once
+                rewrite = rewrite or upgraded
+                entry = CachedBank(stamp, bank, records)
+        if optimistic:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        bank = entry.bank
+        if metrics.enabled():
+            record_bank_size(entry)
+
+        # if the command raises, nothing is written
+        yield bank
+
+        bank.update_leaders()
+        if not bank.is_dirty() and not rewrite:
+            counters['writes_skipped'] += 1
+            metrics.put("writeSkipped", 1)
+            bank.mark_clean()
+            put_cached_bank(server_id, entry)
+            return
+        with metrics.phase("persist"):
+            settled = bank.unrecorded + take_settled_bets(bank)
+            record = journal_record(bank)
+
+            if optimistic:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if read_generation(lock) != generation:
+                    raise BankConflict(f"Bank {server_id} was written by another invocation")
+            commands = entry.records + 1 # since the last snapshot, this one included
+            compact = not JOURNAL or commands >= JOURNAL_COMPACT_ENTRIES or rewrite
+            # settled bets are in the journal before they are on the history, even when the journal
+            # is about to be folded into a snapshot, so if the invocation dies in between, whoever
+            # reads the bank next finds them with unrecorded_bets and appends them
+            if len(settled) > 0:
+                record['settled'] = settled
+                record['historyAt'] = list(history_end(history_dir(server_id)))
+            if not compact or len(settled) > 0:
+                append_journal(journal_file(server_id), [record])
+                entry.records += 1
+            append_history(server_id, settled, reindex=rewrite)
+            bank.unrecorded = []
+            if compact:
+                if rewrite:
+                    print("Writing upgraded bank")
+                elif JOURNAL:
+                    print(f"Compacting {commands} journal records into snapshot")
+                write_snapshot(server_file(server_id), bank)
+                # replaying a record on top of a snapshot that already has it is harmless,
+                # so a crash between these two steps loses nothing
+                if os.path.exists(journal_file(server_id)):
+                    os.remove(journal_file(server_id))
+                entry.records = 0
+            bank.mark_clean()
+            write_generation(lock, generation + 1)
+            entry.stamp = bank_stamp(server_id, generation + 1)
+            put_cached_bank(server_id, entry)
+    finally:
+        # closing the descriptor drops the lock
+        os.close(lock)
+
+def read_file_bank(server_id: str, extra_records: list[dict] = []):
+    # the guild's snapshot with its journal and then extra_records replayed on top. returns the
+    # bank, how many journal records were on disk, and whether the files are out of date
+    # (an old version, history still in the snapshot, stats to backfill or settled bets missing from the history)
+    obj, source, migrated = read_snapshot(server_file(server_id))
+    records = read_journal(journal_file(server_id))
+    apply_journal_records(obj, records + extra_records)
+    if source is None and obj == empty_bank_json():
+        obj = new_bank_json()
+    bank, moved_history = load_bank(server_id, obj)
+    upgraded = migrated or moved_history
+    bank.user_source = source
+    bank.snapshot_format = "json" if source is None else "binary"
+    if bank.stats_version < STATS_VERSION:
+        bank.backfill_stats()
+        upgraded = True
+    missing = unrecorded_bets(bank.history_dir, records)
+    if len(missing) > 0:
+        print(f"Found {len(missing)} settled bets missing from the history")
+        bank.unrecorded = bank.unrecorded + missing
+        upgraded = True
+    return bank, len(records), upgraded
+
+# built on first use and kept for the life of the container
+sqlite_connection = None
+
+@contextmanager
+def sqlite_server(server_id: str, optimistic: bool = False):
+    # nothing is read up front: users and open bets are read as the command asks for them,
+    # and only the rows it changed are written, in the same transaction as the reads.
+    # optimistic commands read in a deferred transaction, which fails to write if another
+    # invocation wrote in between; the others take the database's write lock first
+    global sqlite_connection
+    import sqlite3
+    import sqlbank
+    if sqlite_connection is None:
+        sqlite_connection = sqlbank.connect(SQLITE_PATH)
+    store = sqlbank.GuildStore(sqlite_connection, server_id)
+    try:
+        with metrics.phase("load"):
+            store.begin(immediate=not optimistic)
+            fields = store.bank_fields()
+            if len(fields) == 0 and store.user_count == 0:
+                obj = new_bank_json()
             else:
-                bank = Bank({}, [], [])
-        else:
-            print("No bank found")
-            bank = Bank({}, [], [])
+                obj = {"users": {}, "currentBets": [], "history": [], **fields}
+            bank = Bank.from_dict(obj)
+            bank.user_source = store
+            bank.bet_source = store
+            if bank.stats_version < STATS_VERSION:
+                bank.backfill_stats()
+
+        # if the command raises, nothing is written
+        yield bank
 
+        bank.update_leaders()
+        if not bank.is_dirty():
+            counters['writes_skipped'] += 1
+            metrics.put("writeSkipped", 1)
+            store.commit()
+            return
+        with metrics.phase("persist"):
+            users = [user_record(user) for user in bank.dirty_users().values()]
+            fields = bank.extra_fields() if bank.fields_dirty() else None
+            removed, changed = bank.changed_bets()
+            settled = take_settled_bets(bank)
+            try:
+                store.write(users, removed, [bet.to_dict() for bet in changed], settled, fields)
+                store.commit()
+                metrics.add("writtenRows", len(users) + len(removed) + len(changed) + len(settled))
+            except sqlite3.OperationalError as e:
+                if optimistic and sqlbank.is_busy(e):
+                    raise BankConflict(f"Bank {server_id} was written by another invocation")
+                raise
+        bank.mark_clean()
+    finally:
+        store.rollback()
+
+@dataclass
+class ResidentBank:
+    bank: Bank
+    generation: int # of the guild's lock file when the bank was last read or written
+    records: list[dict] = field(default_factory=list) # commands since the last snapshot, as journal records
+    upgraded: bool = False # the files are out of date even if no command has run
+
+# guild id -> bank kept in memory by a long-running process, see resident_server
+resident_banks: Dict[str, ResidentBank] = {}
+
+def load_resident(server_id: str):
+    # reads the guild into resident_banks if it isn't there yet. like file_server, an upgraded
+    # bank is written back straight away so the upgrade only happens once
+    entry = resident_banks.get(server_id)
+    if entry is not None:
+        return entry
+    lock = open_guild_lock(server_id, fcntl.LOCK_SH)
+    try:
+        generation = read_generation(lock)
+        bank, _, upgraded = read_file_bank(server_id)
+    finally:
+        os.close(lock)
+    entry = ResidentBank(bank, generation, upgraded=upgraded)
+    resident_banks[server_id] = entry
+    if upgraded:
+        snapshot_resident(server_id)
+    return entry
+
+def snapshot_resident(server_id: str):
+    # writes a resident bank to its files if anything changed since they were read: a fresh
+    # snapshot with the old journal folded in, and the bets settled since go on the history.
+    # returns whether anything was written
+    entry = resident_banks[server_id]
+    bank = entry.bank
+    if len(entry.records) == 0 and len(bank.history) == 0 and not entry.upgraded:
+        return False
+    lock = open_guild_lock(server_id, fcntl.LOCK_EX)
+    try:
+        generation = read_generation(lock)
+        if generation != entry.generation:
+            print(f"Bank {server_id} was written by another process since it was read, overwriting it")
+        # settled bets go to the history segments, not the snapshot. as in file_server, the
+        # commands that settled them are journaled first, so a crash before the history has
+        # them loses nothing
+        settled = bank.unrecorded + [bet.to_dict() for bet in bank.history]
+        records = entry.records
+        if len(settled) > 0:
+            last = records[-1] if len(records) > 0 else {}
+            records = records[:-1] + [{**last, 'settled': settled,
+                                       'historyAt': list(history_end(history_dir(server_id)))}]
+        if len(records) > 0:
+            append_journal(journal_file(server_id), records)
+        append_history(server_id, settled, reindex=entry.upgraded)
+        bank.unrecorded = []
+        bank.history = []
+        write_snapshot(server_file(server_id), bank)
+        if os.path.exists(journal_file(server_id)):
+            os.remove(journal_file(server_id))
+        bank.mark_clean()
+        write_generation(lock, generation + 1)
+        entry.generation = generation + 1
+        entry.records = []
+        entry.upgraded = False
+    finally:
+        os.close(lock)
+    return True
+
+@contextmanager
+def resident_server(server_id: str, optimistic: bool = False):
+    # for a long-running process (see local_server.py): banks are read once and kept in
+    # resident_banks, and nothing is written per command. each command's changes are kept as
+    # a journal record until snapshot_resident writes the bank out, so a crash loses every
+    # command since the last snapshot. callers run one command per guild at a time
+    entry = load_resident(server_id)
+    bank = entry.bank
+    # the guild may have been moved into its shard since it was read
+    bank.history_dir = history_dir(server_id)
+    settled = len(bank.history)
+    try:
+        yield bank
+    except Exception:
+        # the command may have left the bank half-changed. read it again, with every
+        # command that did finish replayed on top
+        restored, _, _ = read_file_bank(server_id, entry.records)
+        restored.history = bank.history[:settled]
+        entry.bank = restored
+        raise
+    bank.update_leaders()
+    record = journal_record(bank)
+    if len(record) > 0:
+        entry.records.append(record)
+    bank.mark_clean()
+
+# the ways a bank can be stored, by STORAGE setting
+STORAGE_BACKENDS = {
+    "files": file_server,
+    "sqlite": sqlite_server,
+    "resident": resident_server,
+}
+
+def record_bank_size(entry: CachedBank):
+    bank = entry.bank
+    metrics.put("users", bank.user_count())
+    metrics.put("openBets", len(bank.current_bets))
+    metrics.put("journalRecords", entry.records)
+    metrics.put("settledBets", bank.settled_count)
+
+def with_bank(server_id: str, command):
+    # runs command(bank) against the guild's bank and returns what it returns.
+    # the first attempts are optimistic, so the command may run more than once
+    # and must not have effects outside the bank it is given
+    for attempt in range(OPTIMISTIC_RETRIES + 1):
         try:
-            yield bank
-        except Exception as e:
-            # don't write to file
-            raise e
-        else:
-            file.seek(0, SEEK_SET)
-            file.truncate(0)
-            file.write(VERSION + '\n')
-            file.write(bank.to_json())
+            with server(server_id, optimistic=attempt < OPTIMISTIC_RETRIES) as bank:
+                expired = bank.expire_bets()
+                if len(expired) > 0:
+                    print(f"Expired {len(expired)} bets")
+                    metrics.add("expiredBets", len(expired))
+                result = command(bank)
+            return result
+        except BankConflict as e:
+            counters['bank_conflicts'] += 1
+            metrics.add("conflicts", 1)
+            print(f"{e}, retrying")
+
+def empty_bank_json():
+    return {"users": {}, "currentBets": [], "history": []}
+
+def new_bank_json():
+    # a bank nothing has been written to yet has no stats to backfill
+    return {**empty_bank_json(), "statsVersion": STATS_VERSION}
+
+def load_bank(server_id: str, obj: dict):
+    # settled bets belong in the history segments, not in the bank file. anything still in
+    # the file's history list predates segments, and the file must be rewritten. nothing is
+    # written here, since the guild may only be locked shared: the bets are left unrecorded,
+    # for the write to put on the history under the exclusive lock. if segments exist already,
+    # they were moved there by a write that crashed before rewriting the file
+    legacy = obj['history']
+    obj['history'] = []
+    bank = Bank.from_dict(obj)
+    bank.history_dir = history_dir(server_id)
+    if len(legacy) > 0 and len(history_segments(bank.history_dir)) == 0:
+        print(f"Moving {len(legacy)} settled bets into history segments")
+        bank.unrecorded = legacy
+    return bank, len(legacy) > 0
+
+def read_snapshot(path: str):
+    # returns the bank as JSON, a BinaryBank to read users from if the snapshot is binary,
+    # and whether the snapshot was on an old version and should be written back.
+    # binary snapshots leave "users" empty; users are read from the file as they are asked for
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        if metrics.LOG_EVENTS:
+            print("No bank found")
+        return empty_bank_json(), None, False
+    with open(path, "rb") as file:
+        version = read_version(file)
+        if metrics.LOG_EVENTS:
+            print(f"Found bank with version {version}")
+        if version == "empty":
+            return empty_bank_json(), None, False
+        if version in binbank.BINARY_VERSIONS:
+            # only the pages that get touched are actually read
+            metrics.add("mappedBytes", os.path.getsize(path))
+            source = binbank.BinaryBank(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), file.tell(), version)
+            obj = {"users": {}, "currentBets": source.current_bets(), "history": source.history(), **source.extra()}
+            return obj, source, version != binbank.BINARY_VERSION
+        data = file.read()
+        metrics.add("readBytes", file.tell())
+        obj = json.loads(data)
+        if version != VERSION:
+            migrate_bank(path, version, obj)
+            return obj, None, True
+        return obj, None, False
+
+def write_snapshot(path: str, bank: Bank):
+    format = BANK_FORMAT or bank.snapshot_format
+    if format == "binary":
+        users = bank_user_records(bank)
+        data = (binbank.BINARY_VERSION + '\n').encode() + \
+               binbank.encode(users, [bet.to_dict() for bet in bank.current_bets], [bet.to_dict() for bet in bank.history],
+                              bank.extra_fields())
+    else:
+        bank.materialize()
+        data = (VERSION + '\n' + bank.to_json()).encode('utf-8')
+    write_file_atomic(path, data)
+    bank.snapshot_format = format
+
+def write_file_atomic(path: str, data: bytes):
+    # write beside the old file and swap, so readers never see a half-written one
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as file:
+        file.write(data)
+        metrics.add("writtenBytes", len(data))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+def bank_user_records(bank: Bank):
+    # (id, balance, last paycheck) for every user, without building User objects for the
+    # ones that were never read out of a binary snapshot
+    users = {}
+    if bank.user_source is not None:
+        for record in bank.user_source.user_records():
+            users[record[0]] = record
+    for id, user in bank.users.items():
+        users[id] = user_record(user)
+    return list(users.values())
+
+def read_journal(path: str):
+    records = []
+    if not os.path.exists(path):
+        return records
+    metrics.add("readBytes", os.path.getsize(path))
+    with open(path, "r", encoding='utf-8') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a record torn by a crashed invocation, whose command never completed. the
+                # next append starts on a new line, so records after it are still read
+                print(f"Ignoring unreadable journal record in {path}")
+                continue
+    return records
+
+def append_journal(path: str, records: list[dict]):
+    data = ''.join(json.dumps(record) + '\n' for record in records)
+    metrics.add("writtenBytes", len(data.encode('utf-8')))
+    with open(path, "a+", encoding='utf-8') as file:
+        if file.tell() > 0:
+            # don't glue onto a record torn by a crashed append, which read_journal would stop at
+            file.seek(file.tell() - 1, SEEK_SET)
+            if file.read(1) != '\n':
+                file.write('\n')
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+def journal_record(bank: Bank):
+    # records hold whole users, and the pairs of closed bets with each new or changed bet whole,
+    # so replaying one twice is harmless and a record stays the size of what the command touched
+    record = {}
+    changed = {id: user.to_dict() for id, user in bank.dirty_users().items()}
+    if len(changed) > 0:
+        record['users'] = changed
+    if bank.bets_dirty():
+        closed, bets = bank.changed_bets()
+        if len(closed) > 0:
+            record['closedBets'] = [list(key) for key in sorted(closed)]
+        if len(bets) > 0:
+            record['bets'] = [bet.to_dict() for bet in bets]
+    if bank.fields_dirty():
+        record['fields'] = bank.extra_fields()
+    return record
+
+def apply_journal_records(obj: dict, records: list[dict]):
+    # open bets by pair, as a position in obj['currentBets'], built once for all the records
+    bets = obj['currentBets']
+    positions = {bet_key(bet['p1'], bet['p2']): i for i, bet in enumerate(bets)}
+    for record in records:
+        obj['users'].update(record.get('users', {}))
+        if 'currentBets' in record:
+            # journals written before per-bet records carried the whole open bet list
+            bets = obj['currentBets'] = record['currentBets']
+            positions = {bet_key(bet['p1'], bet['p2']): i for i, bet in enumerate(bets)}
+        # closes come first: a bet closed and opened again between the same users is in both
+        for p1, p2 in record.get('closedBets', []):
+            i = positions.pop(bet_key(p1, p2), None)
+            if i is None:
+                continue
+            last = bets.pop()
+            if i < len(bets):
+                bets[i] = last
+                positions[bet_key(last['p1'], last['p2'])] = i
+        for bet in record.get('bets', []):
+            key = bet_key(bet['p1'], bet['p2'])
+            if key in positions:
+                bets[positions[key]] = bet
+            else:
+                positions[key] = len(bets)
+                bets.append(bet)
+        obj.update(record.get('fields', {}))
+        if 'history' in record:
+            # journals written before history segments carried settled bets too
+            obj['history'][record['historyStart']:] = record['history']
+
+def history_segments(dir: str):
+    if not os.path.isdir(dir):
+        return []
+    return sorted(name for name in os.listdir(dir) if name.isdigit())
+
+def segment_name(number: int):
+    return f"{number:06d}"
+
+def take_settled_bets(bank: Bank):
+    settled = [bet.to_dict() for bet in bank.history]
+    bank.history.clear()
+    return settled
+
+def history_end(dir: str):
+    # the position the next settled bet is appended at, give or take a segment that is full
+    segments = history_segments(dir)
+    if len(segments) == 0:
+        return (0, 0)
+    return (int(segments[-1]), os.path.getsize(f"{dir}/{segments[-1]}"))
+
+def unrecorded_bets(dir: str, records: list[dict]):
+    # the settled bets of the newest journal record that has any, less those that made it onto
+    # the history after its historyAt: the ones its invocation died before appending. each
+    # write finishes its history before the next one starts, so older records are complete
+    for record in reversed(records):
+        if 'settled' in record:
+            found = sum(1 for _, _, bet in scan_history(dir, tuple(record['historyAt'])) if bet is not None)
+            return record['settled'][found:]
+    return []
+
+def append_history(server_id: str, bets: list[dict], reindex: bool = False):
+    # history is append-only: bets go on the end of the newest segment until it is full, and
+    # then into the index. commands that settle nothing don't touch the history at all, unless
+    # reindex asks for the index to catch up anyway: for history from before the index, or an
+    # index update a crash cut short, which read_user_history scans past until then
+    dir = history_dir(server_id)
+    if len(bets) > 0:
+        append_history_segment(dir, bets)
+    if len(bets) > 0 or reindex:
+        index_history(dir)
+
+def append_history_segment(dir: str, bets: list[dict]):
+    os.makedirs(dir, exist_ok=True)
+    segments = history_segments(dir)
+    if len(segments) == 0:
+        segment = segment_name(0)
+    elif os.path.getsize(f"{dir}/{segments[-1]}") >= HISTORY_SEGMENT_BYTES:
+        segment = segment_name(int(segments[-1]) + 1)
+    else:
+        segment = segments[-1]
+    with open(f"{dir}/{segment}", "a+", encoding='utf-8') as file:
+        if file.tell() > 0:
+            # don't glue onto a line torn by a crashed append
+            file.seek(file.tell() - 1, SEEK_SET)
+            if file.read(1) != '\n':
+                file.write('\n')
+        start = file.tell()
+        for bet in bets:
+            file.write(json.dumps(bet) + '\n')
+        metrics.add("writtenBytes", file.tell() - start)
+        file.flush()
+        os.fsync(file.fileno())
+
+def read_history(dir: str):
+    for segment in history_segments(dir):
+        with open(f"{dir}/{segment}", "r", encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield Bet.from_dict(json.loads(line))
+                except ValueError:
+                    print(f"Skipping unreadable history entry in {dir}/{segment}")
+
+# where a settled bet starts in the history: (segment number, byte offset in the segment)
+HISTORY_POSITION = struct.Struct("<IQ")
+
+# the per-user history index. index/<user> lists the positions of every bet the user took part
+# in, oldest first, so a page of it is found with one read wherever it is. indexed holds the
+# position up to which bets have been added to the index; bets after it (normally none, unless
+# the history predates the index or an invocation crashed mid-update) are found by scanning
+def history_index_file(dir: str, user_id: str):
+    return f"{dir}/index/{user_id}"
+
+def read_indexed_position(dir: str):
+    try:
+        with open(f"{dir}/indexed", "rb") as file:
+            return HISTORY_POSITION.unpack(file.read())
+    except (FileNotFoundError, struct.error):
+        return (0, 0)
+
+def scan_history(dir: str, start: tuple[int, int]):
+    # (position, position just past it, bet as JSON or None if unreadable) for each complete
+    # line from start on. a line still being written, or torn by a crash, has no newline yet
+    first, offset = start
+    for segment in history_segments(dir):
+        number = int(segment)
+        if number < first:
+            continue
+        with open(f"{dir}/{segment}", "rb") as file:
+            position = offset if number == first else 0
+            file.seek(position)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    obj = None
+                yield (number, position), (number, position + len(line)), obj
+                position += len(line)
+
+def history_unindexed(dir: str):
+    return next(scan_history(dir, read_indexed_position(dir)), None) is not None
+
+def index_history(dir: str):
+    # adds every bet after the indexed position to its users' index files. must hold the guild's
+    # lock exclusively. an index file may get entries it already has if an earlier update
+    # crashed before moving the indexed position; those are skipped
+    start = read_indexed_position(dir)
+    end = start
+    positions: Dict[str, list[tuple[int, int]]] = {}
+    for position, end, obj in scan_history(dir, start):
+        if obj is not None:
+            for user_id in {obj['p1'], obj['p2']}:
+                positions.setdefault(user_id, []).append(position)
+    if end == start:
+        return
+    os.makedirs(f"{dir}/index", exist_ok=True)
+    for user_id, entries in positions.items():
+        with open(history_index_file(dir, user_id), "a+b") as file:
+            size = file.tell() - file.tell() % HISTORY_POSITION.size
+            file.truncate(size)
+            if size > 0:
+                file.seek(size - HISTORY_POSITION.size)
+                last = HISTORY_POSITION.unpack(file.read(HISTORY_POSITION.size))
+                entries = [position for position in entries if position > last]
+            file.write(b"".join(HISTORY_POSITION.pack(*position) for position in entries))
             file.flush()
+            os.fsync(file.fileno())
+    write_file_atomic(f"{dir}/indexed", HISTORY_POSITION.pack(*end))
+
+def read_user_history(dir: str, user_id: str, skip: int, count: int):
+    # see Bank.user_history
+    indexed = read_indexed_position(dir)
+    recent = [obj for _, _, obj in scan_history(dir, indexed) if obj is not None and user_id in (obj['p1'], obj['p2'])]
+    recent.reverse()
+    try:
+        file = open(history_index_file(dir, user_id), "rb")
+    except FileNotFoundError:
+        return len(recent), recent[skip:skip + count]
+    with file:
+        entries = os.fstat(file.fileno()).st_size // HISTORY_POSITION.size
+        # entries from an update still in progress are past indexed, and already in recent
+        while entries > 0 and HISTORY_POSITION.unpack(os.pread(file.fileno(), HISTORY_POSITION.size,
+                                                               (entries - 1) * HISTORY_POSITION.size)) >= indexed:
+            entries -= 1
+        # counting back from the newest indexed bet
+        first = max(0, skip - len(recent))
+        last = min(entries, skip + count - len(recent))
+        positions = []
+        if last > first:
+            data = os.pread(file.fileno(), (last - first) * HISTORY_POSITION.size, (entries - last) * HISTORY_POSITION.size)
+            metrics.add("readBytes", len(data))
+            positions = list(HISTORY_POSITION.iter_unpack(data))[::-1]
+    bets = recent[skip:skip + count]
+    for number, offset in positions:
+        with open(f"{dir}/{segment_name(number)}", "rb") as segment:
+            segment.seek(offset)
+            line = segment.readline()
+            metrics.add("readBytes", len(line))
+            bets.append(json.loads(line))
+    return len(recent) + entries, bets
 
-def read_version(file: TextIOWrapper):
+def read_version(file: BinaryIO):
     s = ""
     null_char = False
     for _ in range(VERSION_MAX_LENGTH):
         next = file.read(1)
         if len(next) == 0:
             return "empty"
-        if next == "\n":
+        if next == b"\n":
             null_char = True
             break
-        s += next
+        s += next.decode('latin-1')
     if null_char:
         return s
     file.seek(0, SEEK_SET)
     return "first"
 
-def fix_bank_json(version: str, s: str):
-    if version == VERSION:
-        return s
-    else:
-        obj = json.loads(s)
-        print(f"Updating {version} -> {VERSION}")
-        match version:
-            case 'first':
-                for bet in obj.get('currentBets'):
-                    bet['pending'] = True
-                for bet in obj.get('history'):
-                    bet['pending'] = False
-            case '1.0':
-                for bet in obj.get('currentBets'):
-                    bet['p1_cancel'] = False
-                    bet['p2_cancel'] = False
-                for bet in obj.get('history'):
-                    bet['p1_cancel'] = False
-                    bet['p2_cancel'] = False
-            case '1.1':
-                for bet in obj.get('currentBets'):
-                    bet['rejected'] = False
-                for bet in obj.get('history'):
-                    bet['rejected'] = False
-        return json.dumps(obj)
+# each migration upgrades a parsed bank by one version, in place.
+# bets use the same keys Bet.to_dict writes
+def migrate_first(obj: dict):
+    for bet in obj['currentBets']:
+        bet['pending'] = True
+    for bet in obj['history']:
+        bet['pending'] = False
+
+def migrate_1_0(obj: dict):
+    for bet in obj['currentBets'] + obj['history']:
+        bet['p1Cancel'] = False
+        bet['p2Cancel'] = False
+
+def migrate_1_1(obj: dict):
+    for bet in obj['currentBets'] + obj['history']:
+        bet['rejected'] = False
+
+# version -> (version it upgrades to, migration)
+MIGRATIONS = {
+    "first": ("1.0", migrate_first),
+    "1.0": ("1.1", migrate_1_0),
+    "1.1": ("1.2", migrate_1_1),
+}
+
+def report_migration(path: str, version: str, seconds: float):
+    print(f"Migrated {path} from {version} to {VERSION} in {seconds * 1000:.1f}ms")
+    metrics.add("migrateMs", seconds * 1000)
+    metrics.tag("migratedFrom", version)
+
+# called whenever a bank on an old version is loaded, so guilds that are still behind show up
+migration_hook = report_migration
+
+def migrate_bank(path: str, version: str, obj: dict):
+    # runs every step from version up to VERSION over the already-parsed bank
+    start = time.perf_counter()
+    found = version
+    while version != VERSION and version in MIGRATIONS:
+        version, migrate = MIGRATIONS[version]
+        migrate(obj)
+    if version != VERSION:
+        print(f"No migration from {version} to {VERSION}, loading as is")
+    migration_hook(path, found, time.perf_counter() - start)
 
 # def test():
 #     # with open("test", "a+", encoding="utf-8") as file:
@@ -558,14 +2195,15 @@ def fix_bank_json(version: str, s: str):
 # 
 # test()
 
+# TIMEZONE is a zone name or a zoneinfo.ZoneInfo, whose str() is its name. pytz isn't a
+# dependency any more, so a pytz timezone in public_key fails to import
+def get_timezone():
+    return ZoneInfo(str(TIMEZONE))
 def get_next_midnight():
-    today = datetime.datetime.now(pytz.timezone("America/New_York")) \
-                .replace(hour=0,minute=0,second=0,microsecond=0)
-    date = today.date() + datetime.timedelta(days=1)
-    dt = datetime.datetime.combine(date=date, time=today.time(), tzinfo=today.tzinfo)
-    return dt.astimezone(pytz.utc).replace(tzinfo=None)
+    today = datetime.datetime.now(get_timezone()).date()
+    dt = datetime.datetime.combine(date=today + datetime.timedelta(days=1), time=datetime.time(), tzinfo=get_timezone())
+    return dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 def get_prev_midnight():
-    return datetime.datetime.now(pytz.timezone("America/New_York")) \
-            .replace(hour=0,minute=0,second=0,microsecond=0) \
-            .astimezone(pytz.utc) \
-            .replace(tzinfo=None)
+    today = datetime.datetime.now(get_timezone()).date()
+    dt = datetime.datetime.combine(date=today, time=datetime.time(), tzinfo=get_timezone())
+    return dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
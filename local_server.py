@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# runs the bot as a long-running HTTP server instead of behind API Gateway and Lambda, for
+# self-hosting: point the application's Interactions Endpoint URL at it (behind something that
+# terminates TLS). interactions are verified and answered by the same code as in lambda_handler,
+# redeliveries included.
+#
+# banks are read once and stay in memory (STORAGE "resident", see lambda_function.resident_server),
+# so a command doesn't pay for reading and writing its bank. commands run one at a time per guild,
+# and different guilds run side by side: commands, reading a guild that isn't in memory yet and
+# writing snapshots all happen on worker threads, since each can block on the disk or on a guild's
+# file lock held by another process, and the event loop only parses requests and verifies them.
+# every guild that changed is snapshotted to BANK_DIR every --snapshot-seconds and on SIGINT or
+# SIGTERM; a crash loses the commands since the last snapshot.
+# this process must be the only thing writing BANK_DIR while it runs, though offline tools that go
+# through file_server (migrate_banks.py) still wait for each guild's lock
+#
+#   python local_server.py [--host 127.0.0.1] [--port 8080] [--snapshot-seconds 60]
+import argparse
+import asyncio
+import json
+import signal
+import sys
+import lambda_function
+
+MAX_HEADER_BYTES = 16 * 1024 # request line and headers
+MAX_BODY_BYTES = 1024 * 1024 # interactions are a few KB
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+# guild id -> lock held while a command or snapshot uses the guild's bank. waiters get it in the
+# order they asked, so the snapshots at shutdown come after every command already waiting
+guild_locks: dict[str, asyncio.Lock] = {}
+# set once shutdown starts; later interactions would miss the final snapshot
+stopping = False
+# connection task -> its writer, so idle keep-alive connections can be closed at shutdown
+connections: dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+def guild_lock(server_id: str):
+    lock = guild_locks.get(server_id)
+    if lock is None:
+        lock = guild_locks[server_id] = asyncio.Lock()
+    return lock
+
+async def read_request(reader: asyncio.StreamReader):
+    # (method, path, lowercased headers, body), or None once the client has closed the connection
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise HttpError(400, "incomplete request")
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "headers too long")
+    lines = head.decode('latin-1').split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ")
+    except ValueError:
+        raise HttpError(400, f"bad request line: {lines[0]}")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f"body of {length} bytes is too long")
+    body = await reader.readexactly(length)
+    return method, path, headers, body
+
+def write_response(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str = "application/json"):
+    writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                 f"Content-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+
+async def handle_interaction(headers: dict, raw_body: bytes):
+    if stopping:
+        raise HttpError(503, "shutting down")
+    # an event shaped like the one mapping_template.vt makes, so verification is the same
+    event = {
+        "rawBody": raw_body.decode('utf-8'),
+        "params": {"header": {name: headers[name] for name in ("x-signature-ed25519", "x-signature-timestamp") if name in headers}},
+    }
+    try:
+        replayed = lambda_function.verify_interaction(event)
+    except Exception as e:
+        raise HttpError(401, f"Invalid request signature: {e}")
+    try:
+        body = json.loads(event['rawBody'])
+    except ValueError as e:
+        raise HttpError(400, f"body is not JSON: {e}")
+    # redeliveries get the response they got the first time, which may have to be read from disk
+    loop = asyncio.get_running_loop()
+    stored = await loop.run_in_executor(None, lambda_function.stored_response, body)
+    if stored is not None:
+        return stored
+    if replayed:
+        raise HttpError(401, "Invalid request signature: signature has already been used")
+    if lambda_function.ping_pong(body):
+        return lambda_function.PING_PONG
+
+    server_id = body.get('guild_id')
+    async with guild_lock(server_id):
+        if server_id not in lambda_function.resident_banks:
+            # reading a bank is the slow part, so it doesn't hold up other guilds. if it fails,
+            # handle_command tries again and answers with the error
+            try:
+                await loop.run_in_executor(None, lambda_function.load_resident, server_id)
+            except Exception as e:
+                print(f"Failed to load bank {server_id}: {e}")
+        return await loop.run_in_executor(None, lambda_function.handle_command, body)
+
+async def serve_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    task = asyncio.current_task()
+    connections[task] = writer
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, _, headers, body = request
+                if method != "POST":
+                    raise HttpError(405, f"{method} is not supported")
+                resp = await handle_interaction(headers, body)
+                write_response(writer, 200, json.dumps(resp).encode('utf-8'))
+            except HttpError as e:
+                print(f"{e.status} {e}")
+                write_response(writer, e.status, str(e).encode('utf-8'), "text/plain")
+                await writer.drain()
+                break
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        del connections[task]
+        writer.close()
+
+async def snapshot_guild(server_id: str):
+    async with guild_lock(server_id):
+        try:
+            if await asyncio.get_running_loop().run_in_executor(None, lambda_function.snapshot_resident, server_id):
+                print(f"Snapshotted bank {server_id}")
+        except Exception as e:
+            # the changes stay in memory, and are tried again with the next snapshot
+            print(f"Failed to snapshot bank {server_id}: {e}")
+
+async def snapshot_all():
+    await asyncio.gather(*(snapshot_guild(server_id) for server_id in list(lambda_function.resident_banks)))
+
+async def snapshot_periodically(seconds: float, stop: asyncio.Event):
+    # returns once stop is set, but never in the middle of a snapshot
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), seconds)
+            return
+        except asyncio.TimeoutError:
+            await snapshot_all()
+
+async def run(host: str, port: int, snapshot_seconds: float):
+    global stopping
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    server = await asyncio.start_server(serve_connection, host, port, limit=MAX_HEADER_BYTES)
+    snapshots = asyncio.create_task(snapshot_periodically(snapshot_seconds, stop))
+    print(f"Listening on {host}:{port}")
+    await stop.wait()
+    stopping = True
+    server.close()
+    await snapshots
+    print("Shutting down, snapshotting every bank")
+    await snapshot_all()
+    for writer in connections.values():
+        writer.close()
+    await asyncio.gather(*connections, return_exceptions=True)
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(description="serve interactions over HTTP with banks kept in memory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--snapshot-seconds", type=float, default=60, help="how often changed banks are written out")
+    options = parser.parse_args(args)
+
+    lambda_function.STORAGE = "resident"
+    asyncio.run(run(options.host, options.port, options.snapshot_seconds))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# per-invocation timings and sizes, logged as one CloudWatch embedded metric format (EMF)
+# line, which CloudWatch turns into metrics straight from the log without any API calls.
+#
+# settings are environment variables, so they can be changed on the function without a deploy:
+#   BETBOT_METRICS_SAMPLE     fraction of invocations that log a metric line, 0 (off) to 1
+#   BETBOT_METRICS_NAMESPACE  CloudWatch namespace, "betbot" by default
+#   BETBOT_LOG_EVENTS         1 to also print every event and response, and where each bank was
+#                             loaded from, for debugging
+#
+# invocations that aren't sampled collect nothing: every call here returns straight away
+import json
+import os
+import random
+import time
+
+SAMPLE_RATE = float(os.environ.get("BETBOT_METRICS_SAMPLE", "0"))
+NAMESPACE = os.environ.get("BETBOT_METRICS_NAMESPACE", "betbot")
+LOG_EVENTS = os.environ.get("BETBOT_LOG_EVENTS", "") == "1"
+
+class Invocation:
+    def __init__(self):
+        self.values: dict[str, float] = {}
+        self.dimensions: dict[str, str] = {"Command": "unknown"}
+        # logged alongside the metrics and searchable, but not turned into metrics
+        self.tags: dict[str, str] = {}
+
+# the invocation being measured, or None if this one wasn't sampled
+current: Invocation | None = None
+
+# where finished metric lines go; Lambda sends stdout to CloudWatch Logs
+sink = print
+
+def start():
+    global current
+    current = Invocation() if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE else None
+
+def enabled():
+    return current is not None
+
+def add(name: str, value: float):
+    if current is not None:
+        current.values[name] = current.values.get(name, 0) + value
+
+def put(name: str, value: float):
+    if current is not None:
+        current.values[name] = value
+
+def dimension(name: str, value: str):
+    if current is not None:
+        current.dimensions[name] = value
+
+def tag(name: str, value: str):
+    if current is not None:
+        current.tags[name] = value
+
+class Timer:
+    # adds the milliseconds spent inside the with block to a metric
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        add(self.name, (time.perf_counter() - self.start) * 1000)
+
+class NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+NO_TIMER = NoTimer()
+
+def phase(name: str):
+    # with phase("load"): ... adds to the loadMs metric
+    return Timer(f"{name}Ms") if current is not None else NO_TIMER
+
+def unit(name: str):
+    if name.endswith("Ms"):
+        return "Milliseconds"
+    if name.endswith("Bytes"):
+        return "Bytes"
+    return "Count"
+
+def emit():
+    global current
+    invocation, current = current, None
+    if invocation is None:
+        return
+    line = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [list(invocation.dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit(name)} for name in invocation.values],
+            }],
+        },
+    }
+    line.update(invocation.tags)
+    line.update(invocation.dimensions)
+    line.update({name: round(value, 3) for name, value in invocation.values.items()})
+    sink(json.dumps(line))
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# upgrades every guild in BANK_DIR ahead of time, so the first command in an old guild doesn't
+# pay for it: snapshots on an old VERSION (or binbank version) are migrated, stats are
+# backfilled, history is indexed, and everything is written back, in parallel over guilds.
+# with --compact every guild's journal is folded into a fresh snapshot too, and with --format
+# snapshots are converted to that format. --archive keeps a copy of each guild's snapshot and
+# journal as they were, under the same names, before anything is written.
+#
+# safe to run while the bot is live: each guild goes through lambda_function.file_server,
+# holding the guild's lock exclusively like any command, and files are replaced atomically.
+# containers with the guild cached see the new generation and reload it.
+#
+# prints a line per guild and a summary; --report writes a JSON line per guild, with what
+# lambda_function logged for it. --dry-run only reports versions and sizes
+#
+#   python migrate_banks.py [--jobs N] [--format json|binary] [--compact] [--archive DIR]
+#                           [--dry-run] [--report FILE] [GUILD...]
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import binbank
+import lambda_function
+
+def snapshot_version(guild: str):
+    path = lambda_function.server_file(guild)
+    if not os.path.exists(path):
+        return "none"
+    with open(path, "rb") as file:
+        return lambda_function.read_version(file)
+
+def snapshot_format(version: str):
+    if version == "none":
+        return None
+    return "binary" if version in binbank.BINARY_VERSIONS else "json"
+
+def file_size(path: str):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def bank_bytes(guild: str):
+    # the snapshot and journal; history segments are only ever appended to, and not rewritten here
+    return file_size(lambda_function.server_file(guild)) + file_size(lambda_function.journal_file(guild))
+
+def archive_guild(guild: str, dir: str):
+    os.makedirs(dir, exist_ok=True)
+    for path in (lambda_function.server_file(guild), lambda_function.journal_file(guild)):
+        if os.path.exists(path):
+            shutil.copy2(path, f"{dir}/{os.path.basename(path)}")
+
+def upgrade_guild(task: tuple):
+    guild, format, compact, archive, dry_run = task
+    version = snapshot_version(guild)
+    report = {
+        "guild": guild,
+        "versionBefore": version,
+        "bytesBefore": bank_bytes(guild),
+        "journalBytesBefore": file_size(lambda_function.journal_file(guild)),
+    }
+    if dry_run:
+        return report
+    if format is not None:
+        lambda_function.BANK_FORMAT = format
+    # the snapshot is only rewritten if something is out of date, unless asked to. commands
+    # don't check for history from before the index, so that is looked for here
+    rewrite = compact or (format is not None and snapshot_format(version) != format) or \
+        lambda_function.history_unindexed(lambda_function.history_dir(guild))
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            before = lambda_function.file_stat(lambda_function.server_file(guild))
+            with lambda_function.file_server(guild, compact=rewrite) as bank:
+                # under the guild's lock, so these are the files about to be replaced
+                if archive is not None:
+                    archive_guild(guild, archive)
+                report["users"] = bank.user_count()
+                report["openBets"] = len(bank.current_bets)
+            report["rewritten"] = lambda_function.file_stat(lambda_function.server_file(guild)) != before
+    except Exception as e:
+        report["error"] = repr(e)
+    report["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    report["versionAfter"] = snapshot_version(guild)
+    report["bytesAfter"] = bank_bytes(guild)
+    report["log"] = log.getvalue().splitlines()
+    return report
+
+def print_report(report: dict):
+    line = f"{report['guild']:20} {report['versionBefore']:>6}"
+    if "versionAfter" in report:
+        line += f" -> {report['versionAfter']:6} {report['bytesBefore']:>11} -> {report['bytesAfter']:<11} {report['ms']:9.1f} ms"
+        if "error" in report:
+            line += f"  FAILED {report['error']}"
+        elif report["rewritten"]:
+            line += "  rewritten"
+    else:
+        line += f" {report['bytesBefore']:>11} bytes, {report['journalBytesBefore']} in the journal"
+    print(line)
+
+def print_summary(reports: list[dict], seconds: float):
+    versions: dict[str, int] = {}
+    for report in reports:
+        versions[report['versionBefore']] = versions.get(report['versionBefore'], 0) + 1
+    print(f"{len(reports)} guilds in {seconds:.1f}s")
+    print("versions before: " + ", ".join(f"{version} x{count}" for version, count in sorted(versions.items())))
+    before = sum(report['bytesBefore'] for report in reports)
+    print(f"bytes before: {before}")
+    done = [report for report in reports if "versionAfter" in report]
+    if len(done) == 0:
+        return
+    print(f"bytes after: {sum(report['bytesAfter'] for report in done)}")
+    print(f"rewritten: {sum(1 for report in done if report.get('rewritten'))}")
+    slowest = max(done, key=lambda report: report['ms'])
+    print(f"slowest: {slowest['guild']} in {slowest['ms']:.1f} ms")
+    failed = [report for report in done if "error" in report]
+    if len(failed) > 0:
+        print(f"FAILED: {len(failed)}: " + ", ".join(report['guild'] for report in failed))
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(description="upgrade every guild in BANK_DIR ahead of time")
+    parser.add_argument("guilds", nargs="*", help="guilds to upgrade, every guild in BANK_DIR if none")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="guilds upgraded at once")
+    parser.add_argument("--format", choices=["json", "binary"], help="convert snapshots to this format")
+    parser.add_argument("--compact", action="store_true", help="fold every journal into a fresh snapshot")
+    parser.add_argument("--archive", help="copy each guild's files here before they are rewritten")
+    parser.add_argument("--dry-run", action="store_true", help="only report versions and sizes")
+    parser.add_argument("--report", help="write a JSON line per guild to this file")
+    options = parser.parse_args(args)
+
+    guilds = options.guilds or lambda_function.file_guilds()
+    tasks = [(guild, options.format, options.compact, options.archive, options.dry_run) for guild in guilds]
+    start = time.perf_counter()
+    reports = []
+    with multiprocessing.Pool(options.jobs) as pool:
+        for report in pool.imap_unordered(upgrade_guild, tasks):
+            print_report(report)
+            reports.append(report)
+    print_summary(reports, time.perf_counter() - start)
+    if options.report:
+        with open(options.report, "w") as file:
+            for report in sorted(reports, key=lambda report: report['guild']):
+                file.write(json.dumps(report) + '\n')
+    return 1 if any("error" in report for report in reports) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
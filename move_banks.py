@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# moves guilds kept directly in BANK_DIR, from before shard directories, into their shards
+# (see lambda_function.shard_dir). a directory with tens of thousands of guilds makes every
+# lookup in it slow, on EFS especially.
+#
+# safe to run while the bot is live. each guild's files are moved while holding its old lock,
+# then its lock is created in the shard, and from then on every container finds it there
+# (lambda_function.guild_dir). containers waiting on the old lock see the new one once they
+# get it, and look the guild up again. the old lock is removed last. files are renamed, not
+# copied, so the shards must be on the same filesystem as the rest of BANK_DIR.
+# a container that opens the old lock just as it's removed can leave an empty one behind, which
+# the next run removes. once every guild is moved, FLAT_LAYOUT_FALLBACK can be turned off.
+#
+#   python move_banks.py [--jobs N] [--dry-run] [GUILD...]
+import argparse
+import fcntl
+import multiprocessing
+import os
+import sys
+import time
+import lambda_function
+
+# every file and directory a guild can have, by suffix on its id. the lock is handled separately
+SUFFIXES = ("", ".journal", ".replies", ".responses", ".history")
+
+def flat_path(guild: str, suffix: str = ""):
+    return f"{lambda_function.BANK_DIR}/{guild}{suffix}"
+
+def flat_guilds():
+    # guilds with anything left directly in BANK_DIR
+    guilds = set()
+    for name in os.listdir(lambda_function.BANK_DIR):
+        guild, _, suffix = name.partition('.')
+        if suffix in ("", "journal", "replies", "responses", "history", "lock", "tmp") and \
+                (suffix != "" or os.path.isfile(flat_path(guild))):
+            guilds.add(guild)
+    return sorted(guilds)
+
+def move_guild(task: tuple):
+    guild, dry_run = task
+    shard = lambda_function.shard_dir(guild)
+    present = [suffix for suffix in SUFFIXES if os.path.exists(flat_path(guild, suffix))]
+    report = {"guild": guild, "shard": shard, "moved": present}
+    if dry_run:
+        return report
+    start = time.perf_counter()
+    try:
+        old = os.open(flat_path(guild, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # every container finds the guild in BANK_DIR until its lock exists in the shard, and
+            # waits on this lock, so the shard isn't seen until everything is in it
+            fcntl.flock(old, fcntl.LOCK_EX)
+            present = [suffix for suffix in SUFFIXES if os.path.exists(flat_path(guild, suffix))]
+            # an interrupted move leaves some files in the shard already, but never the same one twice
+            clash = [suffix for suffix in present if os.path.exists(f"{shard}/{guild}{suffix}")]
+            if len(clash) > 0:
+                raise Exception(f"both {lambda_function.BANK_DIR} and {shard} have {clash} for this guild")
+            os.makedirs(shard, exist_ok=True)
+            for suffix in present:
+                os.rename(flat_path(guild, suffix), f"{shard}/{guild}{suffix}")
+            report["moved"] = present
+            if os.path.exists(flat_path(guild, ".tmp")):
+                # a snapshot a crashed write never put in place
+                os.remove(flat_path(guild, ".tmp"))
+            new = os.open(f"{shard}/{guild}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # past the old generation, so cached copies of the bank are read again
+                generation = max(lambda_function.read_generation(old), lambda_function.read_generation(new))
+                lambda_function.write_generation(new, generation + 1)
+                os.fsync(new)
+            finally:
+                os.close(new)
+            # commands that read the guild holding the old lock shared take it again to write,
+            # and see it was written since
+            lambda_function.write_generation(old, generation + 1)
+            os.remove(flat_path(guild, ".lock"))
+        finally:
+            os.close(old)
+    except Exception as e:
+        report["error"] = repr(e)
+    report["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return report
+
+def print_report(report: dict):
+    line = f"{report['guild']:20} -> {report['shard']:30} {', '.join(suffix or 'snapshot' for suffix in report['moved']) or 'lock only'}"
+    if "error" in report:
+        line += f"  FAILED {report['error']}"
+    print(line)
+
+def main(args: list[str]):
+    parser = argparse.ArgumentParser(description="move guilds from the top of BANK_DIR into shard directories")
+    parser.add_argument("guilds", nargs="*", help="guilds to move, every guild not in its shard if none")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="guilds moved at once")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be moved")
+    options = parser.parse_args(args)
+
+    guilds = options.guilds or flat_guilds()
+    start = time.perf_counter()
+    reports = []
+    with multiprocessing.Pool(options.jobs) as pool:
+        for report in pool.imap_unordered(move_guild, [(guild, options.dry_run) for guild in guilds]):
+            print_report(report)
+            reports.append(report)
+    failed = [report['guild'] for report in reports if "error" in report]
+    print(f"{len(reports)} guilds in {time.perf_counter() - start:.1f}s")
+    if len(failed) > 0:
+        print(f"FAILED: {len(failed)}: " + ", ".join(failed))
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
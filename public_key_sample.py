@@ -3,3 +3,15 @@
 # APPLICATION_ID = "like 20 digit number"
 # AUTH_TOKEN = "Bot big-base64-with-dashes"
 # BANK_DIR = "/mnt/bot"
+# TIMEZONE = "America/New_York" # paychecks reset at midnight here; a zone name or a zoneinfo.ZoneInfo, not pytz
+# optional:
+# DEFER_BUDGET = 1.5 # acknowledge slow commands and answer with a follow-up; needs lambda:InvokeFunction on itself
+# DISCORD_API = "https://discord.com/api/v10"
+# STORAGE = "sqlite" # keep every guild in one SQLite database instead of files; see sqlbank.py to import them
+# SQLITE_PATH = "/mnt/bot/banks.sqlite3" # only one host may write it at a time, and WAL is off on network filesystems
+# BANK_FORMAT = "binary" # write every snapshot in this format; by default each guild keeps the one it has
+# JOURNAL = False # rewrite the whole snapshot on every change instead of appending to a journal
+# FLAT_LAYOUT_FALLBACK = False # once move_banks.py has moved every guild into its shard directory
+# BATCH_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/betbot" # deferred commands go here, for batch_handler
+# PENDING_BET_EXPIRY_DAYS = 7 # cancel and refund bets nobody accepted after this long
+# UNDECIDED_BET_EXPIRY_DAYS = 30 # cancel and refund accepted bets nobody decided after this long
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# SQLite storage for banks: one database for every guild, in WAL mode.
+#
+# WAL keeps its index in shared memory, which only works for processes on the same host. on a
+# network filesystem (EFS, NFS, SMB) the database gets a rollback journal instead, and relies on
+# the filesystem's locks, which such filesystems don't always honor. so the database should only
+# ever be written from one host at a time: local_server.py, or a Lambda function limited to a
+# single concurrent container, not one scaled out across many.
+#
+# a file bank has to be read whole for every command. here users and open bets are rows,
+# looked up by key as a command asks for them, and a command writes back only the rows it
+# changed, in one transaction:
+#   users      (guild, id) -> balance, last paycheck, wins, losses, cancelled, net
+#   guilds     guild -> the rest of the bank's fields (e.g. the leaderboard) as JSON
+#   open_bets  (guild, low, high) -> the bet, where low and high are its two users in sorted
+#              order; also indexed by (guild, high) and (guild, arbitrator)
+#   history    settled bets in the order they were settled
+#   history_index  (guild, user, n) -> the history seq of the user's nth settled bet, so a
+#              page of a user's history is one range of the primary key
+# timestamps are microseconds since 1970-01-01 and bet booleans are flag bits, as in binbank.
+#
+# run this file to copy the banks in BANK_DIR into the database (existing rows for those
+# guilds are replaced):
+#   python sqlbank.py import DATABASE [GUILD...]
+import json
+import os
+import sqlite3
+import sys
+import binbank
+
+BUSY_TIMEOUT = 5 # seconds a writer waits for another one before giving up
+# /proc/mounts types of filesystems other hosts can have mounted too, where WAL can't work
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "ceph", "glusterfs", "lustre", "fuse.sshfs"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    guild TEXT NOT NULL,
+    id TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    last_paycheck INTEGER NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    net INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guilds (
+    guild TEXT PRIMARY KEY,
+    fields TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS open_bets (
+    guild TEXT NOT NULL,
+    low TEXT NOT NULL,
+    high TEXT NOT NULL,
+    p1 TEXT NOT NULL,
+    p2 TEXT NOT NULL,
+    arbitrator TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    condition TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    flags INTEGER NOT NULL,
+    PRIMARY KEY (guild, low, high)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS open_bets_high ON open_bets (guild, high);
+CREATE INDEX IF NOT EXISTS open_bets_arbitrator ON open_bets (guild, arbitrator);
+CREATE INDEX IF NOT EXISTS open_bets_start ON open_bets (guild, start_time);
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY,
+    guild TEXT NOT NULL,
+    p1 TEXT NOT NULL,
+    p2 TEXT NOT NULL,
+    arbitrator TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    condition TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    flags INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_guild ON history (guild, seq);
+CREATE TABLE IF NOT EXISTS history_index (
+    guild TEXT NOT NULL,
+    user TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (guild, user, n)
+) WITHOUT ROWID;
+"""
+
+BET_COLUMNS = "p1, p2, arbitrator, amount, condition, start_time, end_time, flags"
+HISTORY_COLUMNS = ", ".join(f"history.{column}" for column in BET_COLUMNS.split(", "))
+USER_COLUMNS = "id, balance, last_paycheck, wins, losses, cancelled, net"
+# columns added to users since the first schema, with their definitions
+ADDED_USER_COLUMNS = {
+    "wins": "INTEGER NOT NULL DEFAULT 0",
+    "losses": "INTEGER NOT NULL DEFAULT 0",
+    "cancelled": "INTEGER NOT NULL DEFAULT 0",
+    "net": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# numbers every guild's settled bets per user, for history that has none yet
+INDEX_HISTORY = """
+INSERT OR IGNORE INTO history_index (guild, user, n, seq)
+SELECT guild, user, ROW_NUMBER() OVER (PARTITION BY guild, user ORDER BY seq) - 1, seq FROM (
+    SELECT guild, p1 AS user, seq FROM history WHERE {where}
+    UNION ALL SELECT guild, p2, seq FROM history WHERE {where} AND p2 != p1
+)
+"""
+
+def filesystem_type(path: str):
+    # the type of the filesystem path is on, from the deepest mount point above it in /proc/mounts.
+    # None where there is no /proc/mounts
+    path = os.path.realpath(path)
+    deepest, type = "", None
+    try:
+        with open("/proc/mounts", "r", encoding='utf-8') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces and the like in mount points are octal escapes
+                mount = fields[1].encode().decode('unicode_escape')
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(deepest):
+                    deepest, type = mount, fields[2]
+    except OSError:
+        return None
+    return type
+
+def connect(path: str):
+    # transactions are begun and ended explicitly, see GuildStore
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    if filesystem_type(os.path.dirname(os.path.abspath(path))) in NETWORK_FILESYSTEMS:
+        print(f"{path} is on a network filesystem, using a rollback journal instead of WAL")
+        connection.execute("PRAGMA journal_mode=DELETE")
+    else:
+        connection.execute("PRAGMA journal_mode=WAL")
+    # every commit is synced, like the file backend's fsyncs
+    connection.execute("PRAGMA synchronous=FULL")
+    indexed = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_index'").fetchone() is not None
+    connection.executescript(SCHEMA)
+    if not indexed:
+        # a database from before history_index. another connection doing the same at the same
+        # time numbers the rows the same way
+        connection.execute(INDEX_HISTORY.format(where="1"))
+    # CREATE TABLE IF NOT EXISTS leaves an older users table as it was
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(users)")}
+    for column, definition in ADDED_USER_COLUMNS.items():
+        if column not in existing:
+            connection.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+    return connection
+
+def is_busy(e: sqlite3.OperationalError):
+    # another connection holds the write lock, or wrote since this transaction's snapshot
+    return "locked" in str(e) or "busy" in str(e)
+
+def bet_row(bet: dict):
+    # a bet in its JSON form (as Bet.to_dict writes it) as BET_COLUMNS
+    return (bet['p1'], bet['p2'], bet['arbitrator'], bet['amount'], bet['condition'],
+            binbank.iso_to_micros(bet['startTime']), binbank.iso_to_micros(bet['endTime']), binbank.json_flags(bet))
+
+def bet_dict(row: tuple):
+    return binbank.bet_dict(*row)
+
+def pair(a: str, b: str):
+    return (a, b) if a <= b else (b, a)
+
+class GuildStore:
+    # one guild's rows. reads the same way as binbank.BinaryBank, so a Bank can use it as
+    # its user_source, and finds open bets by key for its bet_source
+    def __init__(self, connection: sqlite3.Connection, guild: str):
+        self.connection = connection
+        self.guild = guild
+
+    def begin(self, immediate: bool):
+        # an immediate transaction takes the write lock up front. a deferred one only reads
+        # until it writes, and its write fails with a busy error if anyone wrote in between
+        self.connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+
+    def commit(self):
+        self.connection.execute("COMMIT")
+
+    def rollback(self):
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+
+    def find_user(self, id: str):
+        return self.connection.execute(f"SELECT {USER_COLUMNS} FROM users WHERE guild = ? AND id = ?",
+                                       (self.guild, id)).fetchone()
+
+    def user_records(self):
+        return self.connection.execute(f"SELECT {USER_COLUMNS} FROM users WHERE guild = ? ORDER BY id",
+                                       (self.guild,))
+
+    @property
+    def user_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM users WHERE guild = ?", (self.guild,)).fetchone()[0]
+
+    def find_bet(self, a: str, b: str):
+        row = self.connection.execute(f"SELECT {BET_COLUMNS} FROM open_bets WHERE guild = ? AND low = ? AND high = ?",
+                                      (self.guild, *pair(a, b))).fetchone()
+        return None if row is None else bet_dict(row)
+
+    def bets_of(self, user_id: str):
+        # without ANALYZE statistics, SQLite would rather scan the guild's part of the primary key
+        # than use a secondary index, hence INDEXED BY
+        rows = self.connection.execute(f"SELECT {BET_COLUMNS} FROM open_bets WHERE guild = ? AND low = ? "
+                                       f"UNION ALL SELECT {BET_COLUMNS} FROM open_bets INDEXED BY open_bets_high "
+                                       f"WHERE guild = ? AND high = ?",
+                                       (self.guild, user_id, self.guild, user_id))
+        return [bet_dict(row) for row in rows]
+
+    def bets_arbitrated_by(self, user_id: str):
+        rows = self.connection.execute(f"SELECT {BET_COLUMNS} FROM open_bets INDEXED BY open_bets_arbitrator "
+                                       f"WHERE guild = ? AND arbitrator = ?",
+                                       (self.guild, user_id))
+        return [bet_dict(row) for row in rows]
+
+    def bets_started_before(self, pending_before: int, accepted_before: int):
+        # open bets not yet accepted that started before pending_before, and accepted ones that
+        # started (were accepted) before accepted_before, in micros
+        rows = self.connection.execute(f"SELECT {BET_COLUMNS} FROM open_bets INDEXED BY open_bets_start "
+                                       f"WHERE guild = ? AND start_time < ? "
+                                       f"AND (flags & {binbank.PENDING} != 0 AND start_time < ? "
+                                       f"OR flags & {binbank.PENDING} = 0 AND start_time < ?)",
+                                       (self.guild, max(pending_before, accepted_before), pending_before, accepted_before))
+        return [bet_dict(row) for row in rows]
+
+    def current_bets(self):
+        rows = self.connection.execute(f"SELECT {BET_COLUMNS} FROM open_bets WHERE guild = ?", (self.guild,))
+        return [bet_dict(row) for row in rows]
+
+    def bank_fields(self):
+        row = self.connection.execute("SELECT fields FROM guilds WHERE guild = ?", (self.guild,)).fetchone()
+        return {} if row is None else json.loads(row[0])
+
+    def history(self):
+        # oldest first
+        rows = self.connection.execute(f"SELECT {BET_COLUMNS} FROM history WHERE guild = ? ORDER BY seq", (self.guild,))
+        return (bet_dict(row) for row in rows)
+
+    def user_history(self, user_id: str, skip: int, count: int):
+        # as Bank.user_history, with bets as JSON
+        row = self.connection.execute("SELECT MAX(n) FROM history_index WHERE guild = ? AND user = ?",
+                                      (self.guild, user_id)).fetchone()
+        total = 0 if row[0] is None else row[0] + 1
+        rows = self.connection.execute(f"SELECT {HISTORY_COLUMNS} FROM history_index JOIN history USING (seq) "
+                                       f"WHERE history_index.guild = ? AND user = ? AND n BETWEEN ? AND ? ORDER BY n DESC",
+                                       (self.guild, user_id, total - skip - count, total - skip - 1))
+        return total, [bet_dict(row) for row in rows]
+
+    def write(self, users: list[tuple], removed: list[tuple[str, str]], bets: list[dict], settled: list[dict],
+              fields: dict | None = None):
+        # users are (id, balance, last paycheck in micros, wins, losses, cancelled, net), removed
+        # are bet pairs, bets are open bets that are new or changed, settled go on the end of the
+        # history and fields, if given, replace the bank's other fields
+        self.connection.executemany(f"INSERT OR REPLACE INTO users (guild, {USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(self.guild, *user) for user in users])
+        if fields is not None:
+            self.connection.execute("INSERT OR REPLACE INTO guilds (guild, fields) VALUES (?, ?)",
+                                    (self.guild, json.dumps(fields)))
+        self.connection.executemany("DELETE FROM open_bets WHERE guild = ? AND low = ? AND high = ?",
+                                    [(self.guild, *pair(*key)) for key in removed])
+        self.connection.executemany(f"INSERT OR REPLACE INTO open_bets (guild, low, high, {BET_COLUMNS}) "
+                                    f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(self.guild, *pair(bet['p1'], bet['p2']), *bet_row(bet)) for bet in bets])
+        for bet in settled:
+            seq = self.connection.execute(f"INSERT INTO history (guild, {BET_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          (self.guild, *bet_row(bet))).lastrowid
+            for user_id in {bet['p1'], bet['p2']}:
+                self.connection.execute("INSERT INTO history_index (guild, user, n, seq) "
+                                        "SELECT ?, ?, COALESCE(MAX(n) + 1, 0), ? FROM history_index WHERE guild = ? AND user = ?",
+                                        (self.guild, user_id, seq, self.guild, user_id))
+
+    def replace(self, users: list[tuple], bets: list[dict], settled, fields: dict):
+        # the whole guild, e.g. when importing it
+        for table in ("users", "guilds", "open_bets", "history", "history_index"):
+            self.connection.execute(f"DELETE FROM {table} WHERE guild = ?", (self.guild,))
+        self.write(users, [], bets, [], fields)
+        self.connection.executemany(f"INSERT INTO history (guild, {BET_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    ((self.guild, *bet_row(bet)) for bet in settled))
+        self.connection.execute(INDEX_HISTORY.format(where="guild = ?"), (self.guild, self.guild))
+
+def import_files(path: str, guilds: list[str]):
+    # lambda_function reads the files the way it always does, journal and history included
+    import lambda_function
+    connection = connect(path)
+    if len(guilds) == 0:
+        guilds = lambda_function.file_guilds()
+    for guild in guilds:
+        with lambda_function.file_server(guild) as bank:
+            users = lambda_function.bank_user_records(bank)
+            bets = [bet.to_dict() for bet in bank.current_bets]
+            store = GuildStore(connection, guild)
+            store.begin(immediate=True)
+            try:
+                store.replace(users, bets, (bet.to_dict() for bet in bank.iter_history()), bank.extra_fields())
+                store.commit()
+            except BaseException:
+                store.rollback()
+                raise
+        print(f"Imported {guild}: {len(users)} users, {len(bets)} open bets")
+    connection.close()
+
+def main(args: list[str]):
+    if len(args) < 2 or args[0] != "import":
+        print("usage: python sqlbank.py import DATABASE [GUILD...]")
+        return 1
+    import_files(args[1], args[2:])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,25 @@
+# lambda_function reads its settings from public_key.py when imported, so a throwaway one is
+# installed first, as the benchmarks do. every test gets its own BANK_DIR and empty caches
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from common import interaction, setup, signed_event
+
+SIGNING_KEY, _ = setup()
+import lambda_function
+
+@pytest.fixture
+def lf(tmp_path, monkeypatch):
+    monkeypatch.setattr(lambda_function, "BANK_DIR", str(tmp_path))
+    for cache in (lambda_function.bank_cache, lambda_function.seen_signatures, lambda_function.recent_responses,
+                  lambda_function.made_dirs, lambda_function.guild_dirs, lambda_function.cold_seconds,
+                  lambda_function.resident_banks):
+        cache.clear()
+    return lambda_function
+
+def run(guild: str, member: str, subcommand: str, **options):
+    # a signed interaction through lambda_handler; the message it was answered with
+    event = signed_event(SIGNING_KEY, interaction(guild, member, subcommand, **options))
+    return lambda_function.lambda_handler(event, None)['data']['content']
@@ -0,0 +1,58 @@
+import http.server
+import json
+import threading
+import pytest
+from common import interaction, signed_event
+from conftest import SIGNING_KEY
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    # plays Discord's webhook endpoint: records each request and answers with `status`
+    status = 200
+    received = []
+
+    def do_PATCH(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        StandIn.received.append((self.path, self.headers['Content-Type'], json.loads(body)))
+        self.send_response(StandIn.status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def discord(lf, monkeypatch):
+    server = http.server.HTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StandIn.status = 200
+    StandIn.received = []
+    monkeypatch.setattr(lf, "DISCORD_API", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(lf, "http_pool", None)
+    # every command is deferred, and the deferred invocation runs straight away
+    monkeypatch.setattr(lf, "DEFER_BUDGET", -1.0)
+    runs = []
+    monkeypatch.setattr(lf, "deferred_invoker", lambda event: runs.append(event))
+    yield runs
+    server.shutdown()
+    server.server_close()
+
+def test_deferred_command_edits_original_message(lf, discord):
+    event = signed_event(SIGNING_KEY, interaction("g", "1", "bank"))
+    assert lf.lambda_handler(event, None) == {"type": lf.RESPONSE_TYPES['ACK_WITH_SOURCE']}
+    assert len(discord) == 1 and StandIn.received == []
+    result = lf.lambda_handler({"deferred": discord[0]}, None)
+    assert StandIn.received == [("/webhooks/0/bench/messages/@original", "application/json", result['data'])]
+    assert "Balance: $1000" in result['data']['content']
+
+def test_failed_followup_is_retried(lf, discord):
+    lf.lambda_handler(signed_event(SIGNING_KEY, interaction("g", "1", "bank")), None)
+    StandIn.status = 500
+    # raising leaves the invocation to Lambda's retries, which answer from the stored result
+    with pytest.raises(Exception, match="Follow-up message failed with 500"):
+        lf.lambda_handler({"deferred": discord[0]}, None)
+    StandIn.status = 200
+    result = lf.lambda_handler({"deferred": discord[0]}, None)
+    assert [content['content'] for _, _, content in StandIn.received] == [result['data']['content']] * 2
+    # and the paycheck in it was only paid once
+    assert "Balance: $1000" in lf.handle_command(interaction("g", "1", "bank"))['data']['content']
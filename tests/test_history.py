@@ -0,0 +1,28 @@
+import json
+import os
+from conftest import run
+
+def settled_bet(p1: str, p2: str, amount: int):
+    return {"p1": p1, "p2": p2, "arbitrator": "3", "amount": amount, "condition": "old",
+            "startTime": "2023-01-01T00:00:00", "endTime": "2023-01-02T00:00:00",
+            "p1Won": True, "pending": False, "rejected": False, "p1Cancel": False, "p2Cancel": False}
+
+def test_legacy_history_moved_by_the_write(lf):
+    # a bank file from before history segments, with its settled bets still inside
+    history = [settled_bet("1", "2", 10), settled_bet("2", "1", 20)]
+    users = {id: {"id": id, "balance": 500, "lastPaycheck": "2023-01-01T00:00:00"} for id in ("1", "2")}
+    lf.make_dir(lf.guild_dir("g"))
+    with open(lf.server_file("g"), "w") as file:
+        file.write(lf.VERSION + "\n" + json.dumps({"users": users, "currentBets": [], "history": history}))
+    # reading it, as an optimistic command does under a shared lock, writes nothing
+    bank, _, upgraded = lf.read_file_bank("g")
+    assert upgraded
+    assert not os.path.exists(lf.history_dir("g"))
+    assert [bet.amount for bet in bank.iter_history()] == [10, 20]
+    run("g", "1", "stats")
+    assert [bet.amount for bet in lf.read_history(lf.history_dir("g"))] == [10, 20]
+    lf.bank_cache.clear()
+    bank, _, upgraded = lf.read_file_bank("g")
+    assert not upgraded
+    assert bank.get_user("1").wins == 1 and bank.get_user("1").losses == 1
+    assert bank.check_stats() == []
@@ -0,0 +1,33 @@
+from conftest import run
+
+def balance(lf, guild: str, user: str):
+    # as a cold container reads it
+    lf.bank_cache.clear()
+    bank, _, _ = lf.read_file_bank(guild)
+    return bank.get_user(user).balance
+
+def test_append_after_torn_record(lf):
+    run("g", "1", "bank")
+    run("g", "2", "bank")
+    path = lf.journal_file("g")
+    with open(path, "rb") as file:
+        data = file.read()
+    # the second claim's record cut in half, as by a crash mid-append
+    first = data.index(b"\n") + 1
+    with open(path, "wb") as file:
+        file.write(data[:first + (len(data) - first) // 2])
+    run("g", "3", "bank")
+    assert balance(lf, "g", "1") == 1000
+    assert balance(lf, "g", "3") == 1000
+    bank, records, _ = lf.read_file_bank("g")
+    assert records == 2
+
+def test_replaying_twice_is_harmless(lf):
+    run("g", "1", "bank")
+    run("g", "2", "bank")
+    run("g", "1", "bet", against="2", arbitrator="3", amount=100, condition="rain")
+    run("g", "2", "accept", against="1")
+    records = lf.read_journal(lf.journal_file("g"))
+    once, _, _ = lf.read_file_bank("g")
+    twice, _, _ = lf.read_file_bank("g", records)
+    assert once.to_dict() == twice.to_dict()
@@ -0,0 +1,30 @@
+import copy
+from common import interaction, signed_event
+from conftest import SIGNING_KEY
+
+def test_result_wins_over_acknowledgement(lf, monkeypatch):
+    # the deferred run finishes, and stores its result, before the acknowledgement is written
+    lf.lambda_handler(signed_event(SIGNING_KEY, interaction("g", "1", "bank")), None)
+    monkeypatch.setattr(lf, "DEFER_BUDGET", -1.0)
+    finished = []
+    monkeypatch.setattr(lf, "send_followup", lambda body, resp: finished.append(resp))
+    monkeypatch.setattr(lf, "deferred_invoker", lambda event: finished.append(lf.handle_event({"deferred": event})))
+    event = signed_event(SIGNING_KEY, interaction("g", "1", "bet", against="2", arbitrator="3", amount=100, condition="rain"))
+    assert lf.lambda_handler(copy.deepcopy(event), None) == {"type": lf.RESPONSE_TYPES['ACK_WITH_SOURCE']}
+    result = finished[0]
+    assert "bets $100" in result['data']['content']
+    # a redelivery, in this container or another one, gets the result and runs nothing
+    monkeypatch.setattr(lf, "deferred_invoker", lambda event: finished.append("ran again"))
+    assert lf.lambda_handler(copy.deepcopy(event), None) == result
+    lf.recent_responses.clear()
+    lf.seen_signatures.clear()
+    assert lf.lambda_handler(copy.deepcopy(event), None) == result
+    assert "ran again" not in finished
+
+def test_reader_prefers_result_written_first(lf):
+    body = interaction("g", "1", "bank")
+    result = lf.message_response("done")
+    lf.store_response(body, result)
+    lf.store_response(body, {"type": lf.RESPONSE_TYPES['ACK_WITH_SOURCE']}, locked=False)
+    lf.recent_responses.clear()
+    assert lf.stored_response(body) == result
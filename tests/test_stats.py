@@ -0,0 +1,32 @@
+from conftest import run
+
+def test_stats_match_history(lf, monkeypatch):
+    for member in ("1", "2", "3", "4"):
+        run("g", member, "bank")
+    # settled
+    run("g", "1", "bet", against="2", arbitrator="3", amount=100, condition="rain")
+    run("g", "2", "accept", against="1")
+    assert "has won" in run("g", "3", "decide", victor="1", loser="2")
+    # cancelled by both sides
+    run("g", "1", "bet", against="3", arbitrator="2", amount=50, condition="snow")
+    run("g", "3", "accept", against="1")
+    run("g", "1", "cancel", against="3")
+    assert "agreed to cancel" in run("g", "3", "cancel", against="1")
+    # still open, with everything 4 has on it
+    run("g", "4", "bet", against="1", arbitrator="3", amount=1000, condition="sun")
+    run("g", "1", "accept", against="4")
+    # expired before it was accepted
+    monkeypatch.setattr(lf, "PENDING_BET_EXPIRY_DAYS", 1e-12)
+    run("g", "2", "bet", against="3", arbitrator="1", amount=10, condition="hail")
+    run("g", "3", "bank")
+    monkeypatch.setattr(lf, "PENDING_BET_EXPIRY_DAYS", None)
+
+    leaderboard = run("g", "1", "leaderboard")
+    assert "<@4>" not in leaderboard and "$0" not in leaderboard
+    assert lf.bank_cache["g"].bank.check_stats() == []
+    lf.bank_cache.clear()
+    bank, _, _ = lf.read_file_bank("g")
+    assert bank.get_user("1").wins == 1 and bank.get_user("2").losses == 1
+    assert bank.get_user("1").cancelled == 1 and bank.get_user("2").cancelled == 1
+    assert bank.settled_count == 3
+    assert bank.check_stats() == []
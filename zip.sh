@@ -6,4 +6,4 @@ rm ../../../../function.zip || true
 cd env/lib/python3.10/site-packages
 zip -r ../../../../function.zip .
 cd ../../../..
-zip function.zip lambda_function.py public_key.py
+zip function.zip lambda_function.py binbank.py commands.py metrics.py sqlbank.py public_key.py